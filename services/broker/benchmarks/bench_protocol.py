@@ -0,0 +1,124 @@
+"""
+Benchmark comparing the text protocol with the binary protocol.
+
+A typical agent event (JSON with a diff) is published, parsed by the
+broker and encoded for a subscriber. The benchmark reports the bytes on
+the wire per message and the CPU time spent in client and broker.
+
+Run from the broker directory:
+
+    python benchmarks/bench_protocol.py
+"""
+
+import base64
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from broker import FSOBroker  # noqa: E402
+from protocol import FRAME_PUBLISH, FrameParser, LineParser, encode_frame  # noqa: E402
+
+MESSAGES = 20_000
+# messages sent back to back in a single read of the broker
+PIPELINE = 50
+
+TOPIC = "/tmp/enlyze/important_stuff/app.conf"
+EVENT = {
+    "emitter": "carbon",
+    "event_type": "modified",
+    "timestamp": "2024-11-26T18:15:52.323819",
+    "file_path": TOPIC,
+    "destination_path": None,
+    "diff": ["--- previous_version", "+++ current_version", "@@ -1,40 +1,40 @@"]
+    + [f" key_{i} = value_{i}\n" for i in range(40)]
+    + ["-debug = false\n", "+debug = true\n"],
+}
+
+
+def publish_text(body: bytes) -> bytes:
+    """Agent side: base64 encode the JSON and build PUBLISH lines."""
+    return b"".join(
+        f"PUBLISH {TOPIC} {base64.b64encode(body).decode('utf-8')}\n".encode("utf-8")
+        for _ in range(PIPELINE)
+    )
+
+
+def broker_text(parser: LineParser, chunk: bytes) -> list[bytes]:
+    """Broker side: split every line and re-encode it for the subscriber."""
+    out = []
+    for line in parser.feed(chunk):
+        _, topic, payload = line.decode("utf-8").strip().split(" ", 2)
+        out.append(FSOBroker._encode_text(topic, payload))
+    return out
+
+
+def receive_text(messages: list[bytes]) -> None:
+    """Recorder side: split, base64 decode and parse the JSON."""
+    for message in messages:
+        json.loads(base64.b64decode(message.split(b" ", 1)[1]))
+
+
+def publish_binary(body: bytes) -> bytes:
+    """Agent side: frame the raw JSON."""
+    return b"".join(encode_frame(FRAME_PUBLISH, TOPIC, body) for _ in range(PIPELINE))
+
+
+def broker_binary(parser: FrameParser, chunk: bytes) -> list[memoryview]:
+    """Broker side: forward the received frames as memoryview slices."""
+    return [frame for _, _, _, frame in parser.feed(chunk)]
+
+
+def receive_binary(messages: list[memoryview]) -> None:
+    """Recorder side: parse the JSON behind the frame header."""
+    for message in messages:
+        frame = bytes(message)
+        json.loads(frame[frame.index(b"{") :])
+
+
+def run(publish, broker, receive, parser, body: bytes) -> dict:
+    """Send all messages through one protocol and sum up sizes and timings."""
+    totals = {"in": 0, "out": 0, "publish": 0.0, "broker": 0.0, "receive": 0.0}
+    for _ in range(MESSAGES // PIPELINE):
+        start = time.perf_counter()
+        chunk = publish(body)
+        published = time.perf_counter()
+        messages = broker(parser, chunk)
+        brokered = time.perf_counter()
+        receive(messages)
+        received = time.perf_counter()
+
+        totals["in"] += len(chunk)
+        totals["out"] += sum(len(message) for message in messages)
+        totals["publish"] += published - start
+        totals["broker"] += brokered - published
+        totals["receive"] += received - brokered
+    return totals
+
+
+def main():
+    body = json.dumps(EVENT).encode("utf-8")
+    print(f"messages: {MESSAGES}, JSON body: {len(body)} bytes")
+    print(
+        f"{'protocol':<10}{'bytes in':>10}{'bytes out':>11}"
+        f"{'agent us':>10}{'broker us':>11}{'recorder us':>13}  (per message)",
+    )
+    runs = (
+        ("text", publish_text, broker_text, receive_text, LineParser()),
+        ("binary", publish_binary, broker_binary, receive_binary, FrameParser()),
+    )
+    for name, publish, broker, receive, parser in runs:
+        totals = run(publish, broker, receive, parser, body)
+        print(
+            f"{name:<10}{totals['in'] / MESSAGES:>10.0f}"
+            f"{totals['out'] / MESSAGES:>11.0f}"
+            f"{totals['publish'] / MESSAGES * 1e6:>10.2f}"
+            f"{totals['broker'] / MESSAGES * 1e6:>11.2f}"
+            f"{totals['receive'] / MESSAGES * 1e6:>13.2f}",
+        )
+
+
+if __name__ == "__main__":
+    main()
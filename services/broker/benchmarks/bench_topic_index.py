@@ -0,0 +1,57 @@
+"""
+Micro-benchmark comparing the subscription scan with the TopicIndex.
+
+Run from the broker directory:
+
+    python benchmarks/bench_topic_index.py
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from broker import FSOBroker  # noqa: E402
+from topics import TopicIndex  # noqa: E402
+
+SUBSCRIPTIONS = 10_000
+ROUNDS = 1_000
+
+
+def scan(broker, subscriptions, topic):
+    """The publish matching loop as it was before the index existed."""
+    matches = []
+    for sub_topic, writers in subscriptions.items():
+        if broker.topic_matches(sub_topic, topic):
+            matches.extend(writers)
+    return matches
+
+
+def main():
+    broker = FSOBroker()
+    index = TopicIndex()
+    subscriptions = {}
+    for i in range(SUBSCRIPTIONS):
+        # every recorder/dashboard watches its own host prefix
+        sub_topic = f"/srv/host-{i}/~" if i % 2 else f"/srv/host-{i}/etc/app.conf"
+        subscriptions[sub_topic] = [i]
+        index.add(sub_topic, i)
+
+    topic = f"/srv/host-{SUBSCRIPTIONS - 1}/etc/app.conf"
+    assert sorted(scan(broker, subscriptions, topic)) == sorted(index.match(topic))
+
+    scan_time = timeit.timeit(
+        lambda: scan(broker, subscriptions, topic),
+        number=ROUNDS,
+    )
+    index_time = timeit.timeit(lambda: index.match(topic), number=ROUNDS)
+
+    print(f"subscriptions: {SUBSCRIPTIONS}")
+    print(f"scan:  {scan_time / ROUNDS * 1e6:10.2f} us/publish")
+    print(f"index: {index_time / ROUNDS * 1e6:10.2f} us/publish")
+    print(f"speedup: {scan_time / index_time:.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,58 +1,460 @@
 import asyncio
+import base64
+import functools
+import json
 from collections import defaultdict
 
+from cluster import serve_workers
+from outbound import OVERFLOW_BLOCK, OVERFLOW_POLICIES, OutboundQueue
+from protocol import (
+    FRAME_DISCONNECT,
+    FRAME_MESSAGE,
+    FRAME_PUBLISH,
+    FRAME_PUBLISH_BATCH,
+    FRAME_PUBLISH_TEXT,
+    FRAME_STATS,
+    FRAME_SUBSCRIBE,
+    FRAME_SUBSCRIBE_FROM,
+    FRAME_SUBSCRIBE_GROUP,
+    MAX_BATCH_SIZE,
+    MAX_MESSAGE_SIZE,
+    OFFSET,
+    PROTOCOL_BINARY,
+    PROTOCOL_TEXT,
+    FrameParser,
+    LineParser,
+    ProtocolError,
+    decode_batch,
+    encode_frame,
+)
+from storage import MessageLog
+from topics import SubscriptionGroup, TopicIndex
+
+# bytes requested from the socket per read
+READ_SIZE = 64 * 1024
+
+# reserved topic the broker answers STATS requests on
+STATS_TOPIC = "$SYS/broker/stats"
+# replay from the oldest stored message
+EARLIEST = "earliest"
+# stored messages skipped during a replay before yielding to other clients
+REPLAY_YIELD_INTERVAL = 1000
+
 
 class FSOBroker:
-    def __init__(self):
-        # topic -> list of (writer, wildcard)
+    def __init__(
+        self,
+        queue_size: int = 1024,
+        overflow: str = OVERFLOW_BLOCK,
+        flush_timeout: float = 5.0,
+        max_message_size: int = MAX_MESSAGE_SIZE,
+        log: MessageLog | None = None,
+        verbose: bool = True,
+    ):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        self.queue_size = queue_size
+        self.overflow = overflow
+        # how long to wait for pending messages when a client goes away
+        self.flush_timeout = flush_timeout
+        # upper limit for a single command, larger ones drop the client
+        self.max_message_size = max_message_size
+        # optional durable log of all messages, enables replays
+        self.log = log
+        # print every published message, costly under high load
+        self.verbose = verbose
+        # connections to other worker processes of a multi-process broker
+        self.peers = []
+        # topic -> list of writers
         self.subscriptions = defaultdict(list)
+        # writer -> list of subscribed topics, used to clean up on disconnect
+        self.client_topics = defaultdict(list)
+        # (group, topic) -> shared subscription of the group members
+        self.groups = {}
+        # writer -> list of (group, topic) the client is member of
+        self.client_groups = defaultdict(list)
+        # index over all subscriptions to find matching writers quickly
+        self.index = TopicIndex()
+        # writer -> outbound queue feeding the connection
+        self.outbound = {}
+        # writers that negotiated the binary protocol
+        self.binary_clients = set()
+        # binary writers receiving messages together with their offset
+        self.offset_clients = set()
+        # writer -> (message count, messages) of an incomplete PUBLISH_BATCH
+        self.pending_batches = {}
+        # writer -> running replay tasks
+        self.replays = defaultdict(list)
         self.clients = []
 
     async def handle_client(self, reader, writer):
         """Handle an individual client connection."""
         self.clients.append(writer)
+        self._outbound(writer)
         addr = writer.get_extra_info("peername")
         print(f"Client connected: {addr}")
 
+        parser = LineParser(self.max_message_size)
         try:
-            while data := await reader.read(1024):
-                message = data.decode("utf-8").strip()
-                if message.startswith("SUBSCRIBE"):
-                    # handle subsribe actions
-                    topic = message.split(" ", 1)[1]
-                    self.subscribe(writer, topic)
-                elif message.startswith("PUBLISH"):
-                    # handle publish action
-                    _, topic, payload = message.split(" ", 2)
-                    await self.publish(topic, payload)
-                elif message == "DISCONNECT":
-                    break
+            while data := await reader.read(READ_SIZE):
+                if writer in self.binary_clients:
+                    if not await self.handle_frames(writer, parser.feed(data)):
+                        return
+                    continue
+
+                # a single read may contain many commands or only part of one
+                lines = parser.feed(data)
+                for i, line in enumerate(lines):
+                    if line.startswith(b"HELLO"):
+                        if not await self.hello(writer, line):
+                            continue
+                        # everything behind the handshake is already binary
+                        rest = b"".join(pending + b"\n" for pending in lines[i + 1 :])
+                        rest += parser.flush()
+                        parser = FrameParser(self.max_message_size)
+                        if not await self.handle_frames(writer, parser.feed(rest)):
+                            return
+                        break
+                    if not await self.handle_command(writer, line):
+                        return
+            # the client closed the connection, handle an unterminated command
+            if writer not in self.binary_clients and (rest := parser.flush()):
+                await self.handle_command(writer, rest)
         except Exception as e:
             print(f"Error with client {addr}: {e}")
         finally:
+            # deliver what is still queued for the client before closing
+            if writer in self.outbound:
+                await self.outbound[writer].flush(self.flush_timeout)
             self.disconnect(writer)
             # close the remote connection
             print(f"Client disconnected: {addr}")
 
+    async def handle_command(self, writer, line: bytes) -> bool:
+        """
+        Execute a single text command of a client.
+        Returns False if the client wants to disconnect.
+        """
+        message = line.decode("utf-8").strip()
+        if writer in self.pending_batches:
+            # line of a PUBLISH_BATCH
+            count, messages = self.pending_batches[writer]
+            command, topic, payload = message.split(" ", 2)
+            if command != "PUBLISH":
+                raise ProtocolError(f"Batch carries a {command} command")
+            messages.append((topic, payload, None))
+            if len(messages) == count:
+                del self.pending_batches[writer]
+                await self.publish_batch(messages)
+        elif message.startswith("PUBLISH_BATCH"):
+            # the next <count> lines are PUBLISH commands of the batch
+            count = int(message.split(" ", 1)[1])
+            if count > MAX_BATCH_SIZE:
+                raise ProtocolError(f"Batch exceeds {MAX_BATCH_SIZE} messages")
+            if count > 0:
+                self.pending_batches[writer] = (count, [])
+        elif message.startswith("SUBSCRIBE_GROUP"):
+            # share the subscription with the other members of the group
+            _, group, topic = message.split(" ", 2)
+            self.subscribe_group(writer, group, topic)
+        elif message.startswith("SUBSCRIBE_FROM"):
+            # subscribe and replay stored messages first
+            _, start, topic = message.split(" ", 2)
+            self.subscribe_from(writer, topic, start)
+        elif message.startswith("SUBSCRIBE"):
+            # handle subsribe actions
+            topic = message.split(" ", 1)[1]
+            self.subscribe(writer, topic)
+        elif message.startswith("PUBLISH"):
+            # handle publish action
+            _, topic, payload = message.split(" ", 2)
+            await self.publish(topic, payload)
+        elif message == "STATS":
+            await self.send_stats(writer)
+        elif message == "DISCONNECT":
+            return False
+        return True
+
+    async def hello(self, writer, line: bytes) -> bool:
+        """
+        Negotiate the protocol version with "HELLO <version>". The broker
+        answers with the version it is going to use from now on.
+        Returns True if the client switched to the binary protocol.
+        """
+        version = line.decode("utf-8").strip().split(" ", 1)[-1]
+        if version != str(PROTOCOL_BINARY):
+            await self._send(writer, f"OK {PROTOCOL_TEXT}\n".encode("utf-8"))
+            return False
+        await self._send(writer, f"OK {PROTOCOL_BINARY}\n".encode("utf-8"))
+        self.binary_clients.add(writer)
+        return True
+
+    async def handle_frames(self, writer, frames: list) -> bool:
+        """
+        Execute binary frames of a client.
+        Returns False if the client wants to disconnect.
+        """
+        for frame_type, topic, body, frame in frames:
+            if frame_type == FRAME_PUBLISH:
+                # forward the received frame as it is
+                await self.publish(topic, body, frame)
+            elif frame_type == FRAME_PUBLISH_BATCH:
+                messages = []
+                for _, batch_topic, batch_body, batch_frame in decode_batch(body):
+                    messages.append((batch_topic, batch_body, batch_frame))
+                await self.publish_batch(messages)
+            elif frame_type == FRAME_SUBSCRIBE:
+                self.subscribe(writer, topic)
+            elif frame_type == FRAME_SUBSCRIBE_FROM:
+                self.subscribe_from(writer, topic, str(body, "utf-8"))
+            elif frame_type == FRAME_SUBSCRIBE_GROUP:
+                self.subscribe_group(writer, str(body, "utf-8"), topic)
+            elif frame_type == FRAME_STATS:
+                await self.send_stats(writer)
+            elif frame_type == FRAME_DISCONNECT:
+                return False
+            else:
+                raise ProtocolError(f"Unknown frame type: {frame_type}")
+        return True
+
     def subscribe(self, writer, topic):
         """
         Subscribe a client to a topic.
         We need to map topics to subsribed clients
         """
         print(f"Subscribing client to topic: {topic}")
+        self._outbound(writer)
         self.subscriptions[topic].append(writer)
+        self.client_topics[writer].append(topic)
+        self.index.add(topic, writer)
+
+    def subscribe_group(self, writer, group, topic):
+        """
+        Subscribe a client to a topic as member of a group. Each message
+        is delivered to only one member of the group, chosen by its topic.
+        Groups only exist within a worker, with other workers each of them
+        would deliver the messages to one of its own members.
+        """
+        if self.peers:
+            raise ProtocolError("Shared subscriptions need a single worker")
+        print(f"Subscribing client to topic {topic} in group {group}")
+        self._outbound(writer)
+        key = (group, topic)
+        if key not in self.groups:
+            self.groups[key] = SubscriptionGroup(group, topic)
+            self.index.add(topic, self.groups[key])
+        self.groups[key].add(writer)
+        self.client_groups[writer].append(key)
+
+    def subscribe_from(self, writer, topic, start):
+        """
+        Subscribe a client to a topic, beginning with the stored messages
+        from offset `start` on (or "earliest" for all stored messages).
+        The offset applies to every topic matching the subscription.
+        """
+        if self.log is None:
+            print("Persistence is disabled, subscribing to new messages only.")
+            self.subscribe(writer, topic)
+            return
+
+        from_offset = 0 if start == EARLIEST else int(start)
+        self._outbound(writer)
+        if writer in self.binary_clients:
+            self.offset_clients.add(writer)
+        task = asyncio.get_running_loop().create_task(
+            self._replay(writer, topic, from_offset),
+        )
+        self.replays[writer].append(task)
+
+    async def _replay(self, writer, topic, from_offset):
+        """Send stored messages to a client, then subscribe it to new ones."""
+        print(f"Replaying {topic} from offset {from_offset}")
+        skipped = 0
+        for record_topic, payload, offset in self.log.replay():
+            if offset < from_offset or not self.topic_matches(topic, record_topic):
+                skipped += 1
+                if skipped % REPLAY_YIELD_INTERVAL == 0:
+                    await asyncio.sleep(0)
+                continue
+            if writer in self.offset_clients:
+                data = self._encode_message(record_topic, payload, offset)
+            elif writer in self.binary_clients:
+                data = self._encode_binary(record_topic, payload)
+            else:
+                data = self._encode_text(record_topic, payload)
+            # paced by the client, it asked for all of these messages
+            await self._send(writer, data, wait=True)
+            if writer not in self.outbound:
+                # client disconnected during the replay
+                return
+
+        # nothing was awaited since the latest stored message was read, so
+        # new messages continue right behind the replayed ones
+        self.subscribe(writer, topic)
+
+    async def publish(self, topic, payload, frame=None, forward=True):
+        """
+        Publish a message to a topic.
+        The payload is a string for text clients and a bytes-like body for
+        binary clients, which also pass the frame it was received in.
+        Messages are forwarded to the other workers unless they came from one.
+        """
+        for writer, data in self._route(topic, payload, frame, forward):
+            await self._send(writer, data)
+
+    async def publish_batch(self, messages: list, forward=True):
+        """
+        Publish a batch of (topic, payload, frame) messages. Each client
+        receives all of its messages of the batch as a single queue entry,
+        so they are written with a single drain.
+        """
+        batches = {}
+        for topic, payload, frame in messages:
+            for writer, data in self._route(topic, payload, frame, forward):
+                batches.setdefault(writer, []).append(data)
+        for writer, parts in batches.items():
+            await self._send(writer, parts)
+
+    def _route(self, topic, payload, frame=None, forward=True) -> list:
+        """
+        Store a message and return (writer, data) for every connection it
+        has to be sent to. Every message is encoded at most once per
+        protocol, not per subscriber.
+        """
+        if self.verbose:
+            print(f"Publishing to {topic}")
+        deliveries = []
+        if forward and self.peers:
+            data = self._encode_forward(topic, payload, frame)
+            deliveries.extend((peer, data) for peer in self.peers)
+        offset = self.log.append(topic, payload) if self.log else None
+
+        text_data = binary_data = message_data = None
+        for writer in self.index.match(topic):
+            if isinstance(writer, SubscriptionGroup):
+                writer = writer.pick(topic)
+            if offset is not None and writer in self.offset_clients:
+                if message_data is None:
+                    message_data = self._encode_message(topic, payload, offset)
+                deliveries.append((writer, message_data))
+            elif writer in self.binary_clients:
+                if binary_data is None and frame is not None:
+                    binary_data = frame
+                elif binary_data is None:
+                    binary_data = self._encode_binary(topic, payload)
+                deliveries.append((writer, binary_data))
+            else:
+                if text_data is None:
+                    text_data = self._encode_text(topic, payload)
+                deliveries.append((writer, text_data))
+        return deliveries
 
-    async def publish(self, topic, payload):
-        """Publish a message to a topic."""
-        print(f"Publishing to {topic}: {payload}")
-        for sub_topic, writers in self.subscriptions.items():
-            if self.topic_matches(sub_topic, topic):
-                for writer in writers:
-                    try:
-                        writer.write(f"{topic} {payload}\n".encode("utf-8"))
-                        await writer.drain()
-                    except Exception as e:
-                        print(f"Error sending to client: {e}")
+    def add_peer(self, writer) -> None:
+        """Add the connection to another worker process of the broker."""
+        # messages between workers must never be dropped
+        self.outbound[writer] = OutboundQueue(
+            writer,
+            maxsize=self.queue_size,
+            overflow=OVERFLOW_BLOCK,
+        )
+        self.peers.append(writer)
+
+    def _encode_forward(self, topic, payload, frame=None) -> bytes:
+        """Encode a message for the other workers, keeping text payloads text."""
+        if isinstance(payload, str):
+            return encode_frame(FRAME_PUBLISH_TEXT, topic, payload.encode("utf-8"))
+        if frame is not None:
+            return frame
+        return self._encode_binary(topic, payload)
+
+    async def handle_peer(self, reader, writer):
+        """Handle the connection of another worker forwarding its messages."""
+        parser = FrameParser(self.max_message_size)
+        try:
+            while data := await reader.read(READ_SIZE):
+                # everything of a single read is delivered as one batch
+                messages = []
+                for frame_type, topic, body, frame in parser.feed(data):
+                    if frame_type == FRAME_PUBLISH_TEXT:
+                        messages.append((topic, str(body, "utf-8"), None))
+                    else:
+                        messages.append((topic, body, frame))
+                await self.publish_batch(messages, forward=False)
+        except Exception as e:
+            print(f"Error with peer worker: {e}")
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _encode_text(topic: str, payload) -> bytes:
+        """
+        Encode a message for text clients. Binary bodies are base64
+        encoded, the text protocol cannot carry arbitrary bytes.
+        """
+        if isinstance(payload, str):
+            return f"{topic} {payload}\n".encode("utf-8")
+        return f"{topic} ".encode("utf-8") + base64.b64encode(payload) + b"\n"
+
+    @staticmethod
+    def _encode_binary(topic: str, payload) -> bytes:
+        """Encode a message for binary clients."""
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        return encode_frame(FRAME_PUBLISH, topic, payload)
+
+    @staticmethod
+    def _encode_message(topic: str, payload, offset: int) -> bytes:
+        """Encode a message together with its offset for binary clients."""
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        return encode_frame(FRAME_MESSAGE, topic, OFFSET.pack(offset) + payload)
+
+    def _outbound(self, writer) -> OutboundQueue:
+        """Return the outbound queue of a client, create it on first use."""
+        if writer not in self.outbound:
+            self.outbound[writer] = OutboundQueue(
+                writer,
+                maxsize=self.queue_size,
+                overflow=self.overflow,
+            )
+        return self.outbound[writer]
+
+    async def _send(self, writer, data: bytes, wait: bool = False) -> None:
+        """
+        Queue data for a client and apply the overflow policy, unless
+        wait is set, see OutboundQueue.put.
+        """
+        outbound = self.outbound.get(writer)
+        if outbound is None:
+            # client disconnected while we were waiting for another one
+            return
+        if not await outbound.put(data, wait):
+            print("Outbound queue of client is full, disconnecting.")
+            self.disconnect(writer)
+
+    async def flush(self) -> None:
+        """Wait until all outbound queues are written to their clients."""
+        for outbound in list(self.outbound.values()):
+            await outbound.flush()
+
+    def stats(self) -> dict:
+        """Return queue depth statistics per connected client."""
+        stats = {}
+        for writer, outbound in self.outbound.items():
+            addr = writer.get_extra_info("peername")
+            if isinstance(addr, tuple):
+                addr = f"{addr[0]}:{addr[1]}"
+            stats[str(addr)] = outbound.stats()
+        return stats
+
+    async def send_stats(self, writer) -> None:
+        """Send the queue depth statistics to a client."""
+        payload = json.dumps(self.stats(), separators=(",", ":"))
+        if writer in self.binary_clients:
+            data = self._encode_binary(STATS_TOPIC, payload)
+        else:
+            data = self._encode_text(STATS_TOPIC, payload)
+        await self._send(writer, data)
 
     def topic_matches(self, sub_topic, topic):
         """
@@ -74,29 +476,136 @@ class FSOBroker:
 
     def disconnect(self, writer):
         """Disconnect a client and clean up subscriptions."""
-        for topic in self.subscriptions.keys():
+        for topic in self.client_topics.pop(writer, []):
             self.subscriptions[topic] = [
                 w for w in self.subscriptions[topic] if w != writer
             ]
+            self.index.remove(topic, writer)
+        for key in self.client_groups.pop(writer, []):
+            group = self.groups.get(key)
+            if group is None:
+                continue
+            # the remaining members take over the topics of the client
+            group.remove(writer)
+            if not group.members:
+                self.index.remove(group.sub_topic, group)
+                del self.groups[key]
+        if writer in self.outbound:
+            self.outbound.pop(writer).stop()
+        self.binary_clients.discard(writer)
+        self.offset_clients.discard(writer)
+        self.pending_batches.pop(writer, None)
+        for task in self.replays.pop(writer, []):
+            task.cancel()
         if writer in self.clients:
             self.clients.remove(writer)
         writer.close()
 
 
-async def main():
-    broker = FSOBroker()
+async def main(host, port, broker):
     server = await asyncio.start_server(
-        # For demonstration, we run the server on localhost
         broker.handle_client,
-        "0.0.0.0",
-        1883,
+        host,
+        port,
     )
     addr = server.sockets[0].getsockname()
     print(f"Serving FSOBroker on {addr}")
 
     async with server:
-        await server.serve_forever()
+        try:
+            await server.serve_forever()
+        finally:
+            if broker.log:
+                broker.log.close()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-a", type=str, help="listen address", default="0.0.0.0")
+    parser.add_argument("-p", type=int, help="listen port", default=1883)
+    parser.add_argument(
+        "-q",
+        type=int,
+        help="outbound queue size per client",
+        default=1024,
+    )
+    parser.add_argument(
+        "-o",
+        type=str,
+        choices=OVERFLOW_POLICIES,
+        help="policy when an outbound queue is full",
+        default=OVERFLOW_BLOCK,
+    )
+    parser.add_argument(
+        "-m",
+        type=int,
+        help="maximum size of a single message in bytes",
+        default=MAX_MESSAGE_SIZE,
+    )
+    parser.add_argument(
+        "-w",
+        type=int,
+        help="number of worker processes sharing the port",
+        default=1,
+    )
+    parser.add_argument(
+        "--quiet",
+        action="store_true",
+        help="do not print every published message",
+    )
+    parser.add_argument(
+        "-d",
+        type=str,
+        help="directory of the message log, enables persistence",
+        default=None,
+    )
+    parser.add_argument(
+        "--segment-bytes",
+        type=int,
+        help="rotate log segments after this many bytes",
+        default=64 * 1024 * 1024,
+    )
+    parser.add_argument(
+        "--segment-age",
+        type=float,
+        help="rotate log segments after this many seconds",
+        default=3600.0,
+    )
+    parser.add_argument(
+        "--retention-bytes",
+        type=int,
+        help="remove old log segments above this total size",
+        default=None,
+    )
+    parser.add_argument(
+        "--retention-age",
+        type=float,
+        help="remove log segments older than this many seconds",
+        default=None,
+    )
+
+    args = parser.parse_args()
+    options = {
+        "queue_size": args.q,
+        "overflow": args.o,
+        "max_message_size": args.m,
+        "verbose": not args.quiet,
+    }
+    if args.w > 1:
+        if args.d:
+            # offsets per topic can only be handed out by a single process
+            parser.error("persistence is not supported with multiple workers")
+        serve_workers(functools.partial(FSOBroker, **options), args.a, args.p, args.w)
+    else:
+        log = None
+        if args.d:
+            log = MessageLog(
+                args.d,
+                segment_bytes=args.segment_bytes,
+                segment_age=args.segment_age,
+                retention_bytes=args.retention_bytes,
+                retention_age=args.retention_age,
+            )
+        asyncio.run(main(args.a, args.p, FSOBroker(log=log, **options)))
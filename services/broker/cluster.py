@@ -0,0 +1,101 @@
+"""Run the broker as several worker processes sharing one port"""
+
+import asyncio
+import multiprocessing
+import multiprocessing.connection
+import os
+import shutil
+import tempfile
+
+# seconds a worker waits for the other workers to come up
+PEER_CONNECT_TIMEOUT = 10.0
+
+
+async def connect_peers(broker, peer_paths: list[str]) -> None:
+    """
+    Connect a broker to the routing sockets of all other workers.
+    Workers start concurrently, so we retry until each socket is up.
+    """
+    loop = asyncio.get_running_loop()
+    for path in peer_paths:
+        deadline = loop.time() + PEER_CONNECT_TIMEOUT
+        while True:
+            try:
+                _, writer = await asyncio.open_unix_connection(path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if loop.time() > deadline:
+                    raise
+                await asyncio.sleep(0.05)
+        broker.add_peer(writer)
+
+
+async def run_worker(broker_factory, host, port, index, socket_paths):
+    """
+    Serve clients in a single worker process. The listening socket is
+    opened with SO_REUSEPORT, so the kernel spreads connections over all
+    workers. Messages published on this worker are routed to the other
+    workers through unix sockets and delivered to their subscribers.
+    """
+    broker = broker_factory()
+    peer_server = await asyncio.start_unix_server(
+        broker.handle_peer,
+        path=socket_paths[index],
+    )
+    await connect_peers(broker, socket_paths[:index] + socket_paths[index + 1 :])
+
+    # only accept clients once every worker is reachable
+    server = await asyncio.start_server(
+        broker.handle_client,
+        host,
+        port,
+        reuse_port=True,
+    )
+    print(f"Worker {index} (pid {os.getpid()}) serving FSOBroker on {host}:{port}")
+
+    async with peer_server, server:
+        await server.serve_forever()
+
+
+def _worker_main(broker_factory, host, port, index, socket_paths):
+    try:
+        asyncio.run(run_worker(broker_factory, host, port, index, socket_paths))
+    except KeyboardInterrupt:
+        pass
+
+
+def serve_workers(broker_factory, host: str, port: int, workers: int) -> None:
+    """
+    Fork worker processes sharing the listening port and wait for them.
+    If any worker dies, all others are stopped as well, since their
+    routing to the dead worker is broken. A supervisor (systemd, docker)
+    is expected to restart the broker.
+    """
+    socket_dir = tempfile.mkdtemp(prefix="fso-broker-")
+    socket_paths = [
+        os.path.join(socket_dir, f"worker-{i}.sock") for i in range(workers)
+    ]
+    # fork: the broker factory is inherited and does not need to be pickled
+    context = multiprocessing.get_context("fork")
+    processes = [
+        context.Process(
+            target=_worker_main,
+            args=(broker_factory, host, port, index, socket_paths),
+            name=f"fso-broker-worker-{index}",
+        )
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    try:
+        multiprocessing.connection.wait([p.sentinel for p in processes])
+        print("A broker worker exited, stopping all workers.")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+        shutil.rmtree(socket_dir, ignore_errors=True)
@@ -0,0 +1,106 @@
+"""Per-connection outbound queues decoupling publishers from slow consumers"""
+
+import asyncio
+
+# what happens when a client's outbound queue is full
+OVERFLOW_BLOCK = "block"  # the publisher waits for free space
+OVERFLOW_DROP_OLDEST = "drop_oldest"  # the oldest queued message is dropped
+OVERFLOW_DISCONNECT = "disconnect"  # the lagging client is disconnected
+OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_DISCONNECT)
+
+
+class OutboundQueue:
+    """
+    Bounded queue of encoded messages for a single client connection.
+    A dedicated writer task takes messages off the queue and writes them
+    to the connection, so a client with a full socket buffer only stalls
+    its own queue and not the publisher or other subscribers.
+    """
+
+    def __init__(self, writer, maxsize: int = 1024, overflow: str = OVERFLOW_BLOCK):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        self.writer = writer
+        self.overflow = overflow
+        self.queue = asyncio.Queue(maxsize)
+        self.closed = False
+        # statistics
+        self.sent = 0
+        self.dropped = 0
+        self.high_watermark = 0
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def put(self, data: bytes | list, wait: bool = False) -> bool:
+        """
+        Queue data for the client according to the overflow policy. A list
+        of buffers is queued as a single entry and written in one go.
+        With wait, the caller waits for free space whatever the policy.
+        Returns False if the client has to be disconnected.
+        """
+        if self.closed:
+            return False
+
+        if self.queue.full() and not wait:
+            if self.overflow == OVERFLOW_DISCONNECT:
+                return False
+            if self.overflow == OVERFLOW_DROP_OLDEST:
+                self.queue.get_nowait()
+                self.queue.task_done()
+                self.dropped += 1
+
+        await self.queue.put(data)
+        self.high_watermark = max(self.high_watermark, self.queue.qsize())
+        return True
+
+    async def _run(self) -> None:
+        """Write queued messages to the client, one drain per batch."""
+        try:
+            while True:
+                batch = [await self.queue.get()]
+                # take everything that piled up meanwhile in one go
+                while not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                for data in batch:
+                    if isinstance(data, list):
+                        self.writer.writelines(data)
+                    else:
+                        self.writer.write(data)
+                try:
+                    await self.writer.drain()
+                finally:
+                    self.sent += len(batch)
+                    for _ in batch:
+                        self.queue.task_done()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"Error sending to client: {e}")
+            self.stop()
+
+    async def flush(self, timeout: float | None = None) -> None:
+        """Wait until all queued messages were written to the client."""
+        if self.closed:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            print("Timeout while flushing outbound queue.")
+
+    def stop(self) -> None:
+        """Stop the writer task and discard everything still queued."""
+        self.closed = True
+        self.task.cancel()
+        # unblock publishers waiting for free space
+        while not self.queue.empty():
+            self.queue.get_nowait()
+            self.queue.task_done()
+
+    def stats(self) -> dict:
+        """Return queue depth statistics of the connection."""
+        return {
+            "queued": self.queue.qsize(),
+            "maxsize": self.queue.maxsize,
+            "high_watermark": self.high_watermark,
+            "sent": self.sent,
+            "dropped": self.dropped,
+        }
@@ -0,0 +1,161 @@
+"""Framing of the byte stream sent by clients into commands"""
+
+import struct
+
+# default upper limit for a single command including its payload
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+
+# protocol versions, negotiated with "HELLO <version>" after connecting
+PROTOCOL_TEXT = 1
+PROTOCOL_BINARY = 2
+
+# binary frame: type, topic length, body length, topic, body
+HEADER = struct.Struct("!BHI")
+FRAME_SUBSCRIBE = 1
+FRAME_PUBLISH = 2
+FRAME_DISCONNECT = 3
+FRAME_STATS = 4
+# body: offset to start from as ASCII number or "earliest"
+FRAME_SUBSCRIBE_FROM = 5
+# message of a replaying subscription, body: offset followed by the payload
+FRAME_MESSAGE = 6
+OFFSET = struct.Struct("!Q")
+# text payload forwarded between the worker processes of the broker
+FRAME_PUBLISH_TEXT = 7
+# body: name of the group sharing the subscription
+FRAME_SUBSCRIBE_GROUP = 8
+# body: PUBLISH frames of all messages in the batch
+FRAME_PUBLISH_BATCH = 9
+
+# upper limit of messages in a text PUBLISH_BATCH
+MAX_BATCH_SIZE = 65536
+
+
+class ProtocolError(Exception):
+    """Raised when a client violates the wire protocol."""
+
+
+class LineParser:
+    """
+    Buffered parser for the newline-delimited text protocol.
+
+    Data is fed as it arrives from the socket. Every complete line
+    contained in the buffer is returned at once, so pipelined commands
+    arriving in a single read are all handled, while a command split
+    over several reads is kept until its newline arrives.
+    """
+
+    def __init__(self, max_message_size: int = MAX_MESSAGE_SIZE):
+        self.max_message_size = max_message_size
+        self._buffer = bytearray()
+
+    def feed(self, data: bytes) -> list[bytes]:
+        """Add received data and return all complete lines (without newline)."""
+        # the buffer holds no newline, only the new data has to be searched,
+        # otherwise a line split over many reads is scanned again and again
+        start = len(self._buffer)
+        self._buffer += data
+        end = self._buffer.rfind(b"\n", start)
+        if end == -1:
+            self._check_size(len(self._buffer))
+            return []
+
+        lines = bytes(self._buffer[:end]).split(b"\n")
+        del self._buffer[: end + 1]
+        for line in lines:
+            self._check_size(len(line))
+        self._check_size(len(self._buffer))
+        return lines
+
+    def flush(self) -> bytes:
+        """Return and clear an incomplete trailing line, e.g. at EOF."""
+        rest = bytes(self._buffer)
+        self._buffer.clear()
+        return rest
+
+    def _check_size(self, size: int) -> None:
+        if size > self.max_message_size:
+            raise ProtocolError(
+                f"Message exceeds maximum size of {self.max_message_size} bytes",
+            )
+
+
+class FrameParser:
+    """
+    Buffered parser for the length-prefixed binary protocol.
+
+    Frames are returned as memoryview slices of the received data, so
+    bodies can be forwarded to subscribers without being copied or
+    decoded. Only a frame spanning several reads is copied once to
+    join its parts.
+    """
+
+    def __init__(self, max_message_size: int = MAX_MESSAGE_SIZE):
+        self.max_message_size = max_message_size
+        # chunks of an incomplete frame and the size needed to complete it
+        self._pending = []
+        self._pending_size = 0
+        self._needed = 0
+
+    def feed(self, data: bytes) -> list[tuple[int, str, memoryview, memoryview]]:
+        """
+        Add received data and return all complete frames as tuples of
+        (frame type, topic, body, whole frame).
+        """
+        if self._pending:
+            self._pending.append(data)
+            self._pending_size += len(data)
+            if self._pending_size < self._needed:
+                # join large frames once and not on every read
+                return []
+            data = b"".join(self._pending)
+            self._pending = []
+
+        view = memoryview(data)
+        frames = []
+        offset = 0
+        needed = HEADER.size
+        while len(view) - offset >= HEADER.size:
+            frame_type, topic_size, body_size = HEADER.unpack_from(view, offset)
+            if topic_size + body_size > self.max_message_size:
+                raise ProtocolError(
+                    f"Message exceeds maximum size of {self.max_message_size} bytes",
+                )
+            topic_start = offset + HEADER.size
+            body_start = topic_start + topic_size
+            end = body_start + body_size
+            if end > len(view):
+                needed = end - offset
+                break
+            topic = str(view[topic_start:body_start], "utf-8")
+            frames.append((frame_type, topic, view[body_start:end], view[offset:end]))
+            offset = end
+
+        if offset < len(view):
+            self._pending = [bytes(view[offset:])]
+            self._pending_size = len(view) - offset
+            self._needed = needed
+        return frames
+
+    @property
+    def pending(self) -> int:
+        """Number of buffered bytes of an incomplete frame."""
+        return self._pending_size if self._pending else 0
+
+
+def decode_batch(body: memoryview) -> list[tuple[int, str, memoryview, memoryview]]:
+    """Split the body of a PUBLISH_BATCH frame into its PUBLISH frames."""
+    parser = FrameParser()
+    frames = parser.feed(body)
+    if parser.pending:
+        raise ProtocolError("Incomplete frame in batch")
+    for frame_type, *_ in frames:
+        if frame_type != FRAME_PUBLISH:
+            raise ProtocolError(f"Frame type {frame_type} in batch, only PUBLISH")
+    return frames
+
+
+def encode_frame(frame_type: int, topic: str = "", body: bytes = b"") -> bytes:
+    """Encode a single binary frame."""
+    topic = topic.encode("utf-8")
+    return HEADER.pack(frame_type, len(topic), len(body)) + topic + body
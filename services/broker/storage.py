@@ -0,0 +1,231 @@
+"""Segmented append-only message log used for persistence and replay"""
+
+import json
+import mmap
+import os
+import struct
+import time
+import zlib
+
+# record: crc32, body length, topic offset, timestamp, flags, topic length
+RECORD = struct.Struct("!IIQdBH")
+# the body of the record is a text payload and not raw bytes
+FLAG_TEXT = 1
+
+SEGMENT_SUFFIX = ".log"
+# highest offset per topic, kept when segments are removed by retention
+OFFSETS_FILE = "offsets.json"
+
+
+class Segment:
+    """A single append-only file of the message log."""
+
+    def __init__(self, directory: str, segment_id: int):
+        self.id = segment_id
+        self.path = os.path.join(directory, f"{segment_id:020d}{SEGMENT_SUFFIX}")
+        self.size = 0
+        self.created = time.time()
+        self.last_timestamp = self.created
+
+    def mapped(self) -> mmap.mmap | None:
+        """Map the written part of the segment into memory for reading."""
+        if self.size == 0:
+            return None
+        with open(self.path, "rb") as f:
+            return mmap.mmap(f.fileno(), self.size, access=mmap.ACCESS_READ)
+
+
+class MessageLog:
+    """
+    Durable log of all published messages.
+
+    Messages are appended to the active segment file, which is rotated
+    once it exceeds a size or an age. Old segments are removed according
+    to the retention settings. Every message gets a monotonic offset per
+    topic. Replays read the segments through mmap and follow the log up
+    to the message appended last.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        segment_bytes: int = 64 * 1024 * 1024,
+        segment_age: float = 3600.0,
+        retention_bytes: int | None = None,
+        retention_age: float | None = None,
+    ):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment_age = segment_age
+        self.retention_bytes = retention_bytes
+        self.retention_age = retention_age
+        # topic -> offset of the next message
+        self.offsets = {}
+        self.segments = []
+        self._file = None
+
+        os.makedirs(directory, exist_ok=True)
+        self._recover()
+
+    def _recover(self) -> None:
+        """Load existing segments and rebuild the offsets of every topic."""
+        offsets_path = os.path.join(self.directory, OFFSETS_FILE)
+        if os.path.exists(offsets_path):
+            with open(offsets_path, "r", encoding="utf-8") as f:
+                self.offsets = json.load(f)
+
+        segment_ids = sorted(
+            int(name[: -len(SEGMENT_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.endswith(SEGMENT_SUFFIX)
+        )
+        for segment_id in segment_ids:
+            segment = Segment(self.directory, segment_id)
+            segment.size = os.path.getsize(segment.path)
+            valid_size = 0
+            for topic, _, offset, timestamp, end in self._records(segment):
+                self.offsets[topic] = max(self.offsets.get(topic, 0), offset + 1)
+                if valid_size == 0:
+                    segment.created = timestamp
+                segment.last_timestamp = timestamp
+                valid_size = end
+            if valid_size < segment.size:
+                # cut off a record torn by a crash
+                print(f"Truncating damaged log segment {segment.path}")
+                with open(segment.path, "r+b") as f:
+                    f.truncate(valid_size)
+                segment.size = valid_size
+            self.segments.append(segment)
+
+        if not self.segments:
+            self.segments.append(Segment(self.directory, 0))
+        self._file = open(self.segments[-1].path, "ab")
+
+    @staticmethod
+    def _records(segment: Segment, position: int = 0):
+        """
+        Yield (topic, payload, offset, timestamp, end position) of every
+        intact record of a segment, starting at the given position.
+        """
+        mapped = segment.mapped()
+        if mapped is None:
+            return
+        with mapped:
+            size = len(mapped)
+            while position + RECORD.size <= size:
+                crc, body_size, offset, timestamp, flags, topic_size = (
+                    RECORD.unpack_from(mapped, position)
+                )
+                start = position + RECORD.size
+                end = start + topic_size + body_size
+                if end > size:
+                    return
+                data = mapped[start:end]
+                if zlib.crc32(data) != crc:
+                    return
+                topic = data[:topic_size].decode("utf-8")
+                payload = data[topic_size:]
+                if flags & FLAG_TEXT:
+                    payload = payload.decode("utf-8")
+                yield topic, payload, offset, timestamp, end
+                position = end
+
+    def append(self, topic: str, payload) -> int:
+        """Append a message and return its offset within the topic."""
+        segment = self.segments[-1]
+        now = time.time()
+        if segment.size >= self.segment_bytes or (
+            segment.size > 0 and now - segment.created >= self.segment_age
+        ):
+            segment = self._rotate()
+
+        flags = 0
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+            flags |= FLAG_TEXT
+        topic_bytes = topic.encode("utf-8")
+        offset = self.offsets.get(topic, 0)
+        crc = zlib.crc32(payload, zlib.crc32(topic_bytes))
+        header = RECORD.pack(crc, len(payload), offset, now, flags, len(topic_bytes))
+
+        self._file.write(header)
+        self._file.write(topic_bytes)
+        self._file.write(payload)
+        # make the record visible to replays mapping the segment
+        self._file.flush()
+
+        if segment.size == 0:
+            segment.created = now
+        segment.size += len(header) + len(topic_bytes) + len(payload)
+        segment.last_timestamp = now
+        self.offsets[topic] = offset + 1
+        return offset
+
+    def _rotate(self) -> Segment:
+        """Close the active segment, start a new one and apply retention."""
+        self._file.close()
+        segment = Segment(self.directory, self.segments[-1].id + 1)
+        self.segments.append(segment)
+        self._file = open(segment.path, "ab")
+        self._apply_retention()
+        return segment
+
+    def _apply_retention(self) -> None:
+        """Remove the oldest closed segments exceeding the retention."""
+        removed = False
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            total = sum(segment.size for segment in self.segments)
+            too_large = self.retention_bytes is not None and (
+                total > self.retention_bytes
+            )
+            too_old = self.retention_age is not None and (
+                time.time() - oldest.last_timestamp > self.retention_age
+            )
+            if not (too_large or too_old):
+                break
+            os.remove(oldest.path)
+            self.segments.pop(0)
+            removed = True
+            print(f"Removed log segment {oldest.path}")
+
+        if removed:
+            # offsets must stay monotonic even if all messages of a topic are gone
+            offsets_path = os.path.join(self.directory, OFFSETS_FILE)
+            with open(offsets_path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(self.offsets, f)
+            os.replace(offsets_path + ".tmp", offsets_path)
+
+    def replay(self):
+        """
+        Yield (topic, payload, offset) of all stored messages in the
+        order they were appended. Messages appended while iterating are
+        included, the iteration ends once the latest message was read.
+        """
+        segment_id = self.segments[0].id
+        position = 0
+        while True:
+            segment = next((s for s in self.segments if s.id >= segment_id), None)
+            if segment is None:
+                return
+            if segment.id != segment_id:
+                # the segment was removed meanwhile or we are done with it
+                segment_id, position = segment.id, 0
+
+            size = segment.size
+            for topic, payload, offset, _, end in self._records(segment, position):
+                yield topic, payload, offset
+                position = end
+
+            if segment.size > size:
+                # the segment grew while we were reading it
+                continue
+            if segment is self.segments[-1]:
+                return
+            segment_id, position = segment.id + 1, 0
+
+    def close(self) -> None:
+        """Close the active segment."""
+        if self._file:
+            self._file.close()
+            self._file = None
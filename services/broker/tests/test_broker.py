@@ -1,8 +1,19 @@
+import asyncio
 from unittest.mock import AsyncMock, MagicMock
 
 import pytest
 
 from broker import FSOBroker
+from protocol import (
+    FRAME_MESSAGE,
+    FRAME_PUBLISH,
+    FRAME_PUBLISH_BATCH,
+    FRAME_SUBSCRIBE,
+    FRAME_SUBSCRIBE_FROM,
+    OFFSET,
+    encode_frame,
+)
+from storage import MessageLog
 
 
 @pytest.fixture
@@ -38,6 +49,8 @@ async def test_publish_to_subscribed_client(broker, mock_writer):
 
     broker.subscribe(mock_writer, topic)
     await broker.publish(topic, payload)
+    # messages are delivered by the writer task of the client
+    await broker.flush()
 
     # Verify the writer received the message
     mock_writer.write.assert_called_once_with(f"{topic} {payload}\n".encode("utf-8"))
@@ -111,3 +124,411 @@ async def test_handle_client_subscribe_and_publish(broker):
     # Verify message sent back to the writer
     writer.write.assert_any_call(b"test/topic Hello!\n")
     writer.close.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_publish_after_disconnect(broker, mock_writer):
+    """Test that a disconnected client no longer receives messages."""
+    broker.subscribe(mock_writer, "test/~")
+    broker.disconnect(mock_writer)
+
+    await broker.publish("test/topic", "Hello?")
+
+    mock_writer.write.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_slow_subscriber_does_not_block_others(broker, mock_writer):
+    """Test that a stalled client does not delay delivery to other clients."""
+    stalled = asyncio.Event()
+    slow_writer = MagicMock()
+    slow_writer.drain = AsyncMock(side_effect=stalled.wait)
+
+    broker.subscribe(slow_writer, "test/~")
+    broker.subscribe(mock_writer, "test/~")
+    for i in range(3):
+        await broker.publish("test/topic", f"msg{i}")
+    await broker.outbound[mock_writer].flush()
+
+    assert mock_writer.write.call_count == 3
+    stalled.set()
+
+
+@pytest.mark.asyncio
+async def test_overflow_drop_oldest(mock_writer):
+    """Test that the drop_oldest policy keeps the newest messages."""
+    broker = FSOBroker(queue_size=2, overflow="drop_oldest")
+    broker.subscribe(mock_writer, "test/topic")
+
+    # publish without yielding to the writer task
+    for i in range(4):
+        await broker.publish("test/topic", f"msg{i}")
+    stats = broker.outbound[mock_writer].stats()
+    await broker.flush()
+
+    assert stats["dropped"] == 2
+    assert stats["queued"] == 2
+    mock_writer.write.assert_any_call(b"test/topic msg3\n")
+    assert mock_writer.write.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_overflow_disconnect(mock_writer):
+    """Test that the disconnect policy drops a lagging client."""
+    broker = FSOBroker(queue_size=1, overflow="disconnect")
+    broker.subscribe(mock_writer, "test/topic")
+
+    await broker.publish("test/topic", "msg0")
+    await broker.publish("test/topic", "msg1")
+
+    assert mock_writer not in broker.outbound
+    mock_writer.close.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_stats(broker, mock_writer):
+    """Test that stats report the queue depth per client."""
+    mock_writer.get_extra_info.return_value = ("127.0.0.1", 12345)
+    broker.subscribe(mock_writer, "test/topic")
+    await broker.publish("test/topic", "Hello!")
+
+    stats = broker.stats()
+
+    assert stats["127.0.0.1:12345"]["queued"] == 1
+    assert stats["127.0.0.1:12345"]["maxsize"] == broker.queue_size
+
+
+@pytest.mark.asyncio
+async def test_handle_client_framing(broker):
+    """Test pipelined commands and a payload split over several reads."""
+    reader = MagicMock()
+    writer = MagicMock()
+    writer.drain = AsyncMock()
+    writer.get_extra_info.return_value = ("127.0.0.1", 12345)
+
+    payload = "x" * 4000
+    reader.read = AsyncMock(
+        side_effect=[
+            b"SUBSCRIBE test/~\nPUBLISH test/a 1\nPUBLISH test/b 2\n",
+            f"PUBLISH test/c {payload[:1500]}".encode("utf-8"),
+            f"{payload[1500:]}\n".encode("utf-8"),
+            b"",
+        ],
+    )
+
+    await broker.handle_client(reader, writer)
+
+    writer.write.assert_any_call(b"test/a 1\n")
+    writer.write.assert_any_call(b"test/b 2\n")
+    writer.write.assert_any_call(f"test/c {payload}\n".encode("utf-8"))
+    assert writer.write.call_count == 3
+
+
+@pytest.mark.asyncio
+async def test_handle_client_binary_protocol(broker, mock_writer):
+    """Test the binary handshake and forwarding to binary and text clients."""
+    broker.subscribe(mock_writer, "test/~")
+
+    reader = MagicMock()
+    writer = MagicMock()
+    writer.drain = AsyncMock()
+    writer.get_extra_info.return_value = ("127.0.0.1", 12345)
+
+    body = b"\x00raw body\n"
+    reader.read = AsyncMock(
+        side_effect=[
+            # frames may directly follow the handshake
+            b"HELLO 2\n" + encode_frame(FRAME_SUBSCRIBE, "test/~"),
+            encode_frame(FRAME_PUBLISH, "test/topic", body),
+            b"",
+        ],
+    )
+
+    await broker.handle_client(reader, writer)
+    await broker.flush()
+
+    writer.write.assert_any_call(b"OK 2\n")
+    sent = [bytes(call.args[0]) for call in writer.write.call_args_list]
+    assert encode_frame(FRAME_PUBLISH, "test/topic", body) in sent
+    # text clients receive binary bodies base64 encoded
+    mock_writer.write.assert_called_once_with(b"test/topic AHJhdyBib2R5Cg==\n")
+
+
+@pytest.mark.asyncio
+async def test_text_publish_to_binary_client(broker):
+    """Test that text messages are framed for binary clients."""
+    writer = MagicMock()
+    writer.drain = AsyncMock()
+    broker.binary_clients.add(writer)
+    broker.subscribe(writer, "test/topic")
+
+    await broker.publish("test/topic", "Hello!")
+    await broker.flush()
+
+    writer.write.assert_called_once_with(
+        encode_frame(FRAME_PUBLISH, "test/topic", b"Hello!"),
+    )
+
+
+@pytest.mark.asyncio
+async def test_hello_unsupported_version(broker, mock_writer):
+    """Test that unknown protocol versions keep the text protocol."""
+    reader = MagicMock()
+    reader.read = AsyncMock(side_effect=[b"HELLO 9\nSUBSCRIBE test/topic\n", b""])
+
+    await broker.handle_client(reader, mock_writer)
+
+    mock_writer.write.assert_called_once_with(b"OK 1\n")
+    assert "test/topic" in broker.subscriptions
+
+
+@pytest.fixture
+def persistent_broker(tmp_path):
+    """Fixture to provide a broker with a message log."""
+    log = MessageLog(str(tmp_path))
+    yield FSOBroker(log=log)
+    log.close()
+
+
+@pytest.mark.asyncio
+async def test_subscribe_from_earliest(persistent_broker, mock_writer):
+    """Test that stored messages are replayed before new ones."""
+    await persistent_broker.publish("test/a", "1")
+    await persistent_broker.publish("other", "x")
+    await persistent_broker.publish("test/b", "2")
+
+    reader = asyncio.StreamReader()
+    reader.feed_data(b"SUBSCRIBE_FROM earliest test/~\n")
+    task = asyncio.create_task(persistent_broker.handle_client(reader, mock_writer))
+    # the replay finishes while the client is connected
+    await asyncio.sleep(0.01)
+    await persistent_broker.publish("test/c", "3")
+    reader.feed_eof()
+    await task
+
+    assert [call.args[0] for call in mock_writer.write.call_args_list] == [
+        b"test/a 1\n",
+        b"test/b 2\n",
+        b"test/c 3\n",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_subscribe_from_offset_binary(persistent_broker, mock_writer):
+    """Test that binary clients receive offsets starting at the given one."""
+    for i in range(3):
+        await persistent_broker.publish("test/a", f"{i}")
+
+    persistent_broker.binary_clients.add(mock_writer)
+    await persistent_broker.handle_frames(
+        mock_writer,
+        [(FRAME_SUBSCRIBE_FROM, "test/a", memoryview(b"1"), None)],
+    )
+    await asyncio.gather(*persistent_broker.replays[mock_writer])
+    await persistent_broker.publish("test/a", "3")
+    await persistent_broker.flush()
+
+    assert [call.args[0] for call in mock_writer.write.call_args_list] == [
+        encode_frame(FRAME_MESSAGE, "test/a", OFFSET.pack(i) + f"{i}".encode())
+        for i in range(1, 4)
+    ]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("overflow", ["drop_oldest", "disconnect"])
+async def test_replay_larger_than_queue(tmp_path, mock_writer, overflow):
+    """Test that a replay waits for the client instead of losing messages."""
+    log = MessageLog(str(tmp_path))
+    broker = FSOBroker(queue_size=2, overflow=overflow, log=log)
+    for i in range(10):
+        await broker.publish("test/a", f"{i}")
+
+    broker.subscribe_from(mock_writer, "test/a", "earliest")
+    await asyncio.gather(*broker.replays[mock_writer])
+    await broker.flush()
+    log.close()
+
+    assert mock_writer in broker.outbound
+    assert [call.args[0] for call in mock_writer.write.call_args_list] == [
+        f"test/a {i}\n".encode() for i in range(10)
+    ]
+
+
+@pytest.mark.asyncio
+async def test_subscribe_from_without_log(broker, mock_writer):
+    """Test that replays fall back to a normal subscription."""
+    broker.subscribe_from(mock_writer, "test/topic", "earliest")
+
+    assert mock_writer in broker.subscriptions["test/topic"]
+
+
+def make_writer():
+    """Create a mock writer outside of the fixture."""
+    writer = MagicMock()
+    writer.drain = AsyncMock()
+    return writer
+
+
+@pytest.mark.asyncio
+async def test_subscribe_group_shares_messages(broker):
+    """Test that each message goes to exactly one group member per topic."""
+    members = [make_writer() for _ in range(3)]
+    for member in members:
+        broker.subscribe_group(member, "recorders", "test/~")
+
+    for i in range(60):
+        await broker.publish(f"test/{i % 20}", f"{i}")
+    await broker.flush()
+
+    received = {}
+    for member in members:
+        for call in member.write.call_args_list:
+            topic = call.args[0].split(b" ")[0]
+            received.setdefault(topic, set()).add(member)
+    # all messages of a topic went to the same member
+    assert len(received) == 20
+    assert all(len(owners) == 1 for owners in received.values())
+    assert sum(member.write.call_count for member in members) == 60
+    assert all(member.write.call_count > 0 for member in members)
+
+
+@pytest.mark.asyncio
+async def test_subscribe_group_rebalance_on_disconnect(broker, mock_writer):
+    """Test that the remaining members take over after a disconnect."""
+    leaving = make_writer()
+    broker.subscribe_group(leaving, "recorders", "test/~")
+    broker.subscribe_group(mock_writer, "recorders", "test/~")
+
+    broker.disconnect(leaving)
+    for i in range(10):
+        await broker.publish(f"test/{i}", "x")
+    await broker.flush()
+
+    assert mock_writer.write.call_count == 10
+
+    broker.disconnect(mock_writer)
+    assert broker.groups == {}
+    assert broker.index.match("test/1") == []
+
+
+@pytest.mark.asyncio
+async def test_subscribe_group_command(broker, mock_writer):
+    """Test the SUBSCRIBE_GROUP text command next to a plain subscription."""
+    reader = MagicMock()
+    reader.read = AsyncMock(
+        side_effect=[b"SUBSCRIBE_GROUP recorders test/~\nPUBLISH test/a 1\n", b""],
+    )
+    plain = make_writer()
+    broker.subscribe(plain, "test/~")
+
+    await broker.handle_client(reader, mock_writer)
+
+    mock_writer.write.assert_called_once_with(b"test/a 1\n")
+    plain.write.assert_called_once_with(b"test/a 1\n")
+
+
+@pytest.mark.asyncio
+async def test_subscribe_group_rejected_with_workers(broker, mock_writer):
+    """Test that groups are refused once other workers are connected."""
+    broker.peers.append(make_writer())
+    reader = MagicMock()
+    reader.read = AsyncMock(side_effect=[b"SUBSCRIBE_GROUP recorders test/~\n"])
+
+    await broker.handle_client(reader, mock_writer)
+
+    assert broker.groups == {}
+    assert mock_writer not in broker.clients
+    # the connection is closed without reading further
+    assert reader.read.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_publish_batch_text(broker, mock_writer):
+    """Test that a text batch is written to each subscriber at once."""
+    other = make_writer()
+    broker.subscribe(mock_writer, "test/~")
+    broker.subscribe(other, "test/b")
+
+    reader = MagicMock()
+    reader.read = AsyncMock(
+        side_effect=[
+            b"PUBLISH_BATCH 3\nPUBLISH test/a 1\nPUBLISH test/b 2\n",
+            b"PUBLISH test/a 3\nPUBLISH test/a 4\n",
+            b"",
+        ],
+    )
+    await broker.handle_client(reader, make_writer())
+    await broker.flush()
+
+    mock_writer.writelines.assert_called_once_with(
+        [b"test/a 1\n", b"test/b 2\n", b"test/a 3\n"],
+    )
+    other.writelines.assert_called_once_with([b"test/b 2\n"])
+    # the command after the batch is a normal publish
+    mock_writer.write.assert_called_once_with(b"test/a 4\n")
+    mock_writer.drain.assert_awaited()
+
+
+@pytest.mark.asyncio
+async def test_publish_batch_binary(broker, mock_writer):
+    """Test that binary batches forward their frames to subscribers."""
+    binary_writer = make_writer()
+    broker.binary_clients.add(binary_writer)
+    broker.subscribe(binary_writer, "test/~")
+    broker.subscribe(mock_writer, "test/~")
+
+    frames = [encode_frame(FRAME_PUBLISH, f"test/{i}", b"%d" % i) for i in range(3)]
+    batch = memoryview(b"".join(frames))
+    await broker.handle_frames(
+        make_writer(),
+        [(FRAME_PUBLISH_BATCH, "", batch, None)],
+    )
+    await broker.flush()
+
+    binary_writer.writelines.assert_called_once()
+    assert [bytes(part) for part in binary_writer.writelines.call_args.args[0]] == (
+        frames
+    )
+    mock_writer.writelines.assert_called_once_with(
+        [b"test/0 MA==\n", b"test/1 MQ==\n", b"test/2 Mg==\n"],
+    )
+
+
+@pytest.mark.asyncio
+async def test_publish_batch_only_publishes(broker, mock_writer):
+    """Test that a batch carrying other frames closes the connection."""
+    batch = encode_frame(FRAME_PUBLISH, "test/a", b"1") + encode_frame(
+        FRAME_SUBSCRIBE,
+        "test/~",
+    )
+    reader = MagicMock()
+    reader.read = AsyncMock(
+        side_effect=[
+            b"HELLO 2\n" + encode_frame(FRAME_PUBLISH_BATCH, "", batch),
+            b"",
+        ],
+    )
+
+    await broker.handle_client(reader, mock_writer)
+
+    assert broker.index.match("test/a") == []
+    assert mock_writer not in broker.clients
+    assert reader.read.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_publish_batch_text_only_publishes(broker, mock_writer):
+    """Test that a text batch carrying other commands closes the connection."""
+    reader = MagicMock()
+    reader.read = AsyncMock(
+        side_effect=[
+            b"PUBLISH_BATCH 2\nPUBLISH test/a 1\nSUBSCRIBE_FROM 0 test/~\n",
+            b"",
+        ],
+    )
+
+    await broker.handle_client(reader, mock_writer)
+
+    assert broker.index.match("test/a") == []
+    assert mock_writer not in broker.clients
+    assert reader.read.call_count == 1
@@ -0,0 +1,66 @@
+import asyncio
+import os
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from broker import FSOBroker
+from cluster import connect_peers
+
+
+@pytest.fixture
+def mock_writer():
+    """Fixture to create a mock writer."""
+    writer = MagicMock()
+    writer.drain = AsyncMock()
+    return writer
+
+
+def written(writer) -> list[bytes]:
+    """Return everything written to a mock writer, single or batched."""
+    data = []
+    for call in writer.method_calls:
+        if call[0] == "write":
+            data.append(bytes(call.args[0]))
+        elif call[0] == "writelines":
+            data.extend(bytes(part) for part in call.args[0])
+    return data
+
+
+@pytest.mark.asyncio
+async def test_messages_are_routed_between_workers(tmp_path, mock_writer):
+    """Test that subscribers of one worker receive messages of another."""
+    first, second = FSOBroker(), FSOBroker()
+    paths = [os.path.join(tmp_path, f"worker-{i}.sock") for i in range(2)]
+    servers = [
+        await asyncio.start_unix_server(broker.handle_peer, path=path)
+        for broker, path in zip((first, second), paths)
+    ]
+    await connect_peers(first, [paths[1]])
+    await connect_peers(second, [paths[0]])
+
+    binary_writer = MagicMock()
+    binary_writer.drain = AsyncMock()
+    second.binary_clients.add(binary_writer)
+    second.subscribe(mock_writer, "test/~")
+    second.subscribe(binary_writer, "test/~")
+
+    await first.publish("test/a", "text payload")
+    await first.publish("test/b", memoryview(b"\x00raw"))
+    await first.flush()
+    # give the receiving worker time to process the forwarded frames
+    await asyncio.sleep(0.05)
+    await second.flush()
+
+    # text stays text and bytes stay bytes when crossing workers
+    assert written(mock_writer) == [
+        b"test/a text payload\n",
+        b"test/b AHJhdw==\n",
+    ]
+    assert len(written(binary_writer)) == 2
+    # forwarded messages are not sent back to the original worker
+    assert first.outbound[first.peers[0]].stats()["sent"] == 2
+    assert second.outbound[second.peers[0]].stats()["sent"] == 0
+
+    for server in servers:
+        server.close()
@@ -0,0 +1,118 @@
+import pytest
+
+from protocol import (
+    FRAME_PUBLISH,
+    FRAME_SUBSCRIBE,
+    FrameParser,
+    LineParser,
+    ProtocolError,
+    decode_batch,
+    encode_frame,
+)
+
+
+def test_feed_pipelined_commands():
+    """Test that all commands of a single read are returned."""
+    parser = LineParser()
+    lines = parser.feed(b"SUBSCRIBE a\nPUBLISH a 1\nPUBLISH a 2\n")
+
+    assert lines == [b"SUBSCRIBE a", b"PUBLISH a 1", b"PUBLISH a 2"]
+
+
+def test_feed_split_command():
+    """Test that a command split over several reads is reassembled."""
+    parser = LineParser()
+    payload = b"x" * 5000
+
+    assert parser.feed(b"PUBLISH a " + payload[:1000]) == []
+    assert parser.feed(payload[1000:]) == []
+    assert parser.feed(b"\nPUBLISH b 2") == [b"PUBLISH a " + payload]
+    assert parser.flush() == b"PUBLISH b 2"
+    assert parser.flush() == b""
+
+
+def test_feed_byte_by_byte():
+    """Test that lines are found when every read holds a single byte."""
+    parser = LineParser()
+    lines = []
+    for byte in b"PUBLISH a 1\nPUBLISH b 22\n":
+        lines += parser.feed(bytes([byte]))
+
+    assert lines == [b"PUBLISH a 1", b"PUBLISH b 22"]
+
+
+def test_feed_message_too_large():
+    """Test that messages above the limit are rejected."""
+    parser = LineParser(max_message_size=10)
+    assert parser.feed(b"0123456789\n") == [b"0123456789"]
+
+    with pytest.raises(ProtocolError):
+        parser.feed(b"0123456789a")
+
+
+def test_feed_message_too_large_in_batch():
+    """Test that the limit also applies to complete lines."""
+    parser = LineParser(max_message_size=10)
+
+    with pytest.raises(ProtocolError):
+        parser.feed(b"short\n0123456789abc\n")
+
+
+def test_frame_roundtrip():
+    """Test that encoded frames are parsed back as they were."""
+    parser = FrameParser()
+    data = encode_frame(FRAME_SUBSCRIBE, "a/~") + encode_frame(
+        FRAME_PUBLISH,
+        "a/b",
+        b"\x00\n binary",
+    )
+
+    frames = parser.feed(data)
+
+    assert [(t, topic, bytes(body)) for t, topic, body, _ in frames] == [
+        (FRAME_SUBSCRIBE, "a/~", b""),
+        (FRAME_PUBLISH, "a/b", b"\x00\n binary"),
+    ]
+    # the whole frame can be forwarded as it is
+    assert bytes(frames[1][3]) == encode_frame(FRAME_PUBLISH, "a/b", b"\x00\n binary")
+
+
+def test_frame_split_over_reads():
+    """Test that frames split over several reads are reassembled."""
+    parser = FrameParser()
+    body = bytes(range(256)) * 100
+    data = encode_frame(FRAME_PUBLISH, "a", body) + encode_frame(FRAME_PUBLISH, "b")
+
+    frames = []
+    for i in range(0, len(data), 1000):
+        frames += parser.feed(data[i : i + 1000])
+
+    assert [(topic, bytes(body)) for _, topic, body, _ in frames] == [
+        ("a", body),
+        ("b", b""),
+    ]
+
+
+def test_frame_too_large():
+    """Test that frames above the limit are rejected from their header."""
+    parser = FrameParser(max_message_size=10)
+
+    with pytest.raises(ProtocolError):
+        parser.feed(encode_frame(FRAME_PUBLISH, "a", b"x" * 10)[:8])
+
+
+def test_decode_batch():
+    """Test that batch bodies are split into frames and validated."""
+    body = encode_frame(FRAME_PUBLISH, "a", b"1") + encode_frame(FRAME_PUBLISH, "b")
+
+    frames = decode_batch(memoryview(body))
+
+    assert [(topic, bytes(payload)) for _, topic, payload, _ in frames] == [
+        ("a", b"1"),
+        ("b", b""),
+    ]
+    with pytest.raises(ProtocolError):
+        decode_batch(memoryview(body[:-1]))
+    # only publishes can be batched
+    with pytest.raises(ProtocolError):
+        decode_batch(memoryview(body + encode_frame(FRAME_SUBSCRIBE, "c")))
@@ -0,0 +1,90 @@
+import pytest
+
+from topics import SubscriptionGroup, TopicIndex
+
+
+@pytest.fixture
+def index():
+    """Fixture to provide an empty TopicIndex."""
+    return TopicIndex()
+
+
+def test_match_exact(index):
+    """Test that exact subscriptions only match the same topic."""
+    index.add("test/topic", "a")
+
+    assert index.match("test/topic") == ["a"]
+    assert index.match("test/topic/sub") == []
+    assert index.match("test") == []
+
+
+def test_match_wildcard(index):
+    """Test that wildcard subscriptions match every topic with the prefix."""
+    index.add("test/~", "a")
+    index.add("~", "b")
+
+    assert sorted(index.match("test/topic")) == ["a", "b"]
+    assert index.match("other/topic") == ["b"]
+
+
+def test_match_wildcard_is_string_prefix(index):
+    """Test that the wildcard matches on the raw string like topic_matches."""
+    index.add("/tmp/enlyze~", "a")
+
+    assert index.match("/tmp/enlyze/foo.txt") == ["a"]
+    assert index.match("/tmp/enlyze_other") == ["a"]
+    assert index.match("/tmp/enly") == []
+
+
+def test_remove(index):
+    """Test that removing a subscriber prunes it from the index."""
+    index.add("test/~", "a")
+    index.add("test/~", "b")
+    index.add("test/topic", "a")
+
+    index.remove("test/~", "a")
+    index.remove("test/topic", "a")
+
+    assert index.match("test/topic") == ["b"]
+    index.remove("test/~", "b")
+    assert index.match("test/topic") == []
+    # every trie branch should be gone after the last removal
+    assert index._root.children == {}
+
+
+def test_remove_unknown(index):
+    """Test that removing an unknown subscription is a no-op."""
+    index.add("test/~", "a")
+    index.remove("other/~", "a")
+    index.remove("test/topic", "a")
+
+    assert index.match("test/x") == ["a"]
+
+
+def test_group_pick_is_stable():
+    """Test that a topic always goes to the same group member."""
+    group = SubscriptionGroup("recorders", "/tmp/~")
+    for member in "abc":
+        group.add(member)
+
+    picks = {f"/tmp/{i}": group.pick(f"/tmp/{i}") for i in range(300)}
+
+    assert all(group.pick(topic) == member for topic, member in picks.items())
+    # every member gets a share of the topics
+    assert set(picks.values()) == {"a", "b", "c"}
+
+
+def test_group_rebalance_moves_only_removed_member():
+    """Test that removing a member only moves the topics it owned."""
+    group = SubscriptionGroup("recorders", "/tmp/~")
+    for member in "abc":
+        group.add(member)
+    picks = {f"/tmp/{i}": group.pick(f"/tmp/{i}") for i in range(300)}
+
+    group.remove("b")
+
+    for topic, member in picks.items():
+        if member == "b":
+            assert group.pick(topic) in ("a", "c")
+        else:
+            assert group.pick(topic) == member
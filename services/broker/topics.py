@@ -0,0 +1,122 @@
+"""Subscription index for fast topic matching"""
+
+
+class _TrieNode:
+    __slots__ = ("children", "subscribers")
+
+    def __init__(self):
+        self.children = {}
+        # subscribers of the wildcard topic ending at this node
+        self.subscribers = []
+
+
+class TopicIndex:
+    """
+    Index mapping subscription topics to subscribers.
+
+    Exact subscriptions live in a dict, wildcard subscriptions in a
+    character trie keyed by the part of the topic in front of the
+    tilde ('~'). Matching a topic walks the trie once along the topic
+    and collects every wildcard node passed on the way, so the cost
+    depends on the topic length and not on the number of subscriptions.
+    """
+
+    def __init__(self):
+        self._exact = {}
+        self._root = _TrieNode()
+
+    @staticmethod
+    def _prefix(sub_topic: str) -> str | None:
+        """Return the wildcard prefix of a topic or None for exact topics."""
+        if "~" in sub_topic:
+            return sub_topic.split("~", 1)[0]
+        return None
+
+    def add(self, sub_topic: str, subscriber) -> None:
+        """Register a subscriber for a (wildcard) topic."""
+        prefix = self._prefix(sub_topic)
+        if prefix is None:
+            self._exact.setdefault(sub_topic, []).append(subscriber)
+            return
+
+        node = self._root
+        for char in prefix:
+            node = node.children.setdefault(char, _TrieNode())
+        node.subscribers.append(subscriber)
+
+    def remove(self, sub_topic: str, subscriber) -> None:
+        """
+        Remove all registrations of a subscriber for a topic.
+        Empty trie branches are pruned afterwards.
+        """
+        prefix = self._prefix(sub_topic)
+        if prefix is None:
+            subscribers = self._exact.get(sub_topic, [])
+            subscribers[:] = [s for s in subscribers if s is not subscriber]
+            if not subscribers:
+                self._exact.pop(sub_topic, None)
+            return
+
+        path = [self._root]
+        for char in prefix:
+            node = path[-1].children.get(char)
+            if node is None:
+                return
+            path.append(node)
+
+        node = path[-1]
+        node.subscribers[:] = [s for s in node.subscribers if s is not subscriber]
+        # prune the branch bottom-up as long as nodes are unused
+        for depth in range(len(prefix), 0, -1):
+            node = path[depth]
+            if node.children or node.subscribers:
+                break
+            del path[depth - 1].children[prefix[depth - 1]]
+
+    def match(self, topic: str) -> list:
+        """Return every subscriber whose subscription matches the topic."""
+        node = self._root
+        matches = list(node.subscribers)
+        for char in topic:
+            node = node.children.get(char)
+            if node is None:
+                break
+            if node.subscribers:
+                matches.extend(node.subscribers)
+        matches.extend(self._exact.get(topic, ()))
+        return matches
+
+
+class SubscriptionGroup:
+    """
+    Members sharing a subscription, every message goes to one of them.
+
+    The member is chosen by rendezvous hashing over the topic: all
+    messages of a topic go to the same member as long as it is part of
+    the group, which keeps their order. If members join or leave, only
+    the topics of the affected member move to another one.
+    """
+
+    def __init__(self, name: str, sub_topic: str):
+        self.name = name
+        self.sub_topic = sub_topic
+        # member -> prefix of the member mixed into the hash
+        self.members = {}
+        self._next_key = 0
+
+    def add(self, member) -> None:
+        """Add a member to the group."""
+        if member not in self.members:
+            self.members[member] = f"{self._next_key}:"
+            self._next_key += 1
+
+    def remove(self, member) -> None:
+        """Remove a member from the group."""
+        self.members.pop(member, None)
+
+    def pick(self, topic: str):
+        """
+        Return the member responsible for a topic. The hash only has to
+        be stable within the broker process owning the group.
+        """
+        return max(self.members, key=lambda member: hash(self.members[member] + topic))
@@ -1,8 +1,26 @@
 import asyncio
-import pathlib
+import base64
+import hashlib
+import json
+import os
+import random
+import signal
+import socket
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from cache import FSOFileDiff
-from models import FileObserverEvent, FileObserverRule
+from coalescer import CoalescedEvent, EventCoalescer
+from compression import DiffCompressor, load_dictionaries
+from indexer import CacheIndexer
+from inotify import InotifyObserver
+from metrics import Metrics, SamplingProfiler
+from models import CODECS, FileObserverEvent, FileObserverRule
+from reconcile import Reconciler, TreeManifest, entry_hash
+from rules import CompiledRule
+from spool import Spool
+from store import CacheStore
 from watchdog.events import (
     DirCreatedEvent,
     DirDeletedEvent,
@@ -16,52 +34,326 @@ from watchdog.events import (
 )
 from watchdog.observers import Observer
 
+# binary broker protocol: type, topic length, body length, topic, body
+PROTOCOL_BINARY = 2
+FRAME_HEADER = struct.Struct("!BHI")
+FRAME_SUBSCRIBE = 1
+FRAME_PUBLISH = 2
+FRAME_DISCONNECT = 3
+FRAME_PUBLISH_BATCH = 9
+# seconds to wait for the broker to answer the protocol negotiation
+HANDSHAKE_TIMEOUT = 2.0
+# reserved topic the agent publishes its metrics on
+STATS_TOPIC = f"$SYS/agents/{socket.gethostname()}/stats"
+
+
+def encode_frame(frame_type: int, topic: str = "", body: bytes = b"") -> bytes:
+    """Encode a frame of the binary broker protocol."""
+    topic = topic.encode("utf-8")
+    return FRAME_HEADER.pack(frame_type, len(topic), len(body)) + topic + body
+
 
 class FSOMessageClient:
-    def __init__(self, host="127.0.0.1", port=1883):
+    """
+    Publishing client of the broker.
+
+    If the connection is lost, the client reconnects with exponential
+    backoff. Meanwhile messages are appended to the spool, if one is
+    configured, and sent in order at full speed once the connection is
+    back; without a spool they are dropped and counted. Messages written
+    right before the broker went away can be sent twice.
+    """
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=1883,
+        binary=False,
+        batch_size=256,
+        batch_bytes=1024 * 1024,
+        batch_delay=0.005,
+        spool_dir=None,
+        spool_bytes=256 * 1024 * 1024,
+        reconnect_delay=0.5,
+        max_reconnect_delay=30.0,
+    ):
         self.host = host
         self.port = port
+        # request the binary protocol, only active if the broker accepts it
+        self.binary = binary
+        self._binary_requested = binary
+        # a batch is sent once it holds batch_size messages or batch_bytes
+        # bytes, or batch_delay seconds after its first message
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.batch_delay = batch_delay
+        self.spool = Spool(spool_dir, max_bytes=spool_bytes) if spool_dir else None
+        # doubled after every failed attempt up to max_reconnect_delay
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
         self.reader = None
         self.writer = None
+        self.connected = False
+        self._closing = False
+        self._batch = []
+        self._batch_size_bytes = 0
+        self._inflight = None
+        self._flush_handle = None
+        self._flush_task = None
+        self._monitor_task = None
+        self._reconnect_task = None
+        # statistics
+        self.reconnects = 0
+        self.dropped = 0
+        self.published = 0
 
     async def connect(self):
-        """Connect to the broker."""
-        # TODO: add retry logic
-        self.reader, self.writer = await asyncio.open_connection(
-            self.host,
-            self.port,
-        )
+        """
+        Connect to the broker and send the spooled messages, retrying the
+        whole handshake with exponential backoff.
+        """
+        delay = self.reconnect_delay
+        while True:
+            try:
+                await self._handshake()
+                break
+            except OSError as e:
+                if self.writer is not None:
+                    self.writer.close()
+                # jitter keeps many agents from reconnecting all at once
+                wait = delay * random.uniform(0.5, 1.0)
+                print(f"Failed to connect to FOSBroker: {e}, retry in {wait:.1f}s")
+                await asyncio.sleep(wait)
+                delay = min(delay * 2, self.max_reconnect_delay)
+        # the spool is empty, new messages are sent right away
+        self.connected = True
+        self._monitor_task = asyncio.get_running_loop().create_task(self._monitor())
+
+    async def _handshake(self) -> None:
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
         print(f"Connected to FOSBroker at {self.host}:{self.port}")
+        self.binary = self._binary_requested
+        if self.binary:
+            await self._negotiate()
+        await self._drain_spool()
+
+    def start(self) -> None:
+        """
+        Connect in the background, messages published until the broker
+        is reachable are spooled.
+        """
+        self._reconnect_task = asyncio.get_running_loop().create_task(self.connect())
+
+    async def _monitor(self) -> None:
+        """Reconnect once the broker closed the connection."""
+        try:
+            await self.listen()
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        self._connection_lost()
+
+    def _connection_lost(self) -> None:
+        if not self.connected:
+            return
+        self.connected = False
+        self.writer.close()
+        # keep the order: unsent batches go in front of newer messages
+        if self._inflight:
+            self._spool(self._inflight)
+            self._inflight = None
+        if self._batch:
+            self._spool(self._batch)
+            self._batch = []
+            self._batch_size_bytes = 0
+        if self._closing:
+            return
+        print("Lost the connection to FOSBroker, reconnecting.")
+        self._reconnect_task = asyncio.get_running_loop().create_task(
+            self._reconnect(),
+        )
+
+    async def _reconnect(self) -> None:
+        await self.connect()
+        self.reconnects += 1
+
+    def _spool(self, batch: list) -> None:
+        if self.spool is None:
+            self.dropped += len(batch)
+            return
+        for topic, message, _ in batch:
+            self.spool.append(topic, message)
+
+    async def _drain_spool(self) -> None:
+        """
+        Send the spooled messages in order, a batch at a time. Messages
+        published meanwhile are spooled behind them.
+        """
+        sent = 0
+        while self.spool is not None and self.spool.pending:
+            messages, position = self.spool.read(self.batch_bytes)
+            if not messages:
+                break
+            self._write([self._encode(topic, message) for topic, message in messages])
+            # still spooled if the connection is lost, sent after the next one
+            await self.writer.drain()
+            self.spool.consume(position, len(messages))
+            sent += len(messages)
+            self.published += len(messages)
+        if sent:
+            print(f"Published {sent} spooled message(s)")
+
+    def backlog(self) -> dict:
+        """Return the connection state and the messages waiting to be sent."""
+        return {
+            "connected": self.connected,
+            "reconnects": self.reconnects,
+            "dropped": self.dropped,
+            "published": self.published,
+            "batch": len(self._batch),
+            "spool": self.spool.backlog() if self.spool is not None else None,
+        }
+
+    async def _negotiate(self) -> None:
+        """Ask the broker to switch to the binary protocol."""
+        self.writer.write(f"HELLO {PROTOCOL_BINARY}\n".encode("utf-8"))
+        await self.writer.drain()
+        try:
+            answer = await asyncio.wait_for(
+                self.reader.readline(),
+                HANDSHAKE_TIMEOUT,
+            )
+        except asyncio.TimeoutError:
+            # brokers without protocol negotiation ignore the HELLO
+            answer = b""
+        self.binary = answer.strip() == f"OK {PROTOCOL_BINARY}".encode("utf-8")
+        if not self.binary:
+            print("Broker does not support the binary protocol, using text.")
 
     async def disconnect(self) -> None:
         """Disconnect from the broker."""
-        if self.writer:
-            self.writer.write("DISCONNECT\n".encode("utf-8"))
+        self._closing = True
+        for task in (self._monitor_task, self._reconnect_task):
+            if task is not None:
+                task.cancel()
+        if self.connected:
+            await self.flush()
+        if self.connected:
+            self.connected = False
+            if self.binary:
+                self.writer.write(encode_frame(FRAME_DISCONNECT))
+            else:
+                self.writer.write("DISCONNECT\n".encode("utf-8"))
             await self.writer.drain()
             self.writer.close()
             await self.writer.wait_closed()
             print("Disconnected from FOSBroker")
+        else:
+            # kept for the next start
+            self._spool(self._batch)
+            self._batch = []
+        if self.spool is not None:
+            self.spool.close()
 
     async def subscribe(self, topic: str) -> None:
         """Subscribe to a topic."""
         if self.writer:
-            command = f"SUBSCRIBE {topic}\n"
-            self.writer.write(command.encode("utf-8"))
+            if self.binary:
+                self.writer.write(encode_frame(FRAME_SUBSCRIBE, topic))
+            else:
+                command = f"SUBSCRIBE {topic}\n"
+                self.writer.write(command.encode("utf-8"))
             await self.writer.drain()
             print(f"Subscribed to topic: {topic}")
 
-    async def publish(self, topic: str, message: str) -> None:
-        """Publish a message to a topic."""
-        if self.writer:
-            command = f"PUBLISH {topic} {message}\n"
-            self.writer.write(command.encode("utf-8"))
+    async def publish(self, topic: str, message: str | bytes) -> None:
+        """
+        Publish a message to a topic. Binary clients send the message
+        as raw bytes, text clients as a single token on the command line.
+        Messages are collected and sent as a batch, see flush().
+        """
+        if not self.connected or (self.spool is not None and self.spool.pending):
+            # behind the spooled messages until they were sent
+            self._spool([(topic, message, None)])
+            return
+
+        data = self._encode(topic, message)
+        self._batch.append((topic, message, data))
+        self._batch_size_bytes += len(data)
+
+        if (
+            len(self._batch) >= self.batch_size
+            or self._batch_size_bytes >= self.batch_bytes
+        ):
+            await self.flush()
+        elif self._flush_handle is None:
+            # send the batch in time even if no more messages arrive
+            self._flush_handle = asyncio.get_running_loop().call_later(
+                self.batch_delay,
+                self._schedule_flush,
+            )
+
+    def _encode(self, topic: str, message: str | bytes) -> bytes:
+        if self.binary:
+            if isinstance(message, str):
+                message = message.encode("utf-8")
+            return encode_frame(FRAME_PUBLISH, topic, message)
+        if isinstance(message, bytes):
+            # spooled by a binary connection, the text protocol takes a token
+            message = base64.b64encode(message).decode("ascii")
+        return f"PUBLISH {topic} {message}\n".encode("utf-8")
+
+    def _schedule_flush(self) -> None:
+        self._flush_handle = None
+        self._flush_task = asyncio.get_running_loop().create_task(self.flush())
+
+    async def flush(self) -> None:
+        """
+        Send all collected messages. A single message is sent as PUBLISH,
+        several ones as one PUBLISH_BATCH with a single drain.
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._batch or not self.connected:
+            return
+
+        batch = self._batch
+        self._batch = []
+        self._batch_size_bytes = 0
+        self._inflight = batch
+        try:
+            self._write([data for _, _, data in batch])
             await self.writer.drain()
-            print(f"Published to {topic}")
+        except OSError:
+            self._connection_lost()
+            return
+        finally:
+            if self._inflight is batch:
+                self._inflight = None
+        self.published += len(batch)
+
+    def _write(self, batch: list[bytes]) -> None:
+        if len(batch) == 1:
+            self.writer.write(batch[0])
+        elif self.binary:
+            self.writer.write(encode_frame(FRAME_PUBLISH_BATCH, "", b"".join(batch)))
+        else:
+            self.writer.write(f"PUBLISH_BATCH {len(batch)}\n".encode("utf-8"))
+            self.writer.writelines(batch)
 
     async def listen(self) -> None:
         """Listen for incoming messages from the broker."""
         if self.reader:
             while True:
+                if self.binary:
+                    try:
+                        header = await self.reader.readexactly(FRAME_HEADER.size)
+                    except asyncio.IncompleteReadError:
+                        break
+                    _, topic_size, body_size = FRAME_HEADER.unpack(header)
+                    data = await self.reader.readexactly(topic_size + body_size)
+                    print(f"Received: {data[:topic_size].decode('utf-8')}")
+                    continue
                 data = await self.reader.readline()
                 if not data:
                     break
@@ -69,140 +361,672 @@ class FSOMessageClient:
                 # TODO: Handle filter rule updates....
 
 
+class DirectoryBarrier:
+    """
+    A move or a directory delete queued on every diff worker. The last
+    worker to reach it processes the event while the others wait, so it
+    runs after all earlier events and before all later ones of any file.
+    """
+
+    def __init__(self, event: CoalescedEvent, workers: int):
+        self.event = event
+        self.waiting = workers
+        self.done = asyncio.Event()
+
+    def arrive(self) -> bool:
+        """Return True for the last worker, which processes the event."""
+        self.waiting -= 1
+        return self.waiting == 0
+
+
 class FileHandler(FileSystemEventHandler):
+    """
+    Turns file system events into messages in a staged pipeline.
+
+    The watchdog callbacks run on the observer thread and only hand the
+    raw event over to the event loop. There, the events pass these
+    stages, connected by bounded queues:
 
-    def __init__(self, client: FSOMessageClient, rule: FileObserverRule) -> None:
+    - filter: drop excluded paths and collect the rest in an EventCoalescer,
+      directory moves and deletes are passed on to the diff stage directly
+    - coalesce: take the net effect of each burst once it became quiet
+    - diff: update the cache and build the messages in a thread pool,
+      every path is always handled by the same worker to keep its order,
+      moves, which change two paths, wait for all workers
+    - serialize: encode the messages for the broker
+    - publish: hand the payloads to the message client
+
+    A full queue blocks the stage in front of it, up to the observer
+    thread once the raw queue is full.
+    """
+
+    def __init__(
+        self,
+        client: FSOMessageClient,
+        rule: FileObserverRule,
+        quiet_window: float = 0.5,
+        max_delay: float = 5.0,
+        diff_workers: int = 4,
+        queue_size: int = 1024,
+        cache_bytes: int = 128 * 1024 * 1024,
+        cache_dir: str | None = None,
+        manifest_path: str | None = None,
+        codec: str = "json",
+        compressor: DiffCompressor | None = None,
+        metrics: Metrics | None = None,
+        stats_interval: float | None = None,
+    ) -> None:
         super().__init__()
         self.client = client
-        self.cache = FSOFileDiff()
+        # encoding of the messages, see models.CODECS
+        self.codec = CODECS[codec]
+        # compresses larger diffs if given
+        self.compressor = compressor
+        # stage latencies and counters, published every stats_interval
+        # seconds on STATS_TOPIC if given
+        self.metrics = metrics if metrics is not None else Metrics(enabled=False)
+        self.stats_interval = stats_interval
+        # keep the cache on disk for a fast restart
+        store = CacheStore(cache_dir) if cache_dir else None
+        self.cache = FSOFileDiff(max_bytes=cache_bytes, store=store)
+        # state of the tree for the reconciliation after a restart
+        self.manifest = TreeManifest(manifest_path) if manifest_path else None
         self.rule = rule
+        self.rules = CompiledRule(rule)
+        self.coalescer = EventCoalescer(quiet_window, max_delay)
         self.__loop = asyncio.get_event_loop()
-
-    def __emit(self, topic: str, msg: FileObserverEvent) -> None:
-        pub_co = self.client.publish(topic, msg.to_base64())
-        self.__loop.create_task(pub_co)
+        # free slots of the raw queue, taken by the observer thread
+        self._queue_size = queue_size
+        self._raw_slots = threading.BoundedSemaphore(queue_size)
+        self._raw = asyncio.Queue()
+        self._diff = [asyncio.Queue(queue_size) for _ in range(diff_workers)]
+        self._serialize = asyncio.Queue(queue_size)
+        self._publish = asyncio.Queue(queue_size)
+        self._pool = ThreadPoolExecutor(diff_workers, thread_name_prefix="fso-diff")
+        # SHA-256 of the binary versions sent whole or as a delta since the
+        # start, deltas against others could not be applied by the recorder
+        self._sent_versions = set()
 
     def _is_excluded(self, path: str) -> bool:
         """Check if a path matches any of the exclude patterns."""
-        return any(pattern.search(path) for pattern in self.rule.exclude_patterns)
+        start = self.metrics.start()
+        excluded = self.rules.is_excluded(path)
+        self.metrics.observe("rules", start)
+        return excluded
 
     def _is_important(self, path: str) -> bool:
         """Check if a path matches any of the important patterns."""
-        return any(pattern.search(path) for pattern in self.rule.important_pattern)
+        start = self.metrics.start()
+        important = self.rules.is_important(path)
+        self.metrics.observe("rules", start)
+        return important
 
     def initialize_cache(self, path_to_watch: str):
         """
         Initialize the cache with files we want to watch.
+        Excluded subtrees are not walked at all.
         """
-        root_dir = pathlib.Path(path_to_watch)
-        for node in root_dir.rglob("*"):
-            if node.is_file() and not self._is_excluded(str(node)):
-                self.cache.add_file(str(node))
+        for directory, dirnames, filenames in os.walk(path_to_watch):
+            dirnames[:] = [
+                name
+                for name in dirnames
+                if not self.rules.excludes_tree(os.path.join(directory, name))
+            ]
+            for name in filenames:
+                path = os.path.join(directory, name)
+                if os.path.isfile(path) and not self._is_excluded(path):
+                    self.cache.add_file(path)
 
-    def on_modified(self, event: FileModifiedEvent | DirModifiedEvent) -> None:
-        if isinstance(event, DirModifiedEvent):
-            # ignore directory modify events
-            return
+    def _submit(self, event_type: str, path: str, destination=None) -> None:
+        """Hand a raw event over from the observer thread to the event loop."""
+        start = self.metrics.start()
+        # blocks the observer thread while the raw queue is full
+        self._raw_slots.acquire()
+        self.__loop.call_soon_threadsafe(
+            self._put_batch,
+            [(event_type, path, destination)],
+            start,
+        )
 
-        print(f"File {event.src_path} has been modified")
-        if self._is_excluded(event.src_path):
-            return
+    def submit_batch(self, events: list[tuple]) -> None:
+        """
+        Hand a batch of raw (event_type, path, destination) events over
+        to the event loop with a single wakeup.
+        """
+        size = self._queue_size
+        for start in range(0, len(events), size):
+            chunk = events[start : start + size]
+            submitted = self.metrics.start()
+            for _ in chunk:
+                self._raw_slots.acquire()
+            self.__loop.call_soon_threadsafe(self._put_batch, chunk, submitted)
 
-        diff = None
-        if self._is_important(event.src_path):
-            # create a diff for an important file
-            diff = self.cache.get_diff(event.src_path)
-            if diff:
-                diff = list(diff)
-            # now, update the cache with the new file content
-            self.cache.update_cache(event.src_path)
-
-        msg = FileObserverEvent(
-            event_type="modified",
-            file_path=event.src_path,
-            diff=diff,
-        )
-        self.__emit(event.src_path, msg)
+    def _put_batch(self, events: list[tuple], submitted: int = 0) -> None:
+        # time from the observer's callback until the loop took the events
+        self.metrics.observe("dispatch", submitted)
+        self.metrics.add("events", len(events))
+        for event in events:
+            self._raw.put_nowait(event)
 
-    def on_created(self, event: FileCreatedEvent | DirCreatedEvent) -> None:
-        if isinstance(event, DirCreatedEvent):
-            # ignore directory create events
-            return
+    def rescan(self, root: str, on_directory=None) -> int:
+        """
+        Look for changes of important files which were not reported, e.g.
+        after events were lost. Only files whose size or mtime differs
+        from the cache are reported. Returns the number of found changes.
+        :param on_directory: called for every directory that is walked.
+        """
+        events = []
+        seen = set()
+        stack = [root]
+        while stack:
+            directory = stack.pop()
+            if on_directory is not None:
+                on_directory(directory)
+            try:
+                with os.scandir(directory) as entries:
+                    entries = list(entries)
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not self.rules.excludes_tree(entry.path):
+                            stack.append(entry.path)
+                        continue
+                    if not entry.is_file():
+                        continue
+                    path = entry.path
+                    if self._is_excluded(path) or not self._is_important(path):
+                        continue
+                    seen.add(path)
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                if self.cache.content_hash(path) is None:
+                    events.append(("created", path, None))
+                elif not self.cache.is_current(path, stat):
+                    events.append(("modified", path, None))
+        for path in self.cache.paths_below(root):
+            if path not in seen:
+                events.append(("deleted", path, None))
+        print(f"Rescan of {root} found {len(events)} changes.")
+        self.submit_batch(events)
+        return len(events)
+
+    async def run(self) -> None:
+        """Run all stages of the pipeline."""
+        stages = [self._filter_stage(), self._coalesce_stage()]
+        stages += [self._diff_stage(queue) for queue in self._diff]
+        stages += [self._serialize_stage(), self._publish_stage()]
+        if self.stats_interval:
+            stages.append(self._stats_stage())
+        try:
+            await asyncio.gather(*stages)
+        finally:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+    async def _filter_stage(self) -> None:
+        while True:
+            event_type, path, destination = await self._raw.get()
+            self._raw_slots.release()
+            if event_type in ("moved_dir", "deleted_dir"):
+                await self._directory_event(event_type, path, destination)
+                continue
+            if self._is_excluded(path):
+                continue
+            if event_type == "moved":
+                self.coalescer.move(path, destination)
+            else:
+                self.coalescer.add(event_type, path)
 
-        if self._is_excluded(event.src_path):
+    async def _directory_event(self, event_type, path, destination) -> None:
+        """
+        Apply a directory move or delete to the pending events and hand it
+        to all diff workers as a barrier: the files below are spread over
+        the workers and the cache keys must not change under their diffs.
+        """
+        if self.rules.excludes_tree(path):
             return
+        if event_type == "moved_dir":
+            self.coalescer.move_tree(path, destination)
+            event = CoalescedEvent(event_type, destination, 0.0, source=path)
+        else:
+            self.coalescer.remove_tree(path)
+            event = CoalescedEvent(event_type, path, 0.0)
+        barrier = DirectoryBarrier(event, len(self._diff))
+        for queue in self._diff:
+            await queue.put(barrier)
 
-        if self._is_important(event.src_path):
-            self.cache.add_file(event.src_path)
+    async def _coalesce_stage(self) -> None:
+        while True:
+            await asyncio.sleep(self.coalescer.tick)
+            for event in self.coalescer.pop_ready():
+                if event.event_type == "moved":
+                    # the source and the destination may be on different workers
+                    barrier = DirectoryBarrier(event, len(self._diff))
+                    for queue in self._diff:
+                        await queue.put(barrier)
+                    continue
+                queue = self._diff[hash(event.path) % len(self._diff)]
+                await queue.put(event)
 
-        print(f"File {event.src_path} has been created")
-        msg = FileObserverEvent(
-            event_type="created",
-            file_path=event.src_path,
-            # we don't add a diff here since it's assumed a
-            # new file is not a diff
-        )
-        self.__emit(event.src_path, msg)
+    async def _diff_stage(self, queue: asyncio.Queue) -> None:
+        while True:
+            event = await queue.get()
+            if isinstance(event, DirectoryBarrier):
+                if event.arrive():
+                    await self._process(event.event)
+                    event.done.set()
+                else:
+                    await event.done.wait()
+                continue
+            await self._process(event)
 
-    def on_moved(self, event: DirMovedEvent | FileMovedEvent) -> None:
-        if isinstance(event, DirMovedEvent):
-            # ignore directory moved events
+    async def _process(self, event: CoalescedEvent) -> None:
+        try:
+            messages = await self.__loop.run_in_executor(
+                self._pool,
+                self.process_event,
+                event,
+            )
+        except Exception as e:
+            print(f"Failed to process event for {event.path}: {e}")
             return
+        for msg in messages:
+            await self._serialize.put(msg)
 
-        if self._is_excluded(event.src_path):
-            return
+    async def _serialize_stage(self) -> None:
+        while True:
+            msg = await self._serialize.get()
+            start = self.metrics.start()
+            payload = self.codec.encode(msg)
+            self.metrics.observe("serialize", start)
+            if not self.client.binary:
+                # the binary protocol carries the encoding as is
+                payload = base64.b64encode(payload).decode("ascii")
+            await self._publish.put((msg.file_path, payload))
+
+    async def _publish_stage(self) -> None:
+        while True:
+            topic, payload = await self._publish.get()
+            start = self.metrics.start()
+            try:
+                await self.client.publish(topic, payload)
+            except Exception as e:
+                print(f"Failed to publish to {topic}: {e}")
+                continue
+            self.metrics.observe("publish", start)
+            self.metrics.add("messages")
+            self.metrics.add("bytes_published", len(payload))
+
+    async def _stats_stage(self) -> None:
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            await self.publish_stats(self.metrics.snapshot())
 
-        if self._is_important(event.src_path):
+    async def publish_stats(self, stats: dict) -> None:
+        """Publish stats with the state of the pipeline on STATS_TOPIC."""
+        stats["queues"] = self.stats()
+        stats["cache"] = self.cache.stats()
+        if hasattr(self.client, "backlog"):
+            stats["client"] = self.client.backlog()
+        try:
+            await self.client.publish(STATS_TOPIC, json.dumps(stats).encode("utf-8"))
+        except Exception as e:
+            print(f"Failed to publish stats: {e}")
+
+    async def profile(self, seconds: float = 10.0, limit: int = 20) -> list[dict]:
+        """
+        Sample the stacks of all threads for some seconds and publish the
+        most frequent ones on STATS_TOPIC.
+        """
+        profiler = SamplingProfiler()
+        profiler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.stop()
+        top = profiler.top(limit)
+        await self.publish_stats({"profile": top, "samples": profiler.samples})
+        return top
+
+    def stats(self) -> dict:
+        """Return the number of events waiting in each stage."""
+        return {
+            "raw": self._raw.qsize(),
+            "coalescing": len(self.coalescer.pending),
+            "diff": [queue.qsize() for queue in self._diff],
+            "serialize": self._serialize.qsize(),
+            "publish": self._publish.qsize(),
+        }
+
+    def process_event(self, event: CoalescedEvent) -> list[FileObserverEvent]:
+        """
+        Update the cache for a coalesced event and return its messages.
+        Runs in the diff worker pool.
+        """
+        if event.event_type == "moved":
+            messages = self._moved(event)
+        elif event.event_type == "moved_dir":
+            messages = [self._moved_dir(event.source, event.path)]
+        elif event.event_type == "deleted_dir":
+            messages = [self._deleted_dir(event.path)]
+        elif event.event_type == "modified":
+            messages = self._modified(event.path, event.count)
+        elif event.event_type == "created":
+            messages = self._created(event.path, event.count)
+        else:
+            messages = [self._deleted(event.path, event.count)]
+        if self.manifest is not None:
+            self._record(event)
+        return messages
+
+    def _record(self, event: CoalescedEvent) -> None:
+        """Keep the manifest in line with a processed event."""
+        path = event.path
+        if event.event_type == "deleted":
+            self.manifest.remove(path)
+        elif event.event_type == "deleted_dir":
+            self.manifest.remove_tree(path)
+        elif event.event_type == "moved_dir":
+            self.manifest.move_tree(event.source, path)
+        else:
+            if event.event_type == "moved":
+                self.manifest.remove(event.source)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                self.manifest.remove(path)
+            else:
+                self.manifest.put(path, stat, entry_hash(self.cache, path, stat))
+        if event.event_type != "modified":
+            # entries were added or removed
+            self.manifest.invalidate(os.path.dirname(path))
+            if event.source is not None:
+                self.manifest.invalidate(os.path.dirname(event.source))
+
+    def close(self) -> None:
+        """Write the state of the cache and the manifest."""
+        self.cache.close()
+        if self.manifest is not None:
+            self.manifest.close()
+
+    def _modified(self, path: str, merged_events: int) -> list[FileObserverEvent]:
+        print(f"File {path} has been modified ({merged_events} events)")
+        diff = None
+        delta = None
+        uploads = None
+        base_hash = None
+        content_hash = None
+        compressed = None
+        if self._is_important(path):
+            # create a diff (or a delta for a binary file) for an important
+            # file and update the cache with the new file content
+            previous_hash = self.cache.content_hash(path)
+            start = self.metrics.start()
+            if self.cache.is_binary(path):
+                # the recorder rebuilds versions from a base it received
+                if previous_hash in self._sent_versions:
+                    delta = self.cache.get_delta(path, update=True)
+                if delta is None:
+                    # unknown base or too large a delta: the whole version
+                    uploads = self._upload("modified", path, merged_events)
+            else:
+                diff = self.cache.get_diff(path, update=True)
+            self.metrics.observe("diff", start)
+            self.metrics.add("bytes_diffed", self.cache.file_size(path))
+            if uploads:
+                self._sent_versions.discard(previous_hash)
+                return uploads
+            if delta is not None:
+                base_hash = previous_hash
+                content_hash = self.cache.content_hash(path)
+                self._sent_versions.discard(previous_hash)
+                self._sent_versions.add(content_hash)
+            elif diff is None:
+                # not cached (anymore), at least tell what the file is now
+                if self.cache.content_hash(path) == previous_hash:
+                    self.cache.update_cache(path)
+                content_hash = self.cache.content_hash(path)
+            if diff and self.compressor is not None:
+                compressed = self.compressor.compress(path, diff)
+
+        if compressed is not None:
+            diff_compression, data = compressed
+            return [
+                FileObserverEvent.trusted(
+                    event_type="modified",
+                    file_path=path,
+                    diff_compression=diff_compression,
+                    compressed_diff=base64.b64encode(data).decode("ascii"),
+                    merged_events=merged_events,
+                ),
+            ]
+        return [
+            FileObserverEvent.trusted(
+                event_type="modified",
+                file_path=path,
+                diff=diff,
+                delta=delta,
+                base_hash=base_hash,
+                content_hash=content_hash,
+                merged_events=merged_events,
+            ),
+        ]
+
+    def _created(self, path: str, merged_events: int) -> list[FileObserverEvent]:
+        print(f"File {path} has been created")
+        if self._is_important(path):
+            self.cache.add_file(path)
+            if self.cache.is_binary(path):
+                # the whole content, the base of the deltas of later changes
+                uploads = self._upload("created", path, merged_events)
+                if uploads:
+                    return uploads
+
+        return [
+            FileObserverEvent.trusted(
+                event_type="created",
+                file_path=path,
+                merged_events=merged_events,
+                # we don't add a diff here since it's assumed a
+                # new file is not a diff
+            ),
+        ]
+
+    def _upload(
+        self,
+        event_type: str,
+        path: str,
+        merged_events: int,
+    ) -> list[FileObserverEvent] | None:
+        """
+        Send the whole content of a binary file as deltas without a base
+        the recorder needs. A file larger than max_delta_bytes goes in
+        parts: each copies the version built by the ones before and
+        inserts the next piece, all parts but the last are partial.
+        """
+        data = self.cache.get_content(path, update=True)
+        if data is None:
+            return None
+        part_bytes = self.cache.max_delta_bytes
+        events = []
+        digest = hashlib.sha256()
+        base_hash = None
+        for start in range(0, max(len(data), 1), part_bytes):
+            piece = data[start : start + part_bytes]
+            digest.update(piece)
+            content_hash = digest.hexdigest()
+            delta = [(0, start)] if start else []
+            delta.append(base64.b64encode(piece).decode("ascii"))
+            events.append(
+                FileObserverEvent.trusted(
+                    event_type=event_type,
+                    file_path=path,
+                    delta=delta,
+                    base_hash=base_hash,
+                    content_hash=content_hash,
+                    merged_events=merged_events,
+                    partial=start + part_bytes < len(data),
+                ),
+            )
+            base_hash = content_hash
+        self._sent_versions.add(content_hash)
+        return events
+
+    def _moved(self, event: CoalescedEvent) -> list[FileObserverEvent]:
+        if self._is_important(event.source):
             # watch new destination - rekey cache entry...
-            self.cache.rekey(event.src_path, event.dest_path)
+            self.cache.rekey(event.source, event.path)
 
-        print(f"File {event.src_path} has been moved to {event.dest_path}")
-        msg = FileObserverEvent(
+        print(f"File {event.source} has been moved to {event.path}")
+        # changes made before or after the move are reported separately
+        merged_events = 1 if event.modified else event.count
+        messages = [
+            FileObserverEvent.trusted(
+                event_type="moved",
+                file_path=event.source,
+                destination_path=event.path,
+                merged_events=merged_events,
+            ),
+        ]
+        if event.modified:
+            messages.extend(self._modified(event.path, event.count - 1))
+        return messages
+
+    def _moved_dir(self, source: str, destination: str) -> FileObserverEvent:
+        moved = self.cache.rekey_tree(source, destination)
+        print(f"Directory {source} has been moved to {destination} ({moved} cached)")
+        return FileObserverEvent.trusted(
             event_type="moved",
-            file_path=event.src_path,
-            destination_path=event.dest_path,
+            file_path=source,
+            destination_path=destination,
+            is_directory=True,
         )
-        self.__emit(event.src_path, msg)
-
-    def on_deleted(self, event: FileDeletedEvent | DirDeletedEvent) -> None:
-        # TODO: clean cache after file deleted...
-        if isinstance(event, DirDeletedEvent):
-            # ignore directory create events
-            return
 
-        if self._is_excluded(event.src_path):
-            return
+    def _deleted_dir(self, path: str) -> FileObserverEvent:
+        removed = self.cache.remove_tree(path)
+        print(f"Directory {path} has been deleted ({removed} cached)")
+        return FileObserverEvent.trusted(
+            event_type="deleted",
+            file_path=path,
+            is_directory=True,
+        )
 
-        print(f"File {event.src_path} has been deleted")
-        msg = FileObserverEvent(
+    def _deleted(self, path: str, merged_events: int) -> FileObserverEvent:
+        self.cache.remove(path)
+        print(f"File {path} has been deleted")
+        return FileObserverEvent.trusted(
             event_type="deleted",
-            file_path=event.src_path,
-            destination_path=event.dest_path,
+            file_path=path,
+            merged_events=merged_events,
             # assumption: diff is not necessary since we can
             # assume the result after a delete.
         )
-        self.__emit(event.src_path, msg)
+
+    def on_modified(self, event: FileModifiedEvent | DirModifiedEvent) -> None:
+        if isinstance(event, DirModifiedEvent):
+            # ignore directory modify events
+            return
+        self._submit("modified", event.src_path)
+
+    def on_created(self, event: FileCreatedEvent | DirCreatedEvent) -> None:
+        if isinstance(event, DirCreatedEvent):
+            # ignore directory create events
+            return
+        self._submit("created", event.src_path)
+
+    def on_moved(self, event: DirMovedEvent | FileMovedEvent) -> None:
+        if isinstance(event, DirMovedEvent):
+            self._submit("moved_dir", event.src_path, event.dest_path)
+            return
+        if event.is_synthetic:
+            # generated for the files below a moved directory, which
+            # is reported and applied to the cache as a whole
+            return
+        self._submit("moved", event.src_path, event.dest_path)
+
+    def on_deleted(self, event: FileDeletedEvent | DirDeletedEvent) -> None:
+        if isinstance(event, DirDeletedEvent):
+            self._submit("deleted_dir", event.src_path)
+            return
+        self._submit("deleted", event.src_path)
 
 
 class FSOFileObserver:
     """
     Observes a given path for file changes.
+
+    With lazy_index, watching starts right away and the important files
+    are indexed in the background by a CacheIndexer. Files changed before
+    the indexer reached them are reported without a diff.
+
+    The backend is either "watchdog" (portable) or "inotify", which reads
+    the events in batches straight from inotify on Linux.
+
+    With reconcile, the changes made while the agent was down are found
+    with the manifest of the file handler and reported first, before the
+    cache is filled in the background.
     """
 
-    def __init__(self, path_to_watch: str, file_handler: FileHandler):
+    def __init__(
+        self,
+        path_to_watch: str,
+        file_handler: FileHandler,
+        lazy_index: bool = False,
+        index_workers: int = 8,
+        backend: str = "watchdog",
+        reconcile: bool = False,
+    ):
         self.path_to_watch = path_to_watch
         self.event_handler = file_handler
-        self.observer = Observer()
+        if backend == "inotify":
+            self.observer = InotifyObserver()
+        elif backend == "watchdog":
+            self.observer = Observer()
+        else:
+            raise ValueError(f"Unknown observer backend: {backend}")
+        self.reconciler = None
+        if reconcile:
+            self.reconciler = Reconciler(file_handler, file_handler.manifest)
+        self._startup = None
+        self.indexer = None
+        if lazy_index:
+            self.indexer = CacheIndexer(
+                file_handler.rules,
+                file_handler.cache,
+                workers=index_workers,
+            )
 
     def start(self):
         """
         Start observing the path for changes.
         """
-        self.event_handler.initialize_cache(self.path_to_watch)
+        if self.indexer is None and self.reconciler is None:
+            self.event_handler.initialize_cache(self.path_to_watch)
         self.observer.schedule(self.event_handler, self.path_to_watch, recursive=True)
         self.observer.start()
+        if self.reconciler is not None:
+            # the events are handed to the running pipeline
+            self._startup = threading.Thread(
+                target=self._reconcile,
+                name="fso-reconcile",
+                daemon=True,
+            )
+            self._startup.start()
+        elif self.indexer is not None:
+            self.indexer.start(self.path_to_watch)
         print(f"Started monitoring {self.path_to_watch}.")
 
+    def _reconcile(self) -> None:
+        # before the cache is filled, so changed files get a diff against
+        # the version stored before the restart
+        self.reconciler.run(self.path_to_watch)
+        if self.indexer is not None:
+            self.indexer.start(self.path_to_watch)
+        else:
+            self.event_handler.initialize_cache(self.path_to_watch)
+
     def stop(self):
         """
         Stop observing the path.
@@ -212,7 +1036,16 @@ class FSOFileObserver:
         print(f"Stopped monitoring {self.path_to_watch}.")
 
 
-async def run_agent():
+async def run_agent(
+    backend: str = "watchdog",
+    stats_interval: float = 10.0,
+    codec: str = "json",
+    binary: bool = False,
+    batch_size: int = 256,
+    lazy_index: bool = False,
+    reconcile: bool = False,
+    dictionaries: str | None = None,
+):
     # TODO: make this configurable
     path = "/tmp/enlyze"
     rule = FileObserverRule(
@@ -224,21 +1057,116 @@ async def run_agent():
         ],
     )
 
-    client = FSOMessageClient()
-    handler = FileHandler(client, rule)
+    client = FSOMessageClient(
+        binary=binary,
+        batch_size=batch_size,
+        spool_dir="/var/tmp/fso-agent/spool",
+    )
+    compressor = None
+    if dictionaries is not None:
+        compressor = DiffCompressor(load_dictionaries(dictionaries))
+    handler = FileHandler(
+        client,
+        rule,
+        cache_dir="/var/tmp/fso-agent/cache",
+        # the manifest is only needed to find the changes after a restart
+        manifest_path="/var/tmp/fso-agent/manifest.sqlite" if reconcile else None,
+        codec=codec,
+        compressor=compressor,
+        metrics=Metrics(enabled=stats_interval > 0),
+        stats_interval=stats_interval,
+    )
     file_observer = FSOFileObserver(
         path_to_watch=path,
         file_handler=handler,
+        lazy_index=lazy_index,
+        backend=backend,
+        reconcile=reconcile,
     )
 
-    await client.connect()
+    # kill -USR2 <pid> publishes the hot stacks of the next 10 seconds
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(
+        signal.SIGUSR2,
+        lambda: loop.create_task(handler.profile()),
+    )
+
+    # events are spooled while the broker is not reachable yet
+    client.start()
     file_observer.start()
-    while True:
-        await asyncio.sleep(1)  # Keep the script running
+    try:
+        await handler.run()  # Keep the script running
+    finally:
+        file_observer.stop()
+        handler.close()
+        await client.disconnect()
 
 
 if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-o",
+        type=str,
+        help="observer backend",
+        choices=["watchdog", "inotify"],
+        default="watchdog",
+    )
+    parser.add_argument(
+        "-s",
+        type=float,
+        help="seconds between published metrics, 0 disables them",
+        default=10.0,
+    )
+    parser.add_argument(
+        "-c",
+        type=str,
+        help="event codec, compact needs consumers that can decode it",
+        choices=sorted(CODECS),
+        default="json",
+    )
+    parser.add_argument(
+        "-b",
+        action="store_true",
+        help="use the binary protocol if the broker supports it",
+    )
+    parser.add_argument(
+        "-n",
+        type=int,
+        help="messages sent to the broker at once",
+        default=256,
+    )
+    parser.add_argument(
+        "-l",
+        action="store_true",
+        help="index the files in the background while watching",
+    )
+    parser.add_argument(
+        "-r",
+        action="store_true",
+        help="report the changes made while the agent was not running",
+    )
+    parser.add_argument(
+        "-d",
+        type=str,
+        help="compress diffs with the dictionaries of this directory",
+        default=None,
+    )
+
+    args = parser.parse_args()
     try:
-        asyncio.run(run_agent())
+        asyncio.run(
+            run_agent(
+                args.o,
+                args.s,
+                codec=args.c,
+                binary=args.b,
+                batch_size=args.n,
+                lazy_index=args.l,
+                reconcile=args.r,
+                dictionaries=args.d,
+            )
+        )
     except KeyboardInterrupt:
         print("FSO-Agent stopping...")
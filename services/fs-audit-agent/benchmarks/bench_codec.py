@@ -0,0 +1,88 @@
+"""
+Benchmark of the event encodings: size, encoding and decoding time of
+events without a diff, with a text diff and with a binary delta, for
+the JSON codec (base64 encoded as on the text protocol, and raw) and the
+compact codec, and the construction of events with and without
+validation.
+
+Run from the agent directory:
+
+    python benchmarks/bench_codec.py
+"""
+
+import base64
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import CODECS, FileObserverEvent, decode_event, read_header  # noqa: E402
+
+ROUNDS = 20000
+
+
+def measure(function, rounds=ROUNDS):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        function()
+    return (time.perf_counter() - start) / rounds * 1e6
+
+
+def events():
+    generator = random.Random(0)
+    diff = ["--- previous_version", "+++ current_version", "@@ -1,40 +1,40 @@"]
+    for i in range(40):
+        line = f"option_{i} = {generator.randrange(10**6)}"
+        diff.append(("+" if i % 10 == 0 else " ") + line)
+    delta = [(0, 65536)]
+    for i in range(8):
+        delta.append(base64.b64encode(generator.randbytes(4096)).decode("ascii"))
+        delta.append((65536 * (i + 1), 65536))
+    fields = {"file_path": "/tmp/enlyze/important_stuff/app.conf"}
+    return {
+        "no diff": dict(fields, event_type="created"),
+        "text diff": dict(fields, event_type="modified", diff=diff),
+        "binary delta": dict(
+            fields,
+            event_type="modified",
+            delta=delta,
+            base_hash="a" * 64,
+            content_hash="b" * 64,
+        ),
+    }
+
+
+def main():
+    json_codec = CODECS["json"]
+    compact = CODECS["compact"]
+    for name, fields in events().items():
+        event = FileObserverEvent(**fields)
+        print(f"{name}:")
+        validated = measure(lambda: FileObserverEvent(**fields))
+        trusted = measure(lambda: FileObserverEvent.trusted(**fields))
+        print(f"  construct  validated {validated:6.1f} us  trusted {trusted:6.1f} us")
+
+        text = event.to_base64()
+        encode = measure(event.to_base64)
+        decode = measure(lambda: FileObserverEvent.from_base64(text))
+        print(
+            f"  json+base64 {len(text):6d} B  encode {encode:6.1f} us  "
+            f"decode {decode:6.1f} us",
+        )
+        for codec in (json_codec, compact):
+            data = codec.encode(event)
+            encode = measure(lambda: codec.encode(event))
+            decode = measure(lambda: decode_event(data))
+            trusted = measure(lambda: decode_event(data, validate=False))
+            header = measure(lambda: read_header(data))
+            print(
+                f"  {codec.name:11s} {len(data):6d} B  encode {encode:6.1f} us  "
+                f"decode {decode:6.1f} us  unvalidated {trusted:6.1f} us  "
+                f"header {header:6.1f} us",
+            )
+
+
+if __name__ == "__main__":
+    main()
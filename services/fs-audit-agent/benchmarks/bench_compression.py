@@ -0,0 +1,117 @@
+"""
+Benchmark of the diff compression: size of the diffs of edited config
+files as plain JSON lists (the current format), compressed without a
+dictionary, with the built-in one and with a dictionary trained on other
+files of the type, and the size of the events in the recorder's log.
+
+Run from the agent directory:
+
+    python benchmarks/bench_compression.py
+"""
+
+import base64
+import json
+import os
+import random
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from compression import DiffCompressor, train  # noqa: E402
+from diffing import unified_diff  # noqa: E402
+from models import CODECS, FileObserverEvent  # noqa: E402
+
+SAMPLES = 50
+EDITS = 500
+SECTIONS = ["server", "database", "cache", "logging", "auth", "metrics"]
+KEYS = ["host", "port", "timeout", "retries", "user", "level", "path", "enabled"]
+
+
+def config(generator: random.Random) -> list[str]:
+    lines = ["# generated configuration\n"]
+    for section in SECTIONS:
+        lines.append(f"[{section}]\n")
+        for key in generator.sample(KEYS, 6):
+            lines.append(f"{key} = {generator.choice(['yes', 'no', 8080, 30, 3])}\n")
+        lines.append("\n")
+    return lines
+
+
+def edit(generator: random.Random, lines: list[str]) -> list[str]:
+    edited = list(lines)
+    for _ in range(generator.randint(1, 3)):
+        index = generator.randrange(len(edited))
+        if " = " in edited[index]:
+            key = edited[index].split(" = ")[0]
+            edited[index] = f"{key} = {generator.randrange(10000)}\n"
+    return edited
+
+
+def event_size(event: FileObserverEvent, codec: str) -> int:
+    return len(CODECS[codec].encode(event))
+
+
+def main():
+    generator = random.Random(0)
+    dictionary = train(["".join(config(generator)) for _ in range(SAMPLES)])
+    diffs = []
+    for _ in range(EDITS):
+        lines = config(generator)
+        diff, _ = unified_diff(
+            lines,
+            edit(generator, lines),
+            fromfile="previous_version",
+            tofile="current_version",
+            lineterm="",
+        )
+        if diff:
+            diffs.append(diff)
+
+    plain = sum(len(json.dumps(diff)) for diff in diffs)
+    no_dictionary = sum(len(zlib.compress(json.dumps(diff).encode())) for diff in diffs)
+    builtin = DiffCompressor(min_size=0)
+    trained = DiffCompressor({".conf": dictionary}, min_size=0)
+    start = time.perf_counter()
+    compressed = [trained.compress("/etc/app.conf", diff) for diff in diffs]
+    elapsed = time.perf_counter() - start
+    for diff in diffs:
+        builtin.compress("/etc/app.conf", diff)
+
+    print(f"{len(diffs)} diffs, dictionary {len(dictionary)} bytes")
+    print(f"  plain JSON          {plain:8d} B")
+    print(f"  zlib                {no_dictionary:8d} B")
+    print(f"  zlib built-in dict  {builtin.bytes_out:8d} B")
+    print(
+        f"  zlib trained dict   {trained.bytes_out:8d} B  "
+        f"({elapsed / len(diffs) * 1e6:.0f} us per diff)",
+    )
+
+    # on the wire and in the recorder's log
+    sizes = {"json": 0, "json compressed": 0, "compact compressed": 0}
+    log = {"plain": 0, "compressed": 0}
+    for diff, (encoding, data) in zip(diffs, compressed):
+        event = FileObserverEvent(event_type="modified", file_path="/etc/a.conf")
+        with_diff = event.model_copy(update={"diff": diff})
+        packed = event.model_copy(
+            update={
+                "diff_compression": encoding,
+                "compressed_diff": base64.b64encode(data).decode("ascii"),
+            },
+        )
+        sizes["json"] += event_size(with_diff, "json")
+        sizes["json compressed"] += event_size(packed, "json")
+        sizes["compact compressed"] += event_size(packed, "compact")
+        log["plain"] += len(with_diff.model_dump_json()) + 1
+        log["compressed"] += len(packed.model_dump_json()) + 1
+    print("events on the wire:")
+    for name, size in sizes.items():
+        print(f"  {name:19s} {size:8d} B")
+    print("recorder log:")
+    for name, size in log.items():
+        print(f"  {name:19s} {size:8d} B")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""
+Benchmark of the binary delta of a large file with a few local changes,
+an insertion shifting the rest of the file, and a zero filled region.
+
+Run from the agent directory:
+
+    python benchmarks/bench_delta.py
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import delta  # noqa: E402
+
+SIZE = 256 * 1024 * 1024
+
+
+def measure(function):
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+
+def main():
+    generator = random.Random(0)
+    base = (
+        generator.randbytes(SIZE // 2)
+        + bytes(SIZE // 4)
+        + generator.randbytes(SIZE // 4)
+    )
+    edited = bytearray(base)
+    # patched in place, an insertion and a deletion
+    edited[1000:1016] = b"\xff" * 16
+    edited[SIZE // 3 : SIZE // 3] = b"inserted"
+    del edited[SIZE - 4096 : SIZE - 2048]
+    edited = bytes(edited)
+
+    print(f"file: {SIZE / 1024 / 1024:.0f} MiB")
+    signature_time, signature = measure(lambda: delta.signature(base))
+    print(f"signature  {signature_time:6.2f} s  ({len(signature)} chunks)")
+    encode_time, (instructions, _) = measure(lambda: delta.encode(signature, edited))
+    assert delta.apply(base, instructions) == edited
+    print(
+        f"delta      {encode_time:6.2f} s  ({len(instructions)} instructions, "
+        f"{delta.inserted_bytes(instructions) / 1024:.1f} KiB inserted)",
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Benchmark comparing difflib.unified_diff with the block diff engine on
+a large file with a few local changes and a large rewrite.
+
+Run from the agent directory:
+
+    python benchmarks/bench_diff.py
+"""
+
+import difflib
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from diffing import unified_diff  # noqa: E402
+
+LINES = 200_000
+
+
+def measure(function):
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+
+def main():
+    previous = [f"setting.{i} = value {i}\n" for i in range(LINES)]
+    size = sum(len(line) for line in previous)
+
+    edited = list(previous)
+    edited[1000] = "setting.1000 = changed\n"
+    edited[150_000:150_000] = ["added = 1\n", "added = 2\n"]
+    del edited[50_000:50_010]
+
+    print(f"file: {LINES} lines, {size / 1024 / 1024:.1f} MiB")
+    difflib_time, expected = measure(
+        lambda: list(difflib.unified_diff(previous, edited, lineterm="")),
+    )
+    engine_time, (result, info) = measure(
+        lambda: unified_diff(previous, edited, lineterm=""),
+    )
+    assert result == expected
+    print(f"local edits  difflib: {difflib_time:6.2f} s  engine: {engine_time:6.2f} s")
+
+    rewritten = [
+        f"setting.{i} = new\n" if i % 3 == 0 else line
+        for i, line in enumerate(previous)
+    ]
+    engine_time, (result, info) = measure(
+        lambda: unified_diff(previous, rewritten, lineterm=""),
+    )
+    print(
+        f"rewrite      engine: {engine_time:6.2f} s "
+        f"({len(result)} diff lines, large regions: {info['large']})",
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Benchmark comparing the per-pattern regex scan with the CompiledRule
+on a synthetic list of paths.
+
+Run from the agent directory:
+
+    python benchmarks/bench_rules.py
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import FileObserverRule  # noqa: E402
+from rules import CompiledRule  # noqa: E402
+
+PATHS = 1_000_000
+EXTENSIONS = [f"ext{i}" for i in range(150)] + ["conf", "py", "txt", "json"]
+DIRECTORIES = [f"dir{i}" for i in range(100)] + ["etc", "src", "lib", "node_modules"]
+
+
+def make_rule() -> FileObserverRule:
+    """A rule set of a few hundred patterns like the ones we deploy."""
+    exclude = [rf"^.*\.{ext}$" for ext in EXTENSIONS[:150]]
+    exclude += [rf"^.*/{name}/.*$" for name in DIRECTORIES[:100]]
+    exclude += [r"^.*__pycache__$", r"^/srv/cache", r"^.*\.bak\d+$"]
+    exclude += [rf"^.*/user{i}/(secrets|keys)/.*$" for i in range(20)]
+    important = [r"^.*\.conf$", r"^.*/important_stuff/.*$", r"^/etc/.*\.json$"]
+    return FileObserverRule(exclude_patterns=exclude, important_pattern=important)
+
+
+def make_paths(count: int) -> list[str]:
+    random.seed(42)
+    names = [f"pkg{i}" for i in range(200)] + DIRECTORIES[:10]
+    names += ["user3", "secrets", "important_stuff", "home", "srv"]
+    extensions = EXTENSIONS[:20] + EXTENSIONS[-4:] * 20
+    paths = []
+    # files are grouped in directories, like a walk returns them
+    while len(paths) < count:
+        depth = random.randint(1, 4)
+        directory = "/" + "/".join(random.choice(names) for _ in range(depth))
+        for _ in range(random.randint(1, 30)):
+            name = f"file{random.randint(0, 999)}.{random.choice(extensions)}"
+            paths.append(f"{directory}/{name}")
+    return paths[:count]
+
+
+def scan(rule, paths):
+    """The matching as it was before the CompiledRule existed."""
+    return [
+        any(pattern.search(path) for pattern in rule.exclude_patterns) for path in paths
+    ]
+
+
+def main():
+    rule = make_rule()
+    paths = make_paths(PATHS)
+
+    start = time.perf_counter()
+    expected = scan(rule, paths)
+    scan_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    compiled = CompiledRule(rule)
+    result = [compiled.is_excluded(path) for path in paths]
+    compiled_time = time.perf_counter() - start
+
+    assert result == expected
+    print(f"patterns: {len(rule.exclude_patterns)}, paths: {len(paths)}")
+    print(f"excluded: {sum(expected)}")
+    print(f"scan:     {scan_time:8.2f} s ({scan_time / PATHS * 1e6:.2f} us/path)")
+    print(
+        f"compiled: {compiled_time:8.2f} s "
+        f"({compiled_time / PATHS * 1e6:.2f} us/path)",
+    )
+    print(f"speedup: {scan_time / compiled_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,149 @@
 """Cache important files and allow comparison"""
 
-import difflib
+import hashlib
 import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from collections.abc import Mapping
 
+import delta
+from diffing import unified_diff
+from store import CacheStore
+
+# estimated memory of the list slot and str object of a cached line
+LINE_OVERHEAD = 64
+# estimated memory of a chunk in the signature of a binary file
+CHUNK_OVERHEAD = 256
+# a file read less than this after its mtime could change again within
+# the same timestamp tick, its mtime and size are not trusted
+RACY_NS = 2_000_000_000
+
+
+def split_lines(text: str) -> list[str]:
+    """Split text into lines like readlines() does for a text file."""
+    lines = [line + "\n" for line in text.split("\n")]
+    if lines[-1] == "\n":
+        lines.pop()
+    else:
+        lines[-1] = lines[-1][:-1]
+    return lines
+
+
+class _Entry:
+    __slots__ = ("lines", "data", "signature", "digest", "stat", "racy", "size")
 
-class FSOFileDiff:
     def __init__(self):
-        self.files = {}
+        # content as lines (hot) or zlib compressed (cold), None if evicted
+        self.lines = None
+        self.data = None
+        # chunk signature instead of the content of a binary file
+        self.signature = None
+        # SHA-256 of the content as hex
+        self.digest = None
+        # mtime and size of the file when it was read
+        self.stat = None
+        # read within RACY_NS of the mtime, the content has to be compared
+        self.racy = False
+        # estimated resident bytes
+        self.size = 0
+
+
+class _ResidentFiles(Mapping):
+    """Read-only view of the cached text file contents as lists of lines."""
+
+    def __init__(self, cache: "FSOFileDiff"):
+        self._cache = cache
+
+    def __getitem__(self, file_path: str) -> list[str]:
+        lines = self._cache._lines(file_path, touch=False)
+        if lines is None:
+            raise KeyError(file_path)
+        return lines
+
+    def __contains__(self, file_path) -> bool:
+        return file_path in self._cache._lru and not self._cache.is_binary(file_path)
+
+    def __iter__(self):
+        # binary files have no lines
+        return iter(
+            [path for path in list(self._cache._lru) if not self._cache.is_binary(path)]
+        )
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
+class FSOFileDiff:
+    """
+    Keeps the content of monitored files to diff them against new versions.
+
+    The cache is limited to max_bytes. The hot_entries most recently used
+    files are kept as lines, older ones zlib compressed. If the cache
+    still exceeds its budget, the least recently used contents are
+    evicted and only their hash is kept: those files get no diff on
+    their next change, but their content is cached again afterwards.
+
+    With a CacheStore, every content is also kept on disk. Evicted
+    contents are loaded from there, and after a restart files which
+    did not change are taken from the store without reading them.
+
+    Entries are also indexed by directory, so a directory move or delete
+    updates the cache in time proportional to the files below it.
+
+    get_diff skips files whose mtime and size did not change, and files
+    with the same content hash as before without diffing them. Changed
+    regions of large files above large_lines are diffed with a near
+    linear algorithm (see diffing.py).
+
+    Files which are no valid UTF-8 are kept as binary files: only the
+    chunk signature of their content is cached, and get_delta returns
+    copy and insert instructions against it (see delta.py). Deltas
+    inserting more than max_delta_bytes are not worth sending.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 128 * 1024 * 1024,
+        hot_entries: int = 128,
+        store: CacheStore | None = None,
+        large_lines: int = 2000,
+        max_delta_bytes: int = 4 * 1024 * 1024,
+    ):
+        self.max_bytes = max_bytes
+        self.hot_entries = hot_entries
+        self.store = store
+        self.large_lines = large_lines
+        self.max_delta_bytes = max_delta_bytes
+        # path -> entry of every monitored file
+        self._entries = {}
+        # paths with cached content and the uncompressed ones, least recent first
+        self._lru = OrderedDict()
+        self._hot = OrderedDict()
+        # directory -> paths of the entries directly in it
+        self._dirs = {}
+        # directory -> subdirectories with entries somewhere below them
+        self._subdirs = {}
+        self._lock = threading.RLock()
+        # statistics
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.compressions = 0
+        self.loads = 0
+        self.unchanged = 0
+        self.diffs = 0
+        self.large_diffs = 0
+        self.deltas = 0
+        self.diff_seconds = 0.0
+        self.max_diff_seconds = 0.0
+
+    @property
+    def files(self) -> Mapping:
+        """Cached file contents by path, without evicted files."""
+        return _ResidentFiles(self)
 
     def _read_file(self, file_path: str) -> list[str]:
         try:
@@ -16,64 +153,506 @@ class FSOFileDiff:
             print(f"File '{file_path}' not found.")
             return []
 
-    def add_file(self, file_path: str) -> None:
+    def add_file(self, file_path: str, quiet: bool = False) -> None:
         """
         Adds a file to be monitored for diffs. This should be done
         once to populate the cache.
         Validates that the path is a file.
         :param file_path: Path to the file to monitor.
+        :param quiet: Do not print the added file.
         """
         if not os.path.isfile(file_path):
             print(f"Error: '{file_path}' is not a valid file.")
             return
 
-        if file_path in self.files:
+        if file_path in self._entries:
             print(f"File '{file_path}' is already being monitored.")
             return
 
+        if self.store is not None:
+            stat = os.stat(file_path)
+            digest = self.store.lookup(file_path, stat)
+            if digest is not None:
+                # unchanged since it was stored, load the content on demand
+                with self._lock:
+                    entry = self._add_entry(file_path)
+                    entry.digest = digest
+                    self._set_stat(entry, stat)
+                if not quiet:
+                    print(f"File '{file_path}' restored for monitoring.")
+                return
+
         self.update_cache(file_path)
-        print(f"File '{file_path}' added for monitoring.")
+        if not quiet:
+            print(f"File '{file_path}' added for monitoring.")
+
+    def restore(self, file_path: str) -> bool:
+        """
+        Monitor a file with the version kept in the store, even if the
+        file changed since, so its next diff shows the change.
+        """
+        if self.store is None:
+            return False
+        record = self.store.manifest.get(file_path)
+        if record is None:
+            return False
+        mtime_ns, size, digest = record
+        with self._lock:
+            if file_path in self._entries:
+                return False
+            entry = self._add_entry(file_path)
+            entry.digest = digest
+            entry.stat = (mtime_ns, size)
+        return True
 
     def rekey(self, old_path: str, new_path: str) -> None:
         """keys can change when a file is moved. Tell the cache to track with new key"""
-        try:
-            self.files.update({new_path: self.files.pop(old_path)})
-        except KeyError as e:
-            print(f"Cache Re-Keying failed for {old_path}")
-            self.add_file(new_path)
+        with self._lock:
+            if self._move(old_path, new_path):
+                if self.store is not None:
+                    self.store.move([(old_path, new_path)])
+                return
+        print(f"Cache Re-Keying failed for {old_path}")
+        self.add_file(new_path)
+
+    def rekey_tree(self, old_directory: str, new_directory: str) -> int:
+        """
+        Track all files below a moved directory with their new keys.
+        Returns the number of moved entries.
+        """
+        with self._lock:
+            moves = [
+                (old_path, new_directory + old_path[len(old_directory) :])
+                for old_path in self._tree(old_directory)
+            ]
+            for old_path, new_path in moves:
+                self._move(old_path, new_path)
+            if moves and self.store is not None:
+                self.store.move(moves)
+        return len(moves)
+
+    def remove(self, file_path: str) -> None:
+        """Stop monitoring a deleted file."""
+        with self._lock:
+            self._drop(file_path)
+
+    def remove_tree(self, directory: str) -> int:
+        """
+        Stop monitoring all files below a deleted directory.
+        Returns the number of removed entries.
+        """
+        with self._lock:
+            paths = self._tree(directory)
+            for file_path in paths:
+                self._drop(file_path, forget=False)
+            if paths and self.store is not None:
+                self.store.remove(paths)
+        return len(paths)
+
+    def paths_below(self, directory: str) -> list[str]:
+        """Return the paths of all monitored files below a directory."""
+        with self._lock:
+            return self._tree(directory)
+
+    def is_current(self, file_path: str, stat: os.stat_result) -> bool:
+        """Check if the cached version of a file has the given mtime and size."""
+        entry = self._entries.get(file_path)
+        return entry is not None and self._same_stat(entry, stat)
+
+    @staticmethod
+    def _set_stat(entry: _Entry, stat: os.stat_result | None) -> None:
+        if stat is None:
+            entry.stat = None
+            return
+        entry.stat = (stat.st_mtime_ns, stat.st_size)
+        entry.racy = time.time_ns() - stat.st_mtime_ns < RACY_NS
+
+    @staticmethod
+    def _same_stat(entry: _Entry, stat: os.stat_result | None) -> bool:
+        """Check if a file still has the trusted mtime and size of its entry."""
+        return (
+            stat is not None
+            and not entry.racy
+            and entry.stat == (stat.st_mtime_ns, stat.st_size)
+        )
+
+    def _move(self, old_path: str, new_path: str) -> bool:
+        entry = self._pop_entry(old_path)
+        if entry is None:
+            return False
+        # a file moved over a cached one replaces it
+        self._drop(new_path)
+        self._add_entry(new_path, entry)
+        for order in (self._lru, self._hot):
+            if old_path in order:
+                del order[old_path]
+                order[new_path] = None
+        return True
+
+    def _add_entry(self, file_path: str, entry: _Entry | None = None) -> _Entry:
+        """Add an entry and index it by its directory."""
+        if entry is None:
+            entry = _Entry()
+        self._entries[file_path] = entry
+        directory = os.path.dirname(file_path)
+        files = self._dirs.get(directory)
+        if files is None:
+            files = self._dirs[directory] = set()
+            # link the new directory up to the first one already known
+            parent = os.path.dirname(directory)
+            while parent != directory:
+                known = parent in self._dirs or parent in self._subdirs
+                self._subdirs.setdefault(parent, set()).add(directory)
+                if known:
+                    break
+                directory, parent = parent, os.path.dirname(parent)
+        files.add(file_path)
+        return entry
+
+    def _pop_entry(self, file_path: str) -> _Entry | None:
+        """Remove an entry and unlink directories without entries left."""
+        entry = self._entries.pop(file_path, None)
+        if entry is None:
+            return None
+        directory = os.path.dirname(file_path)
+        files = self._dirs[directory]
+        files.discard(file_path)
+        if not files:
+            del self._dirs[directory]
+            while directory not in self._dirs and not self._subdirs.get(directory):
+                self._subdirs.pop(directory, None)
+                parent = os.path.dirname(directory)
+                if parent == directory:
+                    break
+                self._subdirs[parent].discard(directory)
+                directory = parent
+        return entry
+
+    def _tree(self, directory: str) -> list[str]:
+        """Paths of all entries below a directory."""
+        paths = []
+        stack = [directory]
+        while stack:
+            directory = stack.pop()
+            paths.extend(self._dirs.get(directory, ()))
+            stack.extend(self._subdirs.get(directory, ()))
+        return paths
 
     def update_cache(self, file_path: str) -> None:
         """
         Update the file cache. This potentially overrides existing
         cache content.
         """
-        self.files[file_path] = self._read_file(file_path)
+        # taken before reading, a change meanwhile is detected next time
+        stat = self._stat(file_path)
+        try:
+            lines = self._read_file(file_path)
+        except UnicodeDecodeError:
+            data = self._read_bytes(file_path)
+            digest = hashlib.sha256(data).hexdigest()
+            self._store_binary(file_path, stat, delta.signature(data), digest)
+            return
+        data = "".join(lines).encode("utf-8")
+        self._store(file_path, stat, lines, data, hashlib.sha256(data).hexdigest())
+
+    @staticmethod
+    def _read_bytes(file_path: str) -> bytes:
+        try:
+            with open(file_path, "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            print(f"File '{file_path}' not found.")
+            return b""
+
+    @staticmethod
+    def _stat(file_path: str) -> os.stat_result | None:
+        try:
+            return os.stat(file_path)
+        except FileNotFoundError:
+            return None
+
+    def _store(self, file_path, stat, lines, data, digest) -> None:
+        if stat is not None and self.store is not None:
+            self.store.put(file_path, stat, digest, data)
+        with self._lock:
+            entry = self._entries.get(file_path)
+            if entry is None:
+                entry = self._add_entry(file_path)
+            self._set_lines(file_path, entry, lines)
+            entry.digest = digest
+            self._set_stat(entry, stat)
+            self._shrink()
+
+    def _store_binary(self, file_path, stat, signature, digest) -> None:
+        if self.store is not None:
+            # not worth keeping large binary contents on disk
+            self.store.remove([file_path])
+        with self._lock:
+            entry = self._entries.get(file_path)
+            if entry is None:
+                entry = self._add_entry(file_path)
+            self.resident_bytes -= entry.size
+            entry.lines = None
+            entry.data = None
+            entry.signature = signature
+            entry.size = CHUNK_OVERHEAD * len(signature)
+            self.resident_bytes += entry.size
+            self._hot.pop(file_path, None)
+            self._lru[file_path] = None
+            self._lru.move_to_end(file_path)
+            entry.digest = digest
+            self._set_stat(entry, stat)
+            self._shrink()
+
+    def is_binary(self, file_path: str) -> bool:
+        """Check if a file is cached as a binary file."""
+        entry = self._entries.get(file_path)
+        return entry is not None and entry.signature is not None
+
+    def file_size(self, file_path: str) -> int:
+        """Return the size of a file when it was cached, 0 if unknown."""
+        entry = self._entries.get(file_path)
+        if entry is None or entry.stat is None:
+            return 0
+        return entry.stat[1]
 
-    def get_diff(self, file_path: str):
+    def content_hash(self, file_path: str) -> str | None:
+        """Return the SHA-256 of the cached content of a file."""
+        entry = self._entries.get(file_path)
+        if entry is None:
+            return None
+        return entry.digest
+
+    def _set_lines(self, file_path: str, entry: _Entry, lines: list[str]) -> None:
+        """Store the content of an entry uncompressed as most recently used."""
+        self.resident_bytes -= entry.size
+        entry.lines = lines
+        entry.data = None
+        entry.signature = None
+        entry.size = sum(len(line) for line in lines) + LINE_OVERHEAD * len(lines)
+        self.resident_bytes += entry.size
+        for order in (self._lru, self._hot):
+            order[file_path] = None
+            order.move_to_end(file_path)
+
+    def _lines(self, file_path: str, touch: bool = True) -> list[str] | None:
+        """Return the cached lines of a file, None if it was evicted."""
+        with self._lock:
+            entry = self._entries.get(file_path)
+            if entry is None or entry.signature is not None:
+                return None
+            if entry.lines is not None:
+                if touch:
+                    self._lru.move_to_end(file_path)
+                    self._hot.move_to_end(file_path)
+                return entry.lines
+            if entry.data is not None:
+                data = zlib.decompress(entry.data)
+            elif self.store is not None and entry.digest is not None:
+                data = self.store.get(entry.digest)
+                if data is None:
+                    return None
+                self.loads += 1
+            else:
+                return None
+            lines = split_lines(data.decode("utf-8"))
+            if touch:
+                self._set_lines(file_path, entry, lines)
+                self._shrink()
+            return lines
+
+    def _shrink(self) -> None:
+        """Compress and evict the least recently used entries to fit the budget."""
+        while len(self._hot) > self.hot_entries:
+            self._compress(self._hot.popitem(last=False)[0])
+        while self.resident_bytes > self.max_bytes and self._lru:
+            if self._hot:
+                # compress everything before giving up any content
+                self._compress(self._hot.popitem(last=False)[0])
+                continue
+            file_path = self._lru.popitem(last=False)[0]
+            entry = self._entries[file_path]
+            self.resident_bytes -= entry.size
+            entry.data = None
+            entry.signature = None
+            entry.size = 0
+            self.evictions += 1
+
+    def _drop(self, file_path: str, forget: bool = True) -> None:
+        """Forget a file entirely, in the store as well if forget is set."""
+        entry = self._pop_entry(file_path)
+        if entry is not None:
+            self.resident_bytes -= entry.size
+            self._lru.pop(file_path, None)
+            self._hot.pop(file_path, None)
+        # also kept in the store without an entry, e.g. deleted while the
+        # agent was down
+        if forget and self.store is not None:
+            self.store.remove([file_path])
+
+    def _compress(self, file_path: str) -> None:
+        entry = self._entries[file_path]
+        self.resident_bytes -= entry.size
+        entry.data = zlib.compress("".join(entry.lines).encode("utf-8"), 1)
+        entry.lines = None
+        entry.size = len(entry.data)
+        self.resident_bytes += entry.size
+        self.compressions += 1
+
+    def get_diff(self, file_path: str, update: bool = False) -> list[str] | None:
         """
-        Creates a diff for the specified file and prints it to stdout.
+        Creates a diff for the specified file.
         Side effect: if the file wasn't cached before, add it to the cache...
+        Returns None if the file is not monitored or its content was evicted.
         :param file_path: Path to the file to generate the diff for.
+        :param update: Cache the current content afterwards.
         """
-        if file_path not in self.files:
+        entry = self._entries.get(file_path)
+        if entry is None:
             print(f"File '{file_path}' is not being monitored.")
             return
 
-        current_content = self._read_file(file_path)
-        previous_content = self.files[file_path]
-
-        if not previous_content:
-            print(f"No previous content to compare for file '{file_path}'.")
-            # add it to the diff just in case...
-            self.add_file(file_path)
-
-        # create a diff using difflib...
-        diff = difflib.unified_diff(
-            previous_content,
-            current_content,
-            fromfile="previous_version",
-            tofile="current_version",
-            lineterm="",
-        )
-        # print("\n".join(diff))
+        start = time.perf_counter()
+        stat = self._stat(file_path)
+        if self._same_stat(entry, stat):
+            # e.g. a modify event for a metadata change only
+            self.unchanged += 1
+            return []
+
+        previous_content = self._lines(file_path)
+        if previous_content is None:
+            self.misses += 1
+            print(f"Content of '{file_path}' was evicted, no diff available.")
+            return
+        self.hits += 1
+        try:
+            current_content = self._read_file(file_path)
+        except UnicodeDecodeError:
+            print(f"File '{file_path}' is binary now, no diff available.")
+            if update:
+                self.update_cache(file_path)
+            return
+        data = "".join(current_content).encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+
+        if digest == entry.digest:
+            # rewritten with the same content
+            self.unchanged += 1
+            diff = []
+        else:
+            if not previous_content:
+                print(f"No previous content to compare for file '{file_path}'.")
+                # add it to the diff just in case...
+                self.add_file(file_path)
+
+            diff, info = unified_diff(
+                previous_content,
+                current_content,
+                fromfile="previous_version",
+                tofile="current_version",
+                lineterm="",
+                large_lines=self.large_lines,
+            )
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.diffs += 1
+                self.large_diffs += info["large"]
+                self.diff_seconds += elapsed
+                self.max_diff_seconds = max(self.max_diff_seconds, elapsed)
+
+        if update:
+            self._store(file_path, stat, current_content, data, digest)
         return diff
+
+    def get_delta(self, file_path: str, update: bool = False) -> list | None:
+        """
+        Creates the delta of a binary file against its cached version,
+        see delta.encode for the instructions.
+        Returns None if the file is not monitored, its signature was
+        evicted or the delta would be too large.
+        :param file_path: Path to the file to generate the delta for.
+        :param update: Cache the current content afterwards.
+        """
+        entry = self._entries.get(file_path)
+        if entry is None:
+            print(f"File '{file_path}' is not being monitored.")
+            return
+
+        start = time.perf_counter()
+        stat = self._stat(file_path)
+        if self._same_stat(entry, stat):
+            self.unchanged += 1
+            return []
+
+        base_signature = entry.signature
+        if base_signature is None:
+            self.misses += 1
+            print(f"Content of '{file_path}' was evicted, no delta available.")
+            return
+        self.hits += 1
+        data = self._read_bytes(file_path)
+        digest = hashlib.sha256(data).hexdigest()
+
+        if digest == entry.digest:
+            self.unchanged += 1
+            instructions = []
+            signature = base_signature
+        else:
+            instructions, signature = delta.encode(base_signature, data)
+            if delta.inserted_bytes(instructions) > self.max_delta_bytes:
+                print(f"Delta of '{file_path}' is too large.")
+                instructions = None
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.deltas += 1
+                self.diff_seconds += elapsed
+                self.max_diff_seconds = max(self.max_diff_seconds, elapsed)
+
+        if update:
+            self._store_binary(file_path, stat, signature, digest)
+        return instructions
+
+    def get_content(self, file_path: str, update: bool = False) -> bytes | None:
+        """
+        Read the whole content of a monitored binary file, for a receiver
+        without its previous version. Returns None if it is not monitored.
+        :param update: Cache the content as the base of the next delta.
+        """
+        if file_path not in self._entries:
+            print(f"File '{file_path}' is not being monitored.")
+            return
+        stat = self._stat(file_path)
+        if stat is None:
+            return
+        data = self._read_bytes(file_path)
+        if update:
+            digest = hashlib.sha256(data).hexdigest()
+            self._store_binary(file_path, stat, delta.signature(data), digest)
+        return data
+
+    def stats(self) -> dict:
+        """Return the size and hit rate of the cache."""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "resident": len(self._lru),
+                "compressed": len(self._lru) - len(self._hot),
+                "resident_bytes": self.resident_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "compressions": self.compressions,
+                "loads": self.loads,
+                "unchanged": self.unchanged,
+                "diffs": self.diffs,
+                "large_diffs": self.large_diffs,
+                "deltas": self.deltas,
+                "diff_seconds": self.diff_seconds,
+                "max_diff_seconds": self.max_diff_seconds,
+            }
+
+    def close(self) -> None:
+        """Write the state of the persistent store."""
+        if self.store is not None:
+            self.store.close()
@@ -0,0 +1,209 @@
+"""Coalesce bursts of file system events into their net effect"""
+
+import threading
+import time
+
+# net event type after a second event for the same path, None: no change
+NET_EFFECT = {
+    ("created", "created"): "created",
+    ("created", "modified"): "created",
+    ("created", "deleted"): None,
+    ("modified", "created"): "modified",
+    ("modified", "modified"): "modified",
+    ("modified", "deleted"): "deleted",
+    # a file replaced within the window, e.g. an editor's atomic save
+    ("deleted", "created"): "modified",
+    ("deleted", "modified"): "modified",
+    ("deleted", "deleted"): "deleted",
+}
+
+
+class CoalescedEvent:
+    """The net effect of one or more raw events for a single path."""
+
+    __slots__ = (
+        "event_type",
+        "path",
+        "source",
+        "modified",
+        "count",
+        "first_seen",
+        "last_seen",
+    )
+
+    def __init__(self, event_type: str, path: str, now: float, source=None):
+        self.event_type = event_type
+        self.path = path
+        # source path of a move, path is the destination
+        self.source = source
+        # the file was also modified after it was moved
+        self.modified = False
+        # number of raw events merged into this one
+        self.count = 1
+        self.first_seen = now
+        self.last_seen = now
+
+
+class EventCoalescer:
+    """
+    Collects raw events per path until no further event arrived for
+    quiet_window seconds, then hands out their net effect: repeated
+    modifications become a single one, a file created and modified
+    is reported as created, a file created and deleted not at all.
+    Events are handed out after max_delay seconds at the latest, even
+    if the path keeps changing.
+
+    Events are added from the observer thread and taken from the
+    event loop, so all access is guarded by a lock.
+    """
+
+    def __init__(self, quiet_window: float = 0.5, max_delay: float = 5.0):
+        self.quiet_window = quiet_window
+        self.max_delay = max_delay
+        # path -> pending event, in the order the paths changed first
+        self.pending = {}
+        self._lock = threading.Lock()
+        # statistics
+        self.received = 0
+        self.emitted = 0
+        self.cancelled = 0
+
+    def add(self, event_type: str, path: str, now: float | None = None) -> None:
+        """Add a created, modified or deleted event."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self.received += 1
+            self._merge(event_type, path, now, 1, now)
+
+    def _merge(self, event_type, path, now, count, first_seen) -> None:
+        event = self.pending.get(path)
+        if event is None:
+            event = self.pending[path] = CoalescedEvent(event_type, path, now)
+            event.count = count
+            event.first_seen = first_seen
+            return
+
+        event.count += count
+        event.last_seen = now
+        if event.event_type == "moved":
+            if event_type != "deleted":
+                event.modified = True
+                return
+            # moved and deleted afterwards: the source is gone
+            del self.pending[path]
+            self._merge("deleted", event.source, now, event.count, event.first_seen)
+            return
+
+        net = NET_EFFECT[(event.event_type, event_type)]
+        if net is None:
+            del self.pending[path]
+            self.cancelled += event.count
+        else:
+            event.event_type = net
+
+    def move(self, source: str, destination: str, now: float | None = None) -> None:
+        """Add a moved event."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self.received += 1
+            previous = self.pending.pop(source, None)
+            replaced = self.pending.pop(destination, None)
+            if previous is not None and previous.event_type in ("created", "moved"):
+                # created and moved: the file was created at the destination,
+                # moved twice: a single move from the first source
+                event = previous
+                event.path = destination
+                event.count += 1
+            else:
+                event = CoalescedEvent("moved", destination, now, source=source)
+                if previous is not None:
+                    # modifications before the move are reported afterwards
+                    event.modified = previous.event_type != "deleted"
+                    event.count += previous.count
+                    event.first_seen = previous.first_seen
+            if replaced is not None and replaced.event_type == "moved":
+                # overwritten after a move, the source of that move is gone
+                self._moved_away(replaced, now)
+            elif replaced is not None:
+                # the overwritten file's pending changes are gone with it
+                event.count += replaced.count
+            event.last_seen = now
+            self.pending[destination] = event
+
+    def _moved_away(self, event: CoalescedEvent, now: float) -> None:
+        """Report the source of a dropped move as deleted."""
+        later = self.pending.get(event.source)
+        if later is None:
+            self._merge("deleted", event.source, now, event.count, event.first_seen)
+        elif later.event_type != "moved":
+            # a new file at the source, it replaced the moved one
+            later.event_type = NET_EFFECT[("deleted", later.event_type)]
+            later.count += event.count
+            later.first_seen = min(later.first_seen, event.first_seen)
+
+    def move_tree(self, source: str, destination: str) -> None:
+        """Follow a directory move with the pending events below it."""
+        prefix = source + "/"
+        with self._lock:
+            self.received += 1
+            for path in [path for path in self.pending if path.startswith(prefix)]:
+                event = self.pending.pop(path)
+                event.path = destination + path[len(source) :]
+                self.pending[event.path] = event
+
+    def remove_tree(self, directory: str, now: float | None = None) -> None:
+        """
+        Drop the pending changes below a deleted directory, the files are
+        reported deleted with the directory. Deletes already seen for
+        single files are kept.
+        """
+        now = time.monotonic() if now is None else now
+        prefix = directory + "/"
+        with self._lock:
+            self.received += 1
+            for path in [path for path in self.pending if path.startswith(prefix)]:
+                event = self.pending[path]
+                if event.event_type == "deleted":
+                    continue
+                del self.pending[path]
+                if event.event_type == "moved" and not event.source.startswith(prefix):
+                    # moved into the directory: the source is gone
+                    self._merge(
+                        "deleted",
+                        event.source,
+                        now,
+                        event.count,
+                        event.first_seen,
+                    )
+                else:
+                    self.cancelled += event.count
+
+    def pop_ready(self, now: float | None = None) -> list[CoalescedEvent]:
+        """Remove and return all events whose quiet window has passed."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            ready = [
+                event
+                for event in self.pending.values()
+                if now - event.last_seen >= self.quiet_window
+                or now - event.first_seen >= self.max_delay
+            ]
+            for event in ready:
+                del self.pending[event.path]
+            self.emitted += len(ready)
+        return ready
+
+    @property
+    def tick(self) -> float:
+        """Interval in which pending events should be checked."""
+        return max(self.quiet_window / 2, 0.01)
+
+    def stats(self) -> dict:
+        """Return the number of received, emitted and cancelled events."""
+        with self._lock:
+            return {
+                "pending": len(self.pending),
+                "received": self.received,
+                "emitted": self.emitted,
+                "cancelled": self.cancelled,
+            }
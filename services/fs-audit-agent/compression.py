@@ -0,0 +1,156 @@
+"""Compression of diffs with preset dictionaries shared with the recorder"""
+
+import collections
+import hashlib
+import json
+import os
+import zlib
+
+# diffs smaller than this, JSON encoded, are not worth compressing
+MIN_SIZE = 256
+# zlib only looks back 32 KiB, a larger dictionary is not used
+DICTIONARY_SIZE = 32 * 1024
+DICTIONARY_SUFFIX = ".dict"
+# used for files without a dictionary of their own, the headers of every
+# diff are not repeated within a single one
+BUILTIN_DICTIONARY = b'["--- previous_version", "+++ current_version", "@@ -'
+
+
+def dictionary_id(dictionary: bytes) -> str:
+    """Identify a dictionary by its content, agent and recorder agree on it."""
+    return hashlib.sha256(dictionary).hexdigest()[:16]
+
+
+def train(samples: list[str], size: int = DICTIONARY_SIZE) -> bytes:
+    """
+    Build a dictionary for a file type from sample contents: its most
+    common lines as they appear in a JSON encoded diff. zlib finds
+    matches closer to the end cheaper, so the most common lines go last.
+    """
+    counts = collections.Counter(
+        line for sample in samples for line in sample.splitlines(keepends=True)
+    )
+    parts = []
+    total = len(BUILTIN_DICTIONARY)
+    for line, count in counts.most_common():
+        if count < 2:
+            break
+        part = json.dumps(line)[1:-1].encode("utf-8") + b'", "'
+        if total + len(part) > size:
+            break
+        parts.append(part)
+        total += len(part)
+    return BUILTIN_DICTIONARY + b"".join(reversed(parts))
+
+
+def load_dictionaries(directory: str) -> dict[str, bytes]:
+    """Load the dictionaries of a directory by the file suffix they are for."""
+    dictionaries = {}
+    if not os.path.isdir(directory):
+        return dictionaries
+    for name in os.listdir(directory):
+        if name.endswith(DICTIONARY_SUFFIX):
+            with open(os.path.join(directory, name), "rb") as f:
+                dictionaries["." + name[: -len(DICTIONARY_SUFFIX)]] = f.read()
+    return dictionaries
+
+
+class DiffCompressor:
+    """
+    Compresses diffs with zlib and a preset dictionary chosen by the
+    suffix of the file, or the built-in one. The encoding names the
+    dictionary ("zlib:<dictionary id>"), so the recorder can expand the
+    diff with the same dictionary.
+    """
+
+    def __init__(
+        self,
+        dictionaries: dict[str, bytes] | None = None,
+        min_size: int = MIN_SIZE,
+        level: int = 6,
+    ):
+        self.dictionaries = dict(dictionaries or {})
+        self.min_size = min_size
+        self.level = level
+        self._ids = {
+            suffix: dictionary_id(dictionary)
+            for suffix, dictionary in self.dictionaries.items()
+        }
+        self._builtin_id = dictionary_id(BUILTIN_DICTIONARY)
+        # statistics, updated by the diff workers without a lock
+        self.diffs = 0
+        self.compressed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def compress(self, path: str, diff: list[str]) -> tuple[str, bytes] | None:
+        """
+        Return the encoding and the compressed diff, or None if the diff
+        is too small or does not get smaller.
+        """
+        self.diffs += 1
+        data = json.dumps(diff).encode("utf-8")
+        if len(data) < self.min_size:
+            return None
+        suffix = os.path.splitext(path)[1]
+        dictionary = self.dictionaries.get(suffix, BUILTIN_DICTIONARY)
+        dictionary_id = self._ids.get(suffix, self._builtin_id)
+        compressor = zlib.compressobj(self.level, zdict=dictionary)
+        compressed = compressor.compress(data) + compressor.flush()
+        if len(compressed) >= len(data):
+            return None
+        self.compressed += 1
+        self.bytes_in += len(data)
+        self.bytes_out += len(compressed)
+        return f"zlib:{dictionary_id}", compressed
+
+    def stats(self) -> dict:
+        return {
+            "diffs": self.diffs,
+            "compressed": self.compressed,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+        }
+
+
+def decompress(
+    encoding: str,
+    data: bytes,
+    dictionaries: dict[str, bytes],
+) -> list[str]:
+    """Expand a compressed diff, dictionaries are given by their id."""
+    method, _, dictionary = encoding.partition(":")
+    if method != "zlib":
+        raise ValueError(f"Unknown diff compression {encoding}")
+    if dictionary:
+        if dictionary == dictionary_id(BUILTIN_DICTIONARY):
+            zdict = BUILTIN_DICTIONARY
+        elif dictionary in dictionaries:
+            zdict = dictionaries[dictionary]
+        else:
+            raise ValueError(f"Unknown compression dictionary {dictionary}")
+        decompressor = zlib.decompressobj(zdict=zdict)
+    else:
+        decompressor = zlib.decompressobj()
+    return json.loads(decompressor.decompress(data) + decompressor.flush())
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="train a diff dictionary")
+    parser.add_argument("-s", type=str, help="file suffix, e.g. .conf", required=True)
+    parser.add_argument("-o", type=str, help="dictionary directory", default=".")
+    parser.add_argument("samples", nargs="+", help="sample files of the type")
+
+    args = parser.parse_args()
+    samples = []
+    for sample in args.samples:
+        with open(sample, encoding="utf-8", errors="replace") as f:
+            samples.append(f.read())
+    dictionary = train(samples)
+    os.makedirs(args.o, exist_ok=True)
+    path = os.path.join(args.o, args.s.lstrip(".") + DICTIONARY_SUFFIX)
+    with open(path, "wb") as f:
+        f.write(dictionary)
+    print(f"Wrote {path} ({len(dictionary)} bytes, id {dictionary_id(dictionary)})")
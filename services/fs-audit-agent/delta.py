@@ -0,0 +1,97 @@
+"""Binary deltas against content defined chunks, rsync style"""
+
+import base64
+import hashlib
+import re
+
+MIN_CHUNK = 2048
+MAX_CHUNK = 65536
+# a chunk ends behind MIN_CHUNK bytes at the first pair of a byte with the
+# low nibble 0xa and one with 0x5 (1/256 of the positions of random data),
+# or in front of 16 zero bytes; runs of zeros are chunks of their own.
+# The re module finds the boundaries at C speed, a rolling hash computed
+# byte by byte in Python would take seconds for every 100 MB.
+_FIRST = b"".join(b"\\x%02x" % (high << 4 | 0xA) for high in range(16))
+_SECOND = b"".join(b"\\x%02x" % (high << 4 | 0x5) for high in range(16))
+_CHUNK = re.compile(
+    rb"\x00{16,%d}|.{%d,%d}?[%s\x00](?:(?<=[%s])[%s]|\x00{15})|.{1,%d}"
+    % (MAX_CHUNK, MIN_CHUNK, MAX_CHUNK, _FIRST, _FIRST, _SECOND, MAX_CHUNK + 16),
+    re.DOTALL,
+)
+
+
+def _digest(chunk: bytes) -> bytes:
+    return hashlib.blake2b(chunk, digest_size=16).digest()
+
+
+def chunks(data: bytes):
+    """Yield start and end of the content defined chunks of data."""
+    for match in _CHUNK.finditer(data):
+        yield match.span()
+
+
+def signature(data: bytes) -> dict[bytes, tuple[int, int]]:
+    """Map the hash of every chunk of data to its offset and length."""
+    result = {}
+    for start, end in chunks(data):
+        result.setdefault(_digest(data[start:end]), (start, end - start))
+    return result
+
+
+def encode(
+    base_signature: dict[bytes, tuple[int, int]],
+    data: bytes,
+) -> tuple[list, dict[bytes, tuple[int, int]]]:
+    """
+    Return the instructions rebuilding data from the base version with
+    the given signature, and the signature of data. An instruction is
+    either (offset, length) to copy from the base or the base64 encoded
+    bytes to insert.
+    """
+    instructions = []
+    new_signature = {}
+    copy = None
+    insert = []
+    for start, end in chunks(data):
+        chunk = data[start:end]
+        digest = _digest(chunk)
+        new_signature.setdefault(digest, (start, end - start))
+        found = base_signature.get(digest)
+        if found is None:
+            if copy is not None:
+                instructions.append(tuple(copy))
+                copy = None
+            insert.append(chunk)
+            continue
+        if insert:
+            instructions.append(base64.b64encode(b"".join(insert)).decode("ascii"))
+            insert = []
+        offset, length = found
+        if copy is not None and copy[0] + copy[1] == offset:
+            copy[1] += length
+            continue
+        if copy is not None:
+            instructions.append(tuple(copy))
+        copy = [offset, length]
+    if copy is not None:
+        instructions.append(tuple(copy))
+    if insert:
+        instructions.append(base64.b64encode(b"".join(insert)).decode("ascii"))
+    return instructions, new_signature
+
+
+def inserted_bytes(instructions: list) -> int:
+    """Size of the data carried by the instructions themselves."""
+    return sum(len(item) for item in instructions if isinstance(item, str))
+
+
+def apply(base: bytes, instructions: list) -> bytes:
+    """Rebuild a version from its base and the instructions of encode()."""
+    parts = []
+    for item in instructions:
+        if isinstance(item, str):
+            parts.append(base64.b64decode(item))
+        else:
+            offset, length = item
+            parts.append(base[offset : offset + length])
+    return b"".join(parts)
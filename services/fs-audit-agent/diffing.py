@@ -0,0 +1,236 @@
+"""Unified diffs of large files, localized by block hashes"""
+
+import difflib
+
+# a block of lines ends after a line whose hash has these bits unset
+BLOCK_MASK = 31
+MAX_BLOCK_LINES = 256
+# files with fewer lines are diffed line by line right away
+MIN_BLOCK_DIFF_LINES = 1024
+
+
+def _blocks(lines: list[str]) -> tuple[list[int], list[int]]:
+    """
+    Split lines into blocks at content defined boundaries, so an inserted
+    line only changes the block it is inserted into. Returns the start
+    of every block (plus the end) and the hash of each block.
+    """
+    starts = [0]
+    hashes = []
+    start = 0
+    for i, line in enumerate(lines, 1):
+        if not hash(line) & BLOCK_MASK or i - start >= MAX_BLOCK_LINES:
+            hashes.append(hash(tuple(lines[start:i])))
+            starts.append(i)
+            start = i
+    if start < len(lines):
+        hashes.append(hash(tuple(lines[start:])))
+        starts.append(len(lines))
+    return starts, hashes
+
+
+def _patience(a, alo, ahi, b, blo, bhi, opcodes) -> None:
+    """
+    Near linear diff of a[alo:ahi] and b[blo:bhi] for large regions:
+    lines occurring exactly once on both sides serve as anchors, the
+    longest increasing run of anchors is kept and the gaps between them
+    are diffed the same way.
+    """
+    tasks = [(alo, ahi, blo, bhi)]
+    while tasks:
+        task = tasks.pop()
+        if task[0] == "equal":
+            opcodes.append(task)
+            continue
+        alo, ahi, blo, bhi = task
+        # strip common lines at both ends
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            opcodes.append(("equal", alo, alo + 1, blo, blo + 1))
+            alo += 1
+            blo += 1
+        tail = []
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+            tail.append(("equal", ahi, ahi + 1, bhi, bhi + 1))
+        tail.reverse()
+
+        if alo == ahi or blo == bhi:
+            if alo < ahi:
+                opcodes.append(("delete", alo, ahi, blo, blo))
+            elif blo < bhi:
+                opcodes.append(("insert", alo, alo, blo, bhi))
+            opcodes.extend(tail)
+            continue
+
+        counts = {}
+        for i in range(alo, ahi):
+            entry = counts.setdefault(a[i], [0, 0, i])
+            entry[0] += 1
+        for j in range(blo, bhi):
+            entry = counts.get(b[j])
+            if entry is not None:
+                entry[1] += 1
+                entry.append(j)
+        anchors = sorted(
+            (entry[2], entry[3])
+            for entry in counts.values()
+            if entry[0] == 1 and entry[1] == 1
+        )
+        anchors = _longest_increasing(anchors)
+        if not anchors:
+            opcodes.append(("replace", alo, ahi, blo, bhi))
+            opcodes.extend(tail)
+            continue
+
+        # push in reverse, the stack hands them out in order
+        pending = []
+        i, j = alo, blo
+        for ai, bj in anchors:
+            pending.append((i, ai, j, bj))
+            pending.append(("equal", ai, ai + 1, bj, bj + 1))
+            i, j = ai + 1, bj + 1
+        pending.append((i, ahi, j, bhi))
+        pending.extend(tail)
+        tasks.extend(reversed(pending))
+
+
+def _longest_increasing(pairs: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    """Longest subsequence of pairs (sorted by first) increasing in second."""
+    tails = []
+    tail_index = []
+    previous = [None] * len(pairs)
+    for index, (_, j) in enumerate(pairs):
+        low, high = 0, len(tails)
+        while low < high:
+            middle = (low + high) // 2
+            if tails[middle] < j:
+                low = middle + 1
+            else:
+                high = middle
+        if low:
+            previous[index] = tail_index[low - 1]
+        if low == len(tails):
+            tails.append(j)
+            tail_index.append(index)
+        else:
+            tails[low] = j
+            tail_index[low] = index
+    result = []
+    index = tail_index[-1] if tail_index else None
+    while index is not None:
+        result.append(pairs[index])
+        index = previous[index]
+    result.reverse()
+    return result
+
+
+def _diff_region(a, alo, ahi, b, blo, bhi, opcodes, large_lines) -> bool:
+    """Diff a region line by line, returns True if it was a large one."""
+    if (ahi - alo) + (bhi - blo) > large_lines:
+        _patience(a, alo, ahi, b, blo, bhi, opcodes)
+        return True
+    matcher = difflib.SequenceMatcher(None, a[alo:ahi], b[blo:bhi])
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        opcodes.append((tag, alo + i1, alo + i2, blo + j1, blo + j2))
+    return False
+
+
+def _merge(opcodes: list[tuple]) -> list[tuple]:
+    """Join adjacent opcodes, as difflib would have produced them."""
+    merged = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        if i1 == i2 and j1 == j2:
+            continue
+        if merged and (merged[-1][0] == "equal") == (tag == "equal"):
+            last_tag, li1, _, lj1, _ = merged[-1]
+            merged[-1] = (tag if tag == last_tag else "replace", li1, i2, lj1, j2)
+            continue
+        merged.append((tag, i1, i2, j1, j2))
+    return merged
+
+
+def _format_range(start: int, stop: int) -> str:
+    """Line range of a hunk header, like difflib's private helper."""
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return f"{beginning}"
+    if not length:
+        # an empty range begins at the line before it
+        beginning -= 1
+    return f"{beginning},{length}"
+
+
+class _Opcodes(difflib.SequenceMatcher):
+    """SequenceMatcher handing out precomputed opcodes for grouping."""
+
+    def __init__(self, opcodes: list[tuple]):
+        super().__init__(None, [], [])
+        self.opcodes = opcodes
+
+
+def diff_opcodes(a: list[str], b: list[str], large_lines: int) -> tuple[list, dict]:
+    """
+    Return the opcodes turning a into b and some details about the work.
+    Small files are compared line by line with difflib. In larger files
+    the blocks present on both sides are skipped and only the changed
+    regions are diffed, regions above large_lines with a near linear
+    algorithm instead of difflib.
+    """
+    info = {"blocks": 0, "changed_lines": len(a) + len(b), "large": False}
+    opcodes = []
+    if len(a) + len(b) < MIN_BLOCK_DIFF_LINES:
+        info["large"] = _diff_region(a, 0, len(a), b, 0, len(b), opcodes, large_lines)
+        return _merge(opcodes), info
+
+    a_starts, a_hashes = _blocks(a)
+    b_starts, b_hashes = _blocks(b)
+    info["blocks"] = len(a_hashes) + len(b_hashes)
+    matcher = difflib.SequenceMatcher(None, a_hashes, b_hashes, autojunk=False)
+    changed = 0
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        alo, ahi = a_starts[i1], a_starts[i2]
+        blo, bhi = b_starts[j1], b_starts[j2]
+        if tag == "equal" and a[alo:ahi] == b[blo:bhi]:
+            opcodes.append(("equal", alo, ahi, blo, bhi))
+            continue
+        changed += (ahi - alo) + (bhi - blo)
+        if _diff_region(a, alo, ahi, b, blo, bhi, opcodes, large_lines):
+            info["large"] = True
+    info["changed_lines"] = changed
+    return _merge(opcodes), info
+
+
+def unified_diff(
+    a: list[str],
+    b: list[str],
+    fromfile: str = "",
+    tofile: str = "",
+    n: int = 3,
+    lineterm: str = "\n",
+    large_lines: int = 2000,
+) -> tuple[list[str], dict]:
+    """
+    Same output format as difflib.unified_diff, but computed with
+    diff_opcodes. Returns the diff lines and the details of the work.
+    """
+    opcodes, info = diff_opcodes(a, b, large_lines)
+    lines = []
+    for group in _Opcodes(opcodes).get_grouped_opcodes(n):
+        if not lines:
+            lines.append(f"--- {fromfile}{lineterm}")
+            lines.append(f"+++ {tofile}{lineterm}")
+        first, last = group[0], group[-1]
+        file1_range = _format_range(first[1], last[2])
+        file2_range = _format_range(first[3], last[4])
+        lines.append(f"@@ -{file1_range} +{file2_range} @@{lineterm}")
+        for tag, i1, i2, j1, j2 in group:
+            if tag == "equal":
+                lines.extend(" " + line for line in a[i1:i2])
+                continue
+            if tag in ("replace", "delete"):
+                lines.extend("-" + line for line in a[i1:i2])
+            if tag in ("replace", "insert"):
+                lines.extend("+" + line for line in b[j1:j2])
+    return lines, info
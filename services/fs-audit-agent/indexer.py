@@ -0,0 +1,127 @@
+"""Parallel background indexing of the watched tree into the diff cache"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import FSOFileDiff
+from rules import CompiledRule
+
+
+class CacheIndexer:
+    """
+    Walks a directory tree with os.scandir and adds files to the cache.
+
+    Every directory is scanned as a task of a thread pool, subdirectories
+    are submitted as new tasks, so the walk fans out over all workers.
+    Excluded subtrees are not entered. By default only important files
+    are cached, the others never get a diff anyway.
+    """
+
+    def __init__(
+        self,
+        rules: CompiledRule,
+        cache: FSOFileDiff,
+        workers: int = 8,
+        important_only: bool = True,
+    ):
+        self.rules = rules
+        self.cache = cache
+        self.workers = workers
+        self.important_only = important_only
+        self._pool = None
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        # directories submitted but not scanned yet
+        self._pending = 0
+        # statistics
+        self.directories = 0
+        self.files = 0
+        self.indexed = 0
+        self.errors = 0
+        self.started = None
+        self.finished = None
+
+    def start(self, root: str) -> None:
+        """Start indexing in the background and return right away."""
+        self.started = time.monotonic()
+        self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix="fso-index")
+        self._submit(root)
+
+    def wait(self, timeout: float | None = None) -> bool:
+        """Wait until the whole tree was indexed."""
+        return self._done.wait(timeout)
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def _submit(self, directory: str) -> None:
+        with self._lock:
+            self._pending += 1
+        self._pool.submit(self._scan, directory)
+
+    def _scan(self, directory: str) -> None:
+        files = indexed = errors = 0
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if not self.rules.excludes_tree(entry.path):
+                                self._submit(entry.path)
+                            continue
+                        if not entry.is_file():
+                            continue
+                    except OSError:
+                        errors += 1
+                        continue
+                    files += 1
+                    path = entry.path
+                    if self.rules.is_excluded(path):
+                        continue
+                    if self.important_only and not self.rules.is_important(path):
+                        continue
+                    try:
+                        self.cache.add_file(path, quiet=True)
+                    except OSError:
+                        # e.g. not readable, the other files are still indexed
+                        errors += 1
+                        continue
+                    indexed += 1
+        except OSError as e:
+            print(f"Failed to index {directory}: {e}")
+            errors += 1
+        finally:
+            with self._lock:
+                self.directories += 1
+                self.files += files
+                self.indexed += indexed
+                self.errors += errors
+                self._pending -= 1
+                finished = self._pending == 0
+            if finished:
+                self.finished = time.monotonic()
+                self._pool.shutdown(wait=False)
+                self._done.set()
+                print(
+                    f"Indexed {self.indexed} of {self.files} files in "
+                    f"{self.finished - self.started:.1f}s.",
+                )
+
+    def progress(self) -> dict:
+        """Return the progress of the indexing and its speed."""
+        with self._lock:
+            end = self.finished or time.monotonic()
+            elapsed = end - self.started if self.started else 0.0
+            return {
+                "done": self.done,
+                "directories": self.directories,
+                "pending_directories": self._pending,
+                "files": self.files,
+                "indexed": self.indexed,
+                "errors": self.errors,
+                "elapsed": elapsed,
+                "files_per_second": self.files / elapsed if elapsed else 0.0,
+            }
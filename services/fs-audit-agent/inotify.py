@@ -0,0 +1,295 @@
+"""Linux inotify observer reading and dispatching events in batches"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import threading
+import time
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_ONLYDIR
+    | IN_DONT_FOLLOW
+)
+# struct inotify_event: wd, mask, cookie, length of the name behind it
+EVENT = struct.Struct("iIII")
+
+
+def _libc():
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+
+class InotifyObserver:
+    """
+    Observer backend using inotify directly, for busy Linux hosts.
+
+    All pending events are read from the inotify fd with one call into a
+    reused buffer and decoded with struct. Each read is handed to the
+    handler as one batch of raw events (see FileHandler.submit_batch),
+    directory moves and deletes included. Excluded subtrees are not
+    watched at all.
+
+    If the kernel queue overflowed, events were lost: the watches are
+    completed and the handler rescans the tree for important files whose
+    size or mtime differ from the cache.
+
+    A rename whose moved from and moved to events end up in different
+    reads is still reported as a move: events from a moved from event
+    on are held back for move_window seconds until its moved to event
+    arrived. Without one, the file was moved out of the tree.
+    """
+
+    def __init__(
+        self,
+        buffer_size: int = 1024 * 1024,
+        timeout: float = 0.5,
+        batch_delay: float = 0.005,
+        move_window: float = 0.05,
+    ):
+        self.buffer = bytearray(buffer_size)
+        self.timeout = timeout
+        # wait a moment for more events once the first one arrived
+        self.batch_delay = batch_delay
+        self.move_window = move_window
+        self.handler = None
+        self.path = None
+        self._libc = _libc()
+        self._fd = None
+        # watch descriptor <-> directory
+        self._paths = {}
+        self._watches = {}
+        # raw events held back behind a moved from event, the cookies of
+        # those events with their index and the time they were read
+        self._held = []
+        self._held_from = {}
+        self._held_since = 0.0
+        self._stopped = threading.Event()
+        self._thread = None
+        # statistics
+        self.reads = 0
+        self.events = 0
+        self.overflows = 0
+
+    def schedule(self, handler, path: str, recursive: bool = True) -> None:
+        """Watch path and all directories below it for the handler."""
+        self.handler = handler
+        self.path = os.path.abspath(path)
+
+    def start(self) -> None:
+        fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._fd = fd
+        self._add_tree(self.path)
+        self._thread = threading.Thread(
+            target=self._run,
+            name="fso-inotify",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def join(self, timeout: float | None = None) -> None:
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _add_watch(self, directory: str) -> None:
+        wd = self._libc.inotify_add_watch(
+            self._fd,
+            os.fsencode(directory),
+            WATCH_MASK,
+        )
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error != errno.ENOENT:
+                # e.g. out of watches, see fs.inotify.max_user_watches
+                print(f"Failed to watch {directory}: {os.strerror(error)}")
+            return
+        self._paths[wd] = directory
+        self._watches[directory] = wd
+
+    def _add_tree(self, root: str, created: list | None = None) -> None:
+        """
+        Watch a directory and all directories below it. With created,
+        files found there are collected as created: they may have been
+        written before the watch existed. Excluded trees are skipped.
+        """
+        if self.handler.rules.excludes_tree(root):
+            return
+        stack = [root]
+        while stack:
+            directory = stack.pop()
+            self._add_watch(directory)
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            if not self.handler.rules.excludes_tree(entry.path):
+                                stack.append(entry.path)
+                        elif created is not None:
+                            created.append(("created", entry.path, None))
+            except OSError:
+                continue
+
+    def _forget_tree(self, directory: str) -> None:
+        """Remove the watches of a directory moved out of the tree."""
+        prefix = directory + "/"
+        for path in [path for path in self._watches if path.startswith(prefix)] + [
+            directory,
+        ]:
+            wd = self._watches.pop(path, None)
+            if wd is not None:
+                del self._paths[wd]
+                self._libc.inotify_rm_watch(self._fd, wd)
+
+    def _move_tree(self, source: str, destination: str) -> None:
+        """Follow a directory moved within the tree with its watches."""
+        prefix = source + "/"
+        for path in [path for path in self._watches if path.startswith(prefix)] + [
+            source,
+        ]:
+            wd = self._watches.pop(path, None)
+            if wd is not None:
+                path = destination + path[len(source) :]
+                self._paths[wd] = path
+                self._watches[path] = wd
+
+    def _run(self) -> None:
+        poll = select.poll()
+        poll.register(self._fd, select.POLLIN)
+        view = memoryview(self.buffer)
+        while not self._stopped.is_set():
+            timeout = self.move_window if self._held else self.timeout
+            if not poll.poll(timeout * 1000):
+                if self._held:
+                    self.handler.submit_batch(self._moved_out())
+                continue
+            if self.batch_delay:
+                self._stopped.wait(self.batch_delay)
+            try:
+                size = os.readv(self._fd, [self.buffer])
+            except BlockingIOError:
+                continue
+            self.reads += 1
+            batch, overflow = self._decode(view, size)
+            if batch:
+                self.handler.submit_batch(batch)
+            if overflow:
+                self.overflows += 1
+                print("Inotify queue overflowed, rescanning for lost events.")
+                self.handler.rescan(self.path, self._add_watch)
+        if self._held:
+            self.handler.submit_batch(self._moved_out())
+
+    def _decode(self, view: memoryview, size: int) -> tuple[list, bool]:
+        """Turn the events in the buffer into raw events for the handler."""
+        held = bool(self._held)
+        if held and time.monotonic() - self._held_since >= self.move_window:
+            batch, moved_from, held = self._moved_out(), {}, False
+        else:
+            # cookie -> index of a moved from event in the batch
+            batch, moved_from = self._held, self._held_from
+            self._held, self._held_from = [], {}
+        overflow = False
+        offset = 0
+        while offset < size:
+            wd, mask, cookie, length = EVENT.unpack_from(view, offset)
+            offset += EVENT.size
+            name = bytes(view[offset : offset + length]).rstrip(b"\0")
+            offset += length
+            self.events += 1
+
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            if mask & IN_IGNORED:
+                directory = self._paths.pop(wd, None)
+                if directory is not None and self._watches.get(directory) == wd:
+                    del self._watches[directory]
+                continue
+            directory = self._paths.get(wd)
+            if directory is None or not name:
+                # IN_DELETE_SELF of a watch, reported by its parent
+                continue
+            path = os.path.join(directory, os.fsdecode(name))
+            is_dir = mask & IN_ISDIR
+
+            if mask & IN_MOVED_FROM:
+                moved_from[cookie] = len(batch)
+                batch.append(("deleted_dir" if is_dir else "deleted", path, None))
+            elif mask & IN_MOVED_TO:
+                index = moved_from.pop(cookie, None)
+                if index is None:
+                    # moved in from outside the tree
+                    if is_dir:
+                        self._add_tree(path, batch)
+                    else:
+                        batch.append(("created", path, None))
+                    continue
+                source = batch[index][1]
+                if is_dir:
+                    self._move_tree(source, path)
+                batch[index] = ("moved_dir" if is_dir else "moved", source, path)
+            elif mask & IN_CREATE:
+                if is_dir:
+                    self._add_tree(path, batch)
+                else:
+                    batch.append(("created", path, None))
+            elif mask & IN_DELETE:
+                batch.append(("deleted_dir" if is_dir else "deleted", path, None))
+            elif mask & (IN_MODIFY | IN_ATTRIB) and not is_dir:
+                batch.append(("modified", path, None))
+
+        if moved_from:
+            # the moved to events may come with the next read
+            first = min(moved_from.values())
+            self._held = batch[first:]
+            self._held_from = {
+                cookie: index - first for cookie, index in moved_from.items()
+            }
+            if not held:
+                self._held_since = time.monotonic()
+            batch = batch[:first]
+        return batch, overflow
+
+    def _moved_out(self) -> list:
+        """Hand out the held events, unmatched moves left the tree."""
+        batch = self._held
+        for index in self._held_from.values():
+            # the watches went with the directory
+            event_type, path, _ = batch[index]
+            if event_type == "deleted_dir":
+                self._forget_tree(path)
+        self._held, self._held_from = [], {}
+        return batch
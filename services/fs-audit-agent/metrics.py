@@ -0,0 +1,160 @@
+"""Latency histograms, counters and a sampling profiler for the agent"""
+
+import collections
+import os
+import sys
+import threading
+import time
+
+# bucket i holds durations below 2**i nanoseconds, the last one all longer
+BUCKETS = 40
+
+
+class Histogram:
+    """Durations in power of two buckets, percentiles are upper bounds."""
+
+    __slots__ = ("buckets", "count", "total", "max")
+
+    def __init__(self):
+        self.buckets = [0] * BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def observe(self, ns: int) -> None:
+        self.buckets[min(ns.bit_length(), BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+
+    def percentile(self, fraction: float) -> int:
+        """Upper bound of the duration below which fraction of them were."""
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                return min(1 << index, self.max)
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "mean_us": self.total / self.count / 1000 if self.count else 0.0,
+            "p50_us": self.percentile(0.5) / 1000,
+            "p90_us": self.percentile(0.9) / 1000,
+            "p99_us": self.percentile(0.99) / 1000,
+            "max_us": self.max / 1000,
+        }
+
+
+class Metrics:
+    """
+    Latency of the agent's stages and counters, shared by the event loop,
+    the observer thread and the diff workers.
+
+    Timing a stage takes two monotonic clock reads:
+
+        start = metrics.start()
+        ...
+        metrics.observe("diff", start)
+
+    Disabled, start() returns 0 and nothing is recorded.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._stages = collections.defaultdict(Histogram)
+        self._counters = collections.Counter()
+        self._last = time.monotonic()
+        self._last_counters = {}
+
+    def start(self) -> int:
+        return time.perf_counter_ns() if self.enabled else 0
+
+    def observe(self, stage: str, start: int) -> None:
+        """Record the duration of a stage started at start()."""
+        if start:
+            ns = time.perf_counter_ns() - start
+            with self._lock:
+                self._stages[stage].observe(ns)
+
+    def add(self, counter: str, value: int = 1) -> None:
+        if self.enabled:
+            with self._lock:
+                self._counters[counter] += value
+
+    def snapshot(self) -> dict:
+        """
+        Return the histograms, the counters and their rates per second
+        since the previous snapshot.
+        """
+        with self._lock:
+            stages = {name: h.snapshot() for name, h in self._stages.items()}
+            counters = dict(self._counters)
+        now = time.monotonic()
+        elapsed = max(now - self._last, 1e-9)
+        rates = {
+            name: (value - self._last_counters.get(name, 0)) / elapsed
+            for name, value in counters.items()
+        }
+        self._last = now
+        self._last_counters = counters
+        return {"stages": stages, "counters": counters, "rates": rates}
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of all other threads every interval seconds while
+    running and counts how often each stack was seen. Stacks are cut to
+    their innermost depth frames.
+    """
+
+    def __init__(self, interval: float = 0.005, depth: int = 12):
+        self.interval = interval
+        self.depth = depth
+        self.samples = 0
+        self._stacks = collections.Counter()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            name="fso-profiler",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        me = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.depth:
+                    code = frame.f_code
+                    stack.append(
+                        f"{os.path.basename(code.co_filename)}:"
+                        f"{frame.f_lineno}:{code.co_name}",
+                    )
+                    frame = frame.f_back
+                self._stacks[tuple(stack)] += 1
+            self.samples += 1
+
+    def top(self, limit: int = 20) -> list[dict]:
+        """Return the most often seen stacks, innermost frame first."""
+        return [
+            {"samples": count, "stack": list(stack)}
+            for stack, count in self._stacks.most_common(limit)
+        ]
@@ -1,8 +1,10 @@
 import base64
 import re
 import socket
-from datetime import datetime
-from typing import List, Literal
+import struct
+from datetime import datetime, timedelta, timezone
+from itertools import accumulate
+from typing import List, Literal, NamedTuple, Tuple
 
 from pydantic import BaseModel, Field, field_validator
 
@@ -33,6 +35,47 @@ class FileObserverEvent(BaseModel):
         None,
         description="A list of file diff lines",
     )
+    diff_compression: str | None = Field(
+        None,
+        description=(
+            "Compression of compressed_diff: zlib with the preset dictionary "
+            "of the given id, e.g. zlib:0123456789abcdef."
+        ),
+    )
+    compressed_diff: str | None = Field(
+        None,
+        description="Base64 encoded compressed JSON list of diff lines.",
+    )
+    delta: List[Tuple[int, int] | str] | None = Field(
+        None,
+        description=(
+            "Binary delta against the base version: [offset, length] to copy "
+            "from the base or base64 encoded bytes to insert."
+        ),
+    )
+    base_hash: str | None = Field(
+        None,
+        description="SHA-256 of the version the delta applies to.",
+    )
+    content_hash: str | None = Field(
+        None,
+        description="SHA-256 of the new file content if no text diff is available.",
+    )
+    merged_events: int = Field(
+        1,
+        description="Number of raw file system events merged into this event.",
+    )
+    is_directory: bool = Field(
+        False,
+        description="The event is about a directory and all files below it.",
+    )
+    partial: bool = Field(
+        False,
+        description=(
+            "The delta is a part of a version too large for one message, "
+            "the next part builds on the version with content_hash."
+        ),
+    )
 
     class Config:
         json_schema_extra = {
@@ -45,11 +88,32 @@ class FileObserverEvent(BaseModel):
             },
         }
 
+    @classmethod
+    def trusted(cls, **fields) -> "FileObserverEvent":
+        """
+        Build an event without validating the fields, for events built by
+        the agent itself from values of the right types. Like
+        model_construct(), which inspects the default factories on every
+        call and takes longer than a validation.
+        """
+        values = {
+            "emitter": fields.get("emitter") or _HOSTNAME,
+            "timestamp": fields.get("timestamp") or datetime.now(),
+            **_DEFAULTS,
+            **fields,
+        }
+        event = cls.__new__(cls)
+        object.__setattr__(event, "__dict__", values)
+        object.__setattr__(event, "__pydantic_fields_set__", set(fields))
+        object.__setattr__(event, "__pydantic_extra__", None)
+        object.__setattr__(event, "__pydantic_private__", None)
+        return event
+
     def to_base64(self) -> str:
         """
         Serialize the event to a Base64-encoded string.
         """
-        json_str = self.json()
+        json_str = self.model_dump_json()
         base64_bytes = base64.b64encode(json_str.encode("utf-8"))
         return base64_bytes.decode("utf-8")
 
@@ -61,6 +125,299 @@ class FileObserverEvent(BaseModel):
         json_str = base64.b64decode(base64_str).decode("utf-8")
         return cls.model_validate_json(json_str)
 
+    def to_bytes(self) -> bytes:
+        """
+        Serialize the event to UTF-8 encoded JSON, used as body of
+        the binary broker protocol.
+        """
+        return self.model_dump_json().encode("utf-8")
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "FileObserverEvent":
+        """
+        Deserialize UTF-8 encoded JSON back into a FileObserverEvent.
+        """
+        return cls.model_validate_json(data)
+
+
+# defaults of the fields for trusted(), the host name is taken once
+_HOSTNAME = socket.gethostname()
+_DEFAULTS = {
+    name: field.default
+    for name, field in FileObserverEvent.model_fields.items()
+    if field.default_factory is None and not field.is_required()
+}
+
+
+class EventHeader(NamedTuple):
+    """The fields of an event readable without decoding its body."""
+
+    event_type: str
+    file_path: str
+    timestamp: datetime
+    emitter: str
+    destination_path: str | None
+    merged_events: int
+    is_directory: bool
+
+
+class JsonCodec:
+    """
+    The event as UTF-8 encoded JSON. On the text protocol it is sent
+    base64 encoded, the format of to_base64().
+    """
+
+    name = "json"
+
+    def encode(self, event: FileObserverEvent) -> bytes:
+        return event.model_dump_json().encode("utf-8")
+
+    def decode(self, data: bytes, validate: bool = True) -> FileObserverEvent:
+        return FileObserverEvent.model_validate_json(data)
+
+    def header(self, data: bytes) -> EventHeader:
+        """Read the header fields, JSON is decoded as a whole for that."""
+        event = self.decode(data)
+        return EventHeader(
+            event.event_type,
+            event.file_path,
+            event.timestamp,
+            event.emitter,
+            event.destination_path,
+            event.merged_events,
+            event.is_directory,
+        )
+
+
+# magic, version, event type, flags, timestamp in microseconds, merged events
+COMPACT_HEADER = struct.Struct("!BBBBqI")
+COMPACT_MAGIC = 0xFE
+COMPACT_VERSION = 1
+EVENT_TYPES = ("created", "modified", "deleted", "moved")
+FLAG_DIRECTORY = 0x01
+FLAG_DESTINATION = 0x02
+FLAG_CONTENT_HASH = 0x04
+FLAG_BASE_HASH = 0x08
+FLAG_DIFF = 0x10
+FLAG_DELTA = 0x20
+FLAG_COMPRESSED_DIFF = 0x40
+FLAG_PARTIAL = 0x80
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+_STRING = struct.Struct("!H")
+_SIZE = struct.Struct("!I")
+# delta instructions: a copy from the base or bytes to insert
+_COPY = struct.Struct("!BQQ")
+_INSERT = struct.Struct("!BI")
+
+
+class CompactCodec:
+    """
+    Versioned binary encoding of an event.
+
+    The fixed COMPACT_HEADER is followed by the strings of the header
+    (emitter, file path, destination if flagged), the hashes if flagged,
+    and the length of the body, so the header can be read without
+    touching the body. The body holds the diff lines behind their lengths,
+    the delta and the compressed diff, whose bytes are stored raw instead
+    of base64 encoded. Strings are UTF-8 with a 16-bit length, lines and
+    inserts have a 32-bit length.
+
+    Timestamps are kept as given; timezone aware ones are stored in UTC
+    and decoded naive.
+    """
+
+    name = "compact"
+
+    def encode(self, event: FileObserverEvent) -> bytes:
+        flags = 0
+        strings = [event.emitter, event.file_path]
+        if event.is_directory:
+            flags |= FLAG_DIRECTORY
+        if event.partial:
+            flags |= FLAG_PARTIAL
+        for flag, value in (
+            (FLAG_DESTINATION, event.destination_path),
+            (FLAG_CONTENT_HASH, event.content_hash),
+            (FLAG_BASE_HASH, event.base_hash),
+        ):
+            if value is not None:
+                flags |= flag
+                strings.append(value)
+
+        body = []
+        if event.diff is not None:
+            flags |= FLAG_DIFF
+            lines = [line.encode("utf-8") for line in event.diff]
+            # all lengths in front of the lines, packed at once
+            body.append(struct.pack(f"!I{len(lines)}I", len(lines), *map(len, lines)))
+            body.extend(lines)
+        if event.delta is not None:
+            flags |= FLAG_DELTA
+            body.append(_SIZE.pack(len(event.delta)))
+            for item in event.delta:
+                if isinstance(item, str):
+                    data = base64.b64decode(item)
+                    body.append(_INSERT.pack(1, len(data)))
+                    body.append(data)
+                else:
+                    body.append(_COPY.pack(0, *item))
+        if event.compressed_diff is not None:
+            flags |= FLAG_COMPRESSED_DIFF
+            compression = event.diff_compression.encode("utf-8")
+            data = base64.b64decode(event.compressed_diff)
+            body.append(_STRING.pack(len(compression)))
+            body.append(compression)
+            body.append(_SIZE.pack(len(data)))
+            body.append(data)
+        body = b"".join(body)
+
+        timestamp = event.timestamp
+        if timestamp.tzinfo is not None:
+            timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+        parts = [
+            COMPACT_HEADER.pack(
+                COMPACT_MAGIC,
+                COMPACT_VERSION,
+                EVENT_TYPES.index(event.event_type),
+                flags,
+                (timestamp - _EPOCH) // _MICROSECOND,
+                event.merged_events,
+            ),
+        ]
+        for value in strings:
+            value = value.encode("utf-8")
+            parts.append(_STRING.pack(len(value)))
+            parts.append(value)
+        parts.append(_SIZE.pack(len(body)))
+        parts.append(body)
+        return b"".join(parts)
+
+    def _read_header(self, data: bytes) -> tuple[EventHeader, int, list, int]:
+        """Return the header, the flags, the hashes and the body offset."""
+        magic, version, event_type, flags, micros, merged = COMPACT_HEADER.unpack_from(
+            data,
+        )
+        if magic != COMPACT_MAGIC:
+            raise ValueError("Not a compact encoded event")
+        if version != COMPACT_VERSION:
+            raise ValueError(f"Unsupported compact event version {version}")
+        offset = COMPACT_HEADER.size
+        strings = []
+        count = 2 + sum(
+            bool(flags & flag)
+            for flag in (FLAG_DESTINATION, FLAG_CONTENT_HASH, FLAG_BASE_HASH)
+        )
+        for _ in range(count):
+            (size,) = _STRING.unpack_from(data, offset)
+            offset += _STRING.size
+            strings.append(bytes(data[offset : offset + size]).decode("utf-8"))
+            offset += size
+        emitter, file_path, *optional = strings
+        destination = optional.pop(0) if flags & FLAG_DESTINATION else None
+        header = EventHeader(
+            EVENT_TYPES[event_type],
+            file_path,
+            _EPOCH + micros * _MICROSECOND,
+            emitter,
+            destination,
+            merged,
+            bool(flags & FLAG_DIRECTORY),
+        )
+        return header, flags, optional, offset
+
+    def header(self, data: bytes) -> EventHeader:
+        """Read the header fields without decoding the body."""
+        return self._read_header(data)[0]
+
+    def decode(self, data: bytes, validate: bool = True) -> FileObserverEvent:
+        header, flags, hashes, offset = self._read_header(data)
+        content_hash = hashes.pop(0) if flags & FLAG_CONTENT_HASH else None
+        base_hash = hashes.pop(0) if flags & FLAG_BASE_HASH else None
+        (size,) = _SIZE.unpack_from(data, offset)
+        offset += _SIZE.size
+        if len(data) - offset != size:
+            raise ValueError("Truncated compact event")
+
+        diff = None
+        if flags & FLAG_DIFF:
+            (count,) = _SIZE.unpack_from(data, offset)
+            lengths = struct.unpack_from(f"!{count}I", data, offset + _SIZE.size)
+            offset += _SIZE.size * (count + 1)
+            end = offset + sum(lengths)
+            text = str(data[offset:end], "utf-8")
+            if len(text) == end - offset:
+                # ASCII only, cut the decoded text at the byte lengths
+                ends = list(accumulate(lengths))
+                diff = [text[a:b] for a, b in zip([0, *ends], ends)]
+            else:
+                diff = []
+                for length in lengths:
+                    diff.append(str(data[offset : offset + length], "utf-8"))
+                    offset += length
+            offset = end
+        delta = None
+        if flags & FLAG_DELTA:
+            (count,) = _SIZE.unpack_from(data, offset)
+            offset += _SIZE.size
+            delta = []
+            for _ in range(count):
+                if data[offset]:
+                    _, length = _INSERT.unpack_from(data, offset)
+                    offset += _INSERT.size
+                    inserted = data[offset : offset + length]
+                    delta.append(base64.b64encode(inserted).decode("ascii"))
+                    offset += length
+                else:
+                    _, base_offset, length = _COPY.unpack_from(data, offset)
+                    offset += _COPY.size
+                    delta.append((base_offset, length))
+
+        diff_compression = compressed_diff = None
+        if flags & FLAG_COMPRESSED_DIFF:
+            (length,) = _STRING.unpack_from(data, offset)
+            offset += _STRING.size
+            diff_compression = str(data[offset : offset + length], "utf-8")
+            offset += length
+            (length,) = _SIZE.unpack_from(data, offset)
+            offset += _SIZE.size
+            compressed = data[offset : offset + length]
+            compressed_diff = base64.b64encode(compressed).decode("ascii")
+
+        fields = header._asdict()
+        fields.update(
+            diff=diff,
+            diff_compression=diff_compression,
+            compressed_diff=compressed_diff,
+            delta=delta,
+            content_hash=content_hash,
+            base_hash=base_hash,
+            partial=bool(flags & FLAG_PARTIAL),
+        )
+        if validate:
+            return FileObserverEvent.model_validate(fields)
+        return FileObserverEvent.trusted(**fields)
+
+
+CODECS = {codec.name: codec for codec in (JsonCodec(), CompactCodec())}
+
+
+def get_codec(data: bytes) -> JsonCodec | CompactCodec:
+    """Return the codec an encoded event was encoded with."""
+    if data[:1] == bytes([COMPACT_MAGIC]):
+        return CODECS["compact"]
+    return CODECS["json"]
+
+
+def decode_event(data: bytes, validate: bool = True) -> FileObserverEvent:
+    """Decode an event encoded with any of the codecs."""
+    return get_codec(data).decode(data, validate)
+
+
+def read_header(data: bytes) -> EventHeader:
+    """Read the header fields of an event encoded with any of the codecs."""
+    return get_codec(data).header(data)
+
 
 class FileObserverRule(BaseModel):
     """
@@ -0,0 +1,349 @@
+"""Find the changes made to the watched tree while the agent was down"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from cache import RACY_NS
+
+# raw events handed to the pipeline at once
+BATCH_SIZE = 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    path TEXT PRIMARY KEY,
+    parent TEXT NOT NULL,
+    is_dir INTEGER NOT NULL,
+    inode INTEGER,
+    mtime_ns INTEGER,
+    size INTEGER,
+    hash TEXT,
+    checked_ns INTEGER
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS entries_parent ON entries (parent);
+"""
+
+
+def file_hash(path: str) -> str | None:
+    """Return the SHA-256 of the content of a file, None if unreadable."""
+    digest = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            while chunk := f.read(1024 * 1024):
+                digest.update(chunk)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+def entry_hash(cache, path: str, stat: os.stat_result) -> str | None:
+    """
+    Return the hash to record for a file: the cached one, or the hash of
+    the content if the entry is racy, so the next reconciliation can tell
+    a change within the same timestamp tick from none.
+    """
+    digest = cache.content_hash(path)
+    if digest is None and time.time_ns() - stat.st_mtime_ns < RACY_NS:
+        digest = file_hash(path)
+    return digest
+
+
+def _upper(prefix: str) -> str:
+    """Smallest string above all strings starting with prefix + "/"."""
+    return prefix + "0"
+
+
+class TreeManifest:
+    """
+    Inode, mtime, size and hash of every watched file and directory,
+    persisted in SQLite, so a tree with millions of files is compared
+    one directory at a time instead of being loaded into memory.
+
+    Changes are committed every commit_every writes and on close.
+    """
+
+    def __init__(self, path: str, commit_every: int = 1000):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.commit_every = commit_every
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        # shared by the diff workers and the reconciler
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    @property
+    def empty(self) -> bool:
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM entries LIMIT 1").fetchone() is None
+
+    def get(self, path: str) -> tuple | None:
+        """Return (is_dir, inode, mtime_ns, size, hash, checked_ns) of a path."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT is_dir, inode, mtime_ns, size, hash, checked_ns "
+                "FROM entries WHERE path = ?",
+                (path,),
+            ).fetchone()
+
+    def children(self, directory: str) -> dict[str, tuple]:
+        """Return the entries directly in a directory by path."""
+        with self._lock:
+            return {
+                row[0]: row[1:]
+                for row in self._db.execute(
+                    "SELECT path, is_dir, inode, mtime_ns, size, hash, checked_ns "
+                    "FROM entries WHERE parent = ?",
+                    (directory,),
+                )
+            }
+
+    def put(
+        self,
+        path: str,
+        stat: os.stat_result,
+        digest: str | None = None,
+        is_dir: bool = False,
+    ) -> None:
+        """Record the current state of a file or a listed directory."""
+        self._write(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                path,
+                os.path.dirname(path),
+                is_dir,
+                stat.st_ino,
+                stat.st_mtime_ns,
+                stat.st_size,
+                digest,
+                time.time_ns(),
+            ),
+        )
+
+    def invalidate(self, directory: str) -> None:
+        """Have a directory listed again by the next reconciliation."""
+        self._write("UPDATE entries SET mtime_ns = NULL WHERE path = ?", (directory,))
+
+    def remove(self, path: str) -> None:
+        self._write("DELETE FROM entries WHERE path = ?", (path,))
+
+    def remove_tree(self, directory: str) -> None:
+        """Remove a directory and everything below it."""
+        self._write(
+            "DELETE FROM entries WHERE path = ? OR (path >= ? AND path < ?)",
+            (directory, directory + "/", _upper(directory)),
+        )
+
+    def move_tree(self, source: str, destination: str) -> None:
+        """Move a directory and everything below it."""
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM entries WHERE path = ? OR (path >= ? AND path < ?)",
+                (destination, destination + "/", _upper(destination)),
+            )
+            self._db.execute(
+                "UPDATE entries SET path = ? || substr(path, ?), "
+                "parent = ? || substr(parent, ?) WHERE path >= ? AND path < ?",
+                (
+                    destination,
+                    len(source) + 1,
+                    destination,
+                    len(source) + 1,
+                    source + "/",
+                    _upper(source),
+                ),
+            )
+            # listed again, the move changed its ctime only
+            self._db.execute(
+                "UPDATE entries SET path = ?, parent = ?, mtime_ns = NULL "
+                "WHERE path = ?",
+                (destination, os.path.dirname(destination), source),
+            )
+            self._count(1)
+
+    def _write(self, statement: str, parameters: tuple) -> None:
+        with self._lock:
+            self._db.execute(statement, parameters)
+            self._count(1)
+
+    def _count(self, writes: int) -> None:
+        self._writes += writes
+        if self._writes >= self.commit_every:
+            self._db.commit()
+            self._writes = 0
+
+    def commit(self) -> None:
+        with self._lock:
+            self._db.commit()
+            self._writes = 0
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+
+
+class Reconciler:
+    """
+    Compares the watched tree with the manifest and hands the changes
+    made meanwhile to the FileHandler as raw created, modified, deleted
+    and deleted_dir events, so they get diffs like live events.
+
+    A directory whose inode and mtime did not change since it was listed
+    still has the same entries, so it is not listed again; its files
+    are only stat'ed. A directory changed within RACY_NS before it was
+    recorded is always listed. The manifest itself is updated by the
+    handler while it processes the events, an interrupted run reports
+    the remaining changes next time.
+
+    Without a manifest, the tree is recorded as it is and nothing is
+    reported.
+    """
+
+    def __init__(self, handler, manifest: TreeManifest):
+        self.handler = handler
+        self.manifest = manifest
+        self._events = []
+        # statistics
+        self.directories = 0
+        self.listed = 0
+        self.files = 0
+        self.changes = 0
+        self.seconds = 0.0
+
+    def run(self, root: str) -> dict:
+        """Reconcile the tree below root, returns the statistics."""
+        start = time.perf_counter()
+        baseline = self.manifest.empty
+        stack = [root]
+        while stack:
+            directory = stack.pop()
+            try:
+                stat = os.stat(directory)
+            except OSError:
+                continue
+            self.directories += 1
+            known = self.manifest.children(directory)
+            if self._trusted(self.manifest.get(directory), stat):
+                entries = [(path, row[0]) for path, row in known.items()]
+            else:
+                entries = self._list(directory)
+                self.listed += 1
+
+            changed = False
+            for path, is_dir in entries:
+                row = known.pop(path, None)
+                if is_dir:
+                    stack.append(path)
+                    # listed until the new directory was recorded
+                    changed |= row is None and not baseline
+                    continue
+                self.files += 1
+                changed |= self._check(path, row, baseline)
+            for path, row in known.items():
+                # gone since the last run
+                self._emit("deleted_dir" if row[0] else "deleted", path)
+                changed = True
+            if baseline or not changed:
+                # entries of changed directories are recorded by the
+                # handler, until then the directory is listed again
+                self.manifest.put(directory, stat, is_dir=True)
+
+        self._flush()
+        self.manifest.commit()
+        self.seconds = time.perf_counter() - start
+        print(
+            f"Reconciled {self.files} files in {self.directories} directories "
+            f"({self.listed} listed) in {self.seconds:.1f}s, "
+            f"{self.changes} changes.",
+        )
+        return self.stats()
+
+    @staticmethod
+    def _trusted(row: tuple | None, stat: os.stat_result) -> bool:
+        if row is None or not row[0] or row[2] is None:
+            return False
+        _, inode, mtime_ns, _, _, checked_ns = row
+        return (
+            inode == stat.st_ino
+            and mtime_ns == stat.st_mtime_ns
+            and checked_ns - mtime_ns >= RACY_NS
+        )
+
+    def _list(self, directory: str) -> list[tuple[str, bool]]:
+        rules = self.handler.rules
+        entries = []
+        try:
+            with os.scandir(directory) as scan:
+                for entry in scan:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if not rules.excludes_tree(entry.path):
+                                entries.append((entry.path, True))
+                        elif entry.is_file() and not rules.is_excluded(entry.path):
+                            entries.append((entry.path, False))
+                    except OSError:
+                        continue
+        except OSError as e:
+            print(f"Failed to list {directory}: {e}")
+        return entries
+
+    def _check(self, path: str, row: tuple | None, baseline: bool) -> bool:
+        """
+        Compare a file with its entry, returns True if it was created or
+        deleted, i.e. the entries of its directory changed.
+        """
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            if row is not None:
+                self._emit("deleted", path)
+            return row is not None
+        except OSError:
+            return False
+        if baseline:
+            self.manifest.put(path, stat, entry_hash(self.handler.cache, path, stat))
+            return False
+        if row is None:
+            self._emit("created", path)
+            return True
+        _, inode, mtime_ns, size, digest, checked_ns = row
+        if (
+            inode == stat.st_ino
+            and mtime_ns == stat.st_mtime_ns
+            and size == stat.st_size
+        ):
+            if checked_ns - mtime_ns >= RACY_NS:
+                return False
+            # recorded within the tick of the mtime, the content tells
+            if digest is not None and file_hash(path) == digest:
+                self.manifest.put(path, stat, digest)
+                return False
+        if self.handler.rules.is_important(path):
+            # diff against the version cached before the restart
+            self.handler.cache.restore(path)
+        self._emit("modified", path)
+        return False
+
+    def _emit(self, event_type: str, path: str) -> None:
+        self.changes += 1
+        self._events.append((event_type, path, None))
+        if len(self._events) >= BATCH_SIZE:
+            self._flush()
+
+    def _flush(self) -> None:
+        if self._events:
+            self.handler.submit_batch(self._events)
+            self._events = []
+
+    def stats(self) -> dict:
+        return {
+            "directories": self.directories,
+            "listed": self.listed,
+            "files": self.files,
+            "changes": self.changes,
+            "seconds": self.seconds,
+        }
@@ -0,0 +1,231 @@
+"""Compiled matching of paths against the patterns of a FileObserverRule"""
+
+import functools
+import re
+
+from models import FileObserverRule
+
+# characters with a special meaning in a regular expression
+_SPECIAL = set(".^$*+?{}[]|()\\")
+# numbered or named group references and conditionals
+_BACKREFERENCE = re.compile(r"\\[1-9]|\(\?P[<=]|\(\?\(|\\g<")
+
+
+def _escaped(source: str, end: int) -> bool:
+    """Check if the character at end is escaped by a backslash."""
+    backslashes = 0
+    while end > 0 and source[end - 1] == "\\":
+        backslashes += 1
+        end -= 1
+    return backslashes % 2 == 1
+
+
+def _literal(source: str) -> str | None:
+    """Return the text a pattern matches literally or None for real regexes."""
+    chars = []
+    i = 0
+    while i < len(source):
+        char = source[i]
+        if char == "\\":
+            if i + 1 < len(source) and not source[i + 1].isalnum():
+                chars.append(source[i + 1])
+                i += 2
+                continue
+            return None
+        if char in _SPECIAL:
+            return None
+        chars.append(char)
+        i += 1
+    return "".join(chars)
+
+
+def _unanchored(source: str) -> str:
+    """
+    Strip a leading "^.*" and a trailing ".*$" of a pattern, they don't
+    change whether it matches a path without newlines but make the
+    regex engine backtrack over the whole path.
+    """
+    for prefix in ("^.*", ".*"):
+        if source.startswith(prefix):
+            if source[len(prefix) : len(prefix) + 1] not in ("?", "+", "{"):
+                source = source[len(prefix) :]
+            break
+    for suffix in (".*$", ".*"):
+        if source.endswith(suffix) and not _escaped(source, len(source) - len(suffix)):
+            source = source[: -len(suffix)]
+            break
+    return source
+
+
+def classify(pattern: re.Pattern) -> tuple[str, str | None]:
+    """
+    Classify a pattern by what pattern.search() checks for a path without
+    newlines: ("exact", text), ("prefix", text), ("suffix", text),
+    ("substring", text) or ("regex", None) if it is no plain literal.
+    """
+    source = pattern.pattern
+    if pattern.flags & ~re.UNICODE:
+        return "regex", None
+
+    anchored_start = source.startswith("^")
+    if anchored_start:
+        source = source[1:]
+    if source.startswith(".*"):
+        anchored_start = False
+        source = source[2:]
+
+    anchored_end = False
+    if source.endswith("$") and not _escaped(source, len(source) - 1):
+        anchored_end = True
+        source = source[:-1]
+    if source.endswith(".*") and not _escaped(source, len(source) - 2):
+        anchored_end = False
+        source = source[:-2]
+
+    text = _literal(source)
+    if text is None:
+        return "regex", None
+    if anchored_start and anchored_end:
+        return "exact", text
+    if anchored_start:
+        return "prefix", text
+    if anchored_end:
+        return "suffix", text
+    return "substring", text
+
+
+class PathMatcher:
+    """
+    Checks if any of a list of patterns matches a path, with the same
+    result as calling pattern.search(path) for every pattern.
+
+    Literal patterns are sorted into sets: prefixes and suffixes (e.g.
+    file extensions) are looked up by length, directory names like
+    "/joe/" by path component. Other literals and the remaining regular
+    expressions are combined into a single alternation each, so a path
+    is scanned a handful of times instead of once per pattern.
+    """
+
+    def __init__(self, patterns: list[re.Pattern]):
+        self.patterns = list(patterns)
+        self.always = False
+        self.exact = set()
+        # length -> literals
+        self.prefixes = {}
+        self.suffixes = {}
+        # suffixes like ".conf", found with a single lookup
+        self.extensions = set()
+        # names of directories matched by "/name/"
+        self.components = set()
+        substrings = []
+        regexes = []
+        # patterns which can't be part of an alternation
+        self.separate = []
+
+        for pattern in self.patterns:
+            kind, text = classify(pattern)
+            if kind == "regex":
+                if pattern.flags & ~re.UNICODE or _BACKREFERENCE.search(
+                    pattern.pattern,
+                ):
+                    # group references and global flags would break
+                    self.separate.append(pattern)
+                else:
+                    regexes.append(f"(?:{_unanchored(pattern.pattern)})")
+            elif kind == "exact":
+                self.exact.add(text)
+            elif not text:
+                self.always = True
+            elif kind == "prefix":
+                self.prefixes.setdefault(len(text), set()).add(text)
+            elif kind == "suffix" and text[0] == "." and "." not in text[1:]:
+                self.extensions.add(text)
+            elif kind == "suffix":
+                self.suffixes.setdefault(len(text), set()).add(text)
+            elif len(text) > 2 and text[0] == text[-1] == "/" and "/" not in text[1:-1]:
+                self.components.add(text[1:-1])
+            else:
+                substrings.append(text)
+
+        self.max_substring = max((len(text) for text in substrings), default=0)
+        self.substrings = None
+        if substrings:
+            # longest first, so shorter literals don't shadow longer ones
+            substrings.sort(key=len, reverse=True)
+            self.substrings = re.compile("|".join(map(re.escape, substrings)))
+        self.regex = re.compile("|".join(regexes)) if regexes else None
+
+    def search(self, path: str, start: int = 0) -> bool:
+        """
+        Check if any pattern matches the path. With a start position,
+        component and substring literals lying completely in front of
+        it are expected to have been checked already (see matches_tree).
+        """
+        if "\n" in path:
+            # '.' and '$' behave differently around newlines
+            return any(pattern.search(path) for pattern in self.patterns)
+        if self.always or path in self.exact:
+            return True
+        for length, texts in self.prefixes.items():
+            if path[:length] in texts:
+                return True
+        if self.extensions and path[path.rfind(".") :] in self.extensions:
+            return True
+        for length, texts in self.suffixes.items():
+            if len(path) >= length and path[-length:] in texts:
+                return True
+        if self.components and start == 0:
+            if not self.components.isdisjoint(path.split("/")[1:-1]):
+                return True
+        if self.substrings is not None:
+            if self.substrings.search(path, max(0, start - self.max_substring + 1)):
+                return True
+        if self.regex is not None and self.regex.search(path):
+            return True
+        return any(pattern.search(path) for pattern in self.separate)
+
+    def matches_tree(self, directory: str) -> bool:
+        """
+        Check if the patterns match every path below a directory, i.e. a
+        prefix, directory name or substring literal matches already.
+        """
+        if "\n" in directory:
+            return False
+        head = directory + "/"
+        if self.always:
+            return True
+        for length, texts in self.prefixes.items():
+            if length <= len(head) and head[:length] in texts:
+                return True
+        if not self.components.isdisjoint(directory.split("/")[1:]):
+            return True
+        return self.substrings is not None and bool(self.substrings.search(head))
+
+
+class CompiledRule:
+    """
+    Path matching engine built from a FileObserverRule. Decisions for
+    whole directories are kept in a bounded cache, so files in excluded
+    subtrees are rejected with a single lookup and walks can skip them.
+    """
+
+    def __init__(self, rule: FileObserverRule, cache_size: int = 4096):
+        self.rule = rule
+        self.exclude = PathMatcher(rule.exclude_patterns)
+        self.important = PathMatcher(rule.important_pattern)
+        self.excludes_tree = functools.lru_cache(cache_size)(
+            self.exclude.matches_tree,
+        )
+
+    def is_excluded(self, path: str) -> bool:
+        """Check if a path matches any of the exclude patterns."""
+        directory = path.rpartition("/")[0]
+        if not directory:
+            return self.exclude.search(path)
+        if self.excludes_tree(directory):
+            return True
+        return self.exclude.search(path, len(directory) + 1)
+
+    def is_important(self, path: str) -> bool:
+        """Check if a path matches any of the important patterns."""
+        return self.important.search(path)
@@ -0,0 +1,204 @@
+"""Disk-backed outbox for messages the broker could not take yet"""
+
+import os
+import struct
+
+# payload is str, topic length, payload length
+RECORD = struct.Struct("!BHI")
+SEGMENT_SUFFIX = ".seg"
+# segment number and offset of the first message not sent yet
+POSITION_FILE = "position"
+POSITION = struct.Struct("!QQ")
+
+
+class Spool:
+    """
+    Append-only queue of (topic, message) pairs in segment files.
+
+    Messages are appended to the last segment, a new one is started
+    after segment_bytes. Sent messages are consumed by advancing the
+    read position, which is kept in a small file, so messages survive
+    a restart of the agent; fully sent segments are deleted. If the
+    spool exceeds max_bytes, its oldest segment is dropped.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        segment_bytes: int = 16 * 1024 * 1024,
+        max_bytes: int = 256 * 1024 * 1024,
+    ):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.segments = sorted(
+            int(name[: -len(SEGMENT_SUFFIX)])
+            for name in os.listdir(directory)
+            if name.endswith(SEGMENT_SUFFIX)
+        )
+        self.read_segment, self.read_offset = self._load_position()
+        self.segments = [s for s in self.segments if s >= self.read_segment]
+        self._writer = None
+        # statistics
+        self.bytes = 0
+        self.messages = 0
+        self.dropped = 0
+        for segment in self.segments:
+            messages, size = self._scan(segment)
+            self.messages += messages
+            self.bytes += size
+
+    def _path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{segment:012d}{SEGMENT_SUFFIX}")
+
+    def _load_position(self) -> tuple[int, int]:
+        try:
+            with open(os.path.join(self.directory, POSITION_FILE), "rb") as f:
+                return POSITION.unpack(f.read(POSITION.size))
+        except (FileNotFoundError, struct.error):
+            return (self.segments[0] if self.segments else 0), 0
+
+    @property
+    def pending(self) -> bool:
+        return self.messages > 0
+
+    def append(self, topic: str, message: str | bytes) -> None:
+        """Add a message at the end of the spool."""
+        is_str = isinstance(message, str)
+        payload = message.encode("utf-8") if is_str else message
+        topic = topic.encode("utf-8")
+        record = RECORD.pack(is_str, len(topic), len(payload)) + topic + payload
+
+        if self._writer is None or self._writer.tell() >= self.segment_bytes:
+            self._next_segment()
+        self._writer.write(record)
+        self._writer.flush()
+        self.bytes += len(record)
+        self.messages += 1
+        while self.bytes > self.max_bytes and len(self.segments) > 1:
+            self._drop_oldest()
+
+    def _next_segment(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+        segment = self.segments[-1] + 1 if self.segments else self.read_segment
+        self.segments.append(segment)
+        self._writer = open(self._path(segment), "ab")
+
+    def _drop_oldest(self) -> None:
+        segment = self.segments[0]
+        # forget its unsent messages
+        messages, size = self._scan(segment)
+        self.messages -= messages
+        self.bytes -= size
+        self.dropped += messages
+        print(f"Spool is full, dropped {messages} message(s).")
+        self._remove(segment)
+        self.read_segment, self.read_offset = self.segments[0], 0
+        self._save_position()
+
+    def _scan(self, segment: int) -> tuple[int, int]:
+        """Return number and size of the unsent messages in a segment."""
+        offset = self.read_offset if segment == self.read_segment else 0
+        messages = 0
+        size = 0
+        for _, _, end in self._records(segment, offset):
+            messages += 1
+            size += end - offset
+            offset = end
+        return messages, size
+
+    def _records(self, segment: int, offset: int, max_bytes: int | None = None):
+        """
+        Yield topic, message and end offset of the complete records of a
+        segment, a record torn by a crash while appending is skipped.
+        """
+        with open(self._path(segment), "rb") as f:
+            f.seek(offset)
+            data = f.read(max_bytes if max_bytes is not None else -1)
+        position = 0
+        while position + RECORD.size <= len(data):
+            is_str, topic_size, size = RECORD.unpack_from(data, position)
+            start = position + RECORD.size
+            end = start + topic_size + size
+            if end > len(data):
+                if max_bytes is not None and position == 0:
+                    # a single record larger than max_bytes
+                    yield from self._records(segment, offset, end)
+                break
+            topic = data[start : start + topic_size].decode("utf-8")
+            payload = data[start + topic_size : end]
+            yield topic, payload.decode("utf-8") if is_str else payload, offset + end
+            position = end
+
+    def read(self, max_bytes: int = 1024 * 1024) -> tuple[list, tuple[int, int]]:
+        """
+        Return the oldest unsent messages, about max_bytes of them, and
+        the position to consume() once they were sent.
+        """
+        for segment in self.segments:
+            if segment < self.read_segment:
+                continue
+            offset = self.read_offset if segment == self.read_segment else 0
+            messages = []
+            end = offset
+            for topic, message, end in self._records(segment, offset, max_bytes):
+                messages.append((topic, message))
+            if messages:
+                return messages, (segment, end)
+        # only torn records left
+        self.messages = self.bytes = 0
+        return [], (self.read_segment, self.read_offset)
+
+    def consume(self, position: tuple[int, int], messages: int) -> None:
+        """Mark the messages up to position as sent."""
+        segment, offset = position
+        if segment not in self.segments:
+            # dropped meanwhile, its messages were counted as dropped
+            return
+        while self.segments and self.segments[0] < segment:
+            self._remove(self.segments[0])
+        if segment == self.read_segment:
+            self.bytes -= offset - self.read_offset
+        else:
+            self.bytes -= offset
+        self.read_segment, self.read_offset = segment, offset
+        self.messages -= messages
+        if not self.messages:
+            self.bytes = 0
+            if self.segments[-1] == segment:
+                # everything was sent, start over with a new segment
+                self._remove(segment)
+                self.read_segment, self.read_offset = segment + 1, 0
+        self._save_position()
+
+    def _remove(self, segment: int) -> None:
+        if self._writer is not None and segment == self.segments[-1]:
+            self._writer.close()
+            self._writer = None
+        self.segments.remove(segment)
+        try:
+            os.remove(self._path(segment))
+        except FileNotFoundError:
+            pass
+
+    def _save_position(self) -> None:
+        path = os.path.join(self.directory, POSITION_FILE)
+        with open(path + ".tmp", "wb") as f:
+            f.write(POSITION.pack(self.read_segment, self.read_offset))
+        os.replace(path + ".tmp", path)
+
+    def backlog(self) -> dict:
+        """Return the number and size of the messages not sent yet."""
+        return {
+            "messages": self.messages,
+            "bytes": self.bytes,
+            "segments": len(self.segments),
+            "dropped": self.dropped,
+        }
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
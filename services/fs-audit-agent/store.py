@@ -0,0 +1,191 @@
+"""Persistent content-addressed store backing the FSOFileDiff cache"""
+
+import json
+import os
+import threading
+import zlib
+
+MANIFEST_FILE = "manifest.json"
+# changes since the manifest was written last, one JSON array per line
+JOURNAL_FILE = "manifest.journal"
+BLOB_DIR = "blobs"
+
+
+class CacheStore:
+    """
+    Keeps cached file contents on disk across agent restarts.
+
+    Every content is stored once as a zlib compressed blob named by its
+    SHA-256. The manifest maps each path to the mtime, size and hash of
+    the content cached for it. Changes are appended to a journal, which
+    is folded into the manifest when the store is closed or the journal
+    grows too long. The manifest is only loaded on first use.
+    """
+
+    def __init__(self, directory: str, compact_after: int = 100_000):
+        self.directory = directory
+        self.compact_after = compact_after
+        self._manifest = None
+        self._journal = None
+        self._journal_lines = 0
+        # the diff workers store files concurrently
+        self._lock = threading.RLock()
+        os.makedirs(os.path.join(directory, BLOB_DIR), exist_ok=True)
+
+    @property
+    def manifest(self) -> dict:
+        """Path -> [mtime_ns, size, hash] of all stored files."""
+        if self._manifest is None:
+            with self._lock:
+                if self._manifest is None:
+                    self._load()
+        return self._manifest
+
+    def _load(self) -> None:
+        manifest = {}
+        path = os.path.join(self.directory, MANIFEST_FILE)
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+
+        journal = os.path.join(self.directory, JOURNAL_FILE)
+        lines = 0
+        torn = False
+        if os.path.exists(journal):
+            with open(journal, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        file_path, record = json.loads(line)
+                    except ValueError:
+                        # torn by a crash while appending
+                        torn = True
+                        break
+                    lines += 1
+                    if record is None:
+                        manifest.pop(file_path, None)
+                    else:
+                        manifest[file_path] = record
+        self._manifest = manifest
+        self._journal_lines = lines
+        if torn:
+            # don't append behind the damaged line
+            self.compact()
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self.directory, BLOB_DIR, digest[:2], digest)
+
+    def lookup(self, file_path: str, stat: os.stat_result) -> str | None:
+        """
+        Return the hash of the stored content of a file if the file did
+        not change since, judged by its mtime and size.
+        """
+        record = self.manifest.get(file_path)
+        if record is None:
+            return None
+        mtime_ns, size, digest = record
+        if mtime_ns != stat.st_mtime_ns or size != stat.st_size:
+            return None
+        return digest
+
+    def put(self, file_path: str, stat: os.stat_result, digest: str, data: bytes):
+        """Store the content of a file, data is written once per hash."""
+        blob = self._blob_path(digest)
+        if not os.path.exists(blob):
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            temporary = f"{blob}.{threading.get_ident()}.tmp"
+            with open(temporary, "wb") as f:
+                f.write(zlib.compress(data))
+            os.replace(temporary, blob)
+        self._record([(file_path, [stat.st_mtime_ns, stat.st_size, digest])])
+
+    def get(self, digest: str) -> bytes | None:
+        """Return the content stored for a hash."""
+        try:
+            with open(self._blob_path(digest), "rb") as f:
+                return zlib.decompress(f.read())
+        except (FileNotFoundError, zlib.error):
+            return None
+
+    def move(self, moves: list[tuple[str, str]]) -> None:
+        """Move the manifest records of files to their new paths."""
+        with self._lock:
+            changes = []
+            for old_path, new_path in moves:
+                record = self.manifest.get(old_path)
+                if record is not None:
+                    changes.append((old_path, None))
+                    changes.append((new_path, record))
+            self._record(changes)
+
+    def remove(self, file_paths: list[str]) -> None:
+        """Remove the manifest records of files."""
+        with self._lock:
+            self._record(
+                [
+                    (file_path, None)
+                    for file_path in file_paths
+                    if file_path in self.manifest
+                ],
+            )
+
+    def _record(self, changes: list[tuple[str, list | None]]) -> None:
+        """Apply changes to the manifest and append them to the journal."""
+        if not changes:
+            return
+        with self._lock:
+            for file_path, record in changes:
+                if record is None:
+                    self.manifest.pop(file_path, None)
+                else:
+                    self.manifest[file_path] = record
+            if self._journal is None:
+                self._journal = open(
+                    os.path.join(self.directory, JOURNAL_FILE),
+                    "a",
+                    encoding="utf-8",
+                )
+            self._journal.writelines(
+                json.dumps([file_path, record]) + "\n" for file_path, record in changes
+            )
+            self._journal.flush()
+            self._journal_lines += len(changes)
+            if self._journal_lines >= self.compact_after:
+                self.compact()
+
+    def compact(self) -> None:
+        """Write the manifest and start a new journal."""
+        with self._lock:
+            if self._manifest is None:
+                return
+            path = os.path.join(self.directory, MANIFEST_FILE)
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(self._manifest, f)
+            os.replace(path + ".tmp", path)
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            journal = os.path.join(self.directory, JOURNAL_FILE)
+            if os.path.exists(journal):
+                os.remove(journal)
+            self._journal_lines = 0
+
+    def collect_garbage(self) -> int:
+        """Remove blobs no path refers to anymore, returns their number."""
+        referenced = {record[2] for record in self.manifest.values()}
+        removed = 0
+        blob_dir = os.path.join(self.directory, BLOB_DIR)
+        for prefix in os.listdir(blob_dir):
+            for name in os.listdir(os.path.join(blob_dir, prefix)):
+                if name not in referenced:
+                    os.remove(os.path.join(blob_dir, prefix, name))
+                    removed += 1
+        return removed
+
+    def close(self) -> None:
+        """Fold the journal into the manifest and drop unused blobs."""
+        if self._journal_lines:
+            self.compact()
+            self.collect_garbage()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
@@ -1,8 +1,11 @@
 import os
+import random
 from tempfile import NamedTemporaryFile
 
+import delta
 import pytest
-from cache import FSOFileDiff
+from cache import FSOFileDiff, split_lines
+from store import CacheStore
 
 
 @pytest.fixture
@@ -103,3 +106,207 @@ def test_rekey_ok(temp_file, another_temp_file):
 
     # assert new file location is old file content. move worked.
     assert diff.files[another_temp_file] == ["Initial content\n"]
+
+
+def test_cold_entries_are_compressed(temp_file, another_temp_file):
+    diff = FSOFileDiff(hot_entries=1)
+    diff.add_file(temp_file)
+    diff.add_file(another_temp_file)
+
+    # the older entry is kept compressed, but still available
+    assert diff.stats()["compressed"] == 1
+    assert diff.files[temp_file] == ["Initial content\n"]
+
+    with open(temp_file, "w", encoding="utf-8") as f:
+        f.write("Modified content\n")
+    diff_output = list(diff.get_diff(temp_file))
+    assert "-Initial content\n" in diff_output
+    assert diff.stats()["hits"] == 1
+
+
+def test_eviction_keeps_hash(temp_file, another_temp_file):
+    diff = FSOFileDiff(max_bytes=30)
+    diff.add_file(temp_file)
+    diff.add_file(another_temp_file)
+
+    # only the most recently used content fits into the budget
+    assert list(diff.files) == [another_temp_file]
+    assert diff.stats()["evictions"] == 1
+    assert diff.stats()["resident_bytes"] <= 30
+
+    with open(temp_file, "w", encoding="utf-8") as f:
+        f.write("Modified content\n")
+    assert diff.get_diff(temp_file) is None
+    assert diff.stats()["misses"] == 1
+    assert diff.content_hash(temp_file) == (
+        "77859cce10d1487078b6abcce5e6c5f8861cb513797c5baaa18ee19cd302d596"
+    )
+
+
+def test_split_lines():
+    for text in ["", "a", "a\n", "a\n\nb", "a\r\n\x0bb\n"]:
+        with NamedTemporaryFile(mode="w+", encoding="utf-8", newline="") as tmp:
+            tmp.write(text)
+            tmp.flush()
+            with open(tmp.name, encoding="utf-8") as f:
+                content = f.read()
+                f.seek(0)
+                assert split_lines(content) == f.readlines()
+
+
+def test_store_restores_unchanged_files(tmp_path, temp_file, another_temp_file):
+    store_dir = str(tmp_path / "store")
+    diff = FSOFileDiff(store=CacheStore(store_dir))
+    diff.add_file(temp_file)
+    diff.add_file(another_temp_file)
+    diff.close()
+
+    with open(another_temp_file, "w", encoding="utf-8") as f:
+        f.write("Changed while the agent was down\n")
+
+    # a restarted agent only reads the changed file
+    diff = FSOFileDiff(store=CacheStore(store_dir))
+    diff.add_file(temp_file)
+    diff.add_file(another_temp_file)
+    assert list(diff.files) == [another_temp_file]
+    assert diff.content_hash(temp_file) is not None
+
+    with open(temp_file, "w", encoding="utf-8") as f:
+        f.write("Modified content\n")
+    diff_output = list(diff.get_diff(temp_file))
+    assert "-Initial content\n" in diff_output
+    assert "+Modified content\n" in diff_output
+    assert diff.stats()["loads"] == 1
+
+
+def test_store_journal(tmp_path, temp_file, another_temp_file):
+    store = CacheStore(str(tmp_path))
+    diff = FSOFileDiff(store=store)
+    diff.add_file(temp_file)
+    diff.rekey(temp_file, another_temp_file)
+    # not closed: the manifest is rebuilt from the journal
+    store = CacheStore(str(tmp_path))
+    assert list(store.manifest) == [another_temp_file]
+    store.close()
+    assert store.collect_garbage() == 0
+
+
+def test_get_diff_same_content(temp_file):
+    diff = FSOFileDiff()
+    diff.add_file(temp_file)
+
+    # metadata only
+    os.utime(temp_file, ns=(0, 0))
+    assert diff.get_diff(temp_file, update=True) == []
+    # stat unchanged since the update
+    assert diff.get_diff(temp_file) == []
+    assert diff.stats()["unchanged"] == 2
+    assert diff.stats()["diffs"] == 0
+
+
+def test_get_diff_racy_entry(temp_file):
+    diff = FSOFileDiff()
+    # read in the same timestamp tick as the write
+    diff.add_file(temp_file)
+
+    # rewritten with the same size and mtime
+    stat = os.stat(temp_file)
+    with open(temp_file, "w", encoding="utf-8") as f:
+        f.write("Changed content\n")
+    os.utime(temp_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert "+Changed content\n" in diff.get_diff(temp_file, update=True)
+    assert not diff.is_current(temp_file, stat)
+
+
+def test_get_diff_large_file(temp_file):
+    lines = [f"key{i} = {i}\n" for i in range(20000)]
+    with open(temp_file, "w", encoding="utf-8") as f:
+        f.writelines(lines)
+    diff = FSOFileDiff(large_lines=100)
+    diff.add_file(temp_file)
+
+    lines[5000] = "key5000 = changed\n"
+    lines[15000:15000] = [f"new{i}\n" for i in range(500)]
+    with open(temp_file, "w", encoding="utf-8") as f:
+        f.writelines(lines)
+
+    diff_output = diff.get_diff(temp_file)
+    assert "-key5000 = 5000\n" in diff_output
+    assert "+key5000 = changed\n" in diff_output
+    assert "+new499\n" in diff_output
+    # headers, two hunks with 6 lines of context
+    assert len(diff_output) == 2 + (1 + 6 + 2) + (1 + 6 + 500)
+    assert diff.stats()["large_diffs"] == 1
+
+
+def test_rekey_and_remove_tree(tmp_path):
+    store = CacheStore(str(tmp_path / "store"))
+    diff = FSOFileDiff(store=store)
+    old = tmp_path / "old"
+    for name in ("a", "sub/b", "sub/deeper/c"):
+        (old / name).parent.mkdir(parents=True, exist_ok=True)
+        (old / name).write_text(f"{name}\n")
+        diff.add_file(str(old / name))
+    other = tmp_path / "older"
+    other.mkdir()
+    (other / "d").write_text("d\n")
+    diff.add_file(str(other / "d"))
+
+    os.rename(old, tmp_path / "new")
+    assert diff.rekey_tree(str(old), str(tmp_path / "new")) == 3
+    new_file = str(tmp_path / "new" / "sub" / "deeper" / "c")
+    assert diff.content_hash(new_file) is not None
+    assert sorted(store.manifest) == sorted(
+        [str(tmp_path / "new" / name) for name in ("a", "sub/b", "sub/deeper/c")]
+        + [str(other / "d")],
+    )
+
+    (tmp_path / "new" / "sub" / "deeper" / "c").write_text("changed\n")
+    assert "+changed\n" in diff.get_diff(new_file)
+
+    assert diff.remove_tree(str(tmp_path / "new" / "sub")) == 2
+    assert diff.remove_tree(str(old)) == 0
+    diff.remove(str(tmp_path / "new" / "a"))
+    assert list(diff.files) == [str(other / "d")]
+    assert list(store.manifest) == [str(other / "d")]
+    # no empty directories are left in the index
+    assert str(tmp_path / "new") not in diff._subdirs.get(str(tmp_path), ())
+
+
+def test_get_delta_binary_file(tmp_path):
+    path = tmp_path / "firmware.bin"
+    base = random.Random(3).randbytes(100_000)
+    path.write_bytes(base)
+    diff = FSOFileDiff()
+    diff.add_file(str(path))
+    assert diff.is_binary(str(path))
+    assert str(path) not in diff.files
+
+    data = base[:50_000] + b"\xffpatched" + base[50_000:]
+    path.write_bytes(data)
+    instructions = diff.get_delta(str(path), update=True)
+    assert delta.apply(base, instructions) == data
+    assert delta.inserted_bytes(instructions) < len(data) // 4
+    assert diff.get_delta(str(path)) == []
+    assert diff.stats()["deltas"] == 1
+
+    # too large to be worth it
+    diff.max_delta_bytes = 0
+    path.write_bytes(b"\xff" + data)
+    assert diff.get_delta(str(path), update=True) is None
+    assert diff.get_delta(str(path)) == []
+
+
+def test_get_content(tmp_path):
+    path = tmp_path / "firmware.bin"
+    base = random.Random(4).randbytes(20_000)
+    path.write_bytes(base)
+    diff = FSOFileDiff()
+    diff.add_file(str(path))
+
+    data = b"\xff" + base
+    path.write_bytes(data)
+    assert diff.get_content(str(path), update=True) == data
+    # the content is the base of the next delta
+    assert diff.get_delta(str(path)) == []
+    assert diff.get_content(str(tmp_path / "other.bin")) is None
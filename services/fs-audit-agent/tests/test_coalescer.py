@@ -0,0 +1,121 @@
+from coalescer import EventCoalescer
+
+
+def test_repeated_modifications_are_merged():
+    coalescer = EventCoalescer(quiet_window=0.5, max_delay=5.0)
+    for now in (0.0, 0.1, 0.2):
+        coalescer.add("modified", "/a", now=now)
+
+    # the path is not quiet yet
+    assert coalescer.pop_ready(now=0.6) == []
+
+    events = coalescer.pop_ready(now=0.8)
+    assert len(events) == 1
+    assert events[0].event_type == "modified"
+    assert events[0].count == 3
+    assert coalescer.pending == {}
+
+
+def test_max_delay():
+    coalescer = EventCoalescer(quiet_window=0.5, max_delay=1.0)
+    events = []
+    for i in range(20):
+        coalescer.add("modified", "/a", now=i * 0.1)
+        events += coalescer.pop_ready(now=i * 0.1)
+
+    # the path never became quiet, but was emitted after a second
+    assert [event.count for event in events] == [11]
+    assert coalescer.pending["/a"].count == 9
+
+
+def test_net_effect():
+    coalescer = EventCoalescer(quiet_window=0.5)
+    coalescer.add("created", "/created", now=0.0)
+    coalescer.add("modified", "/created", now=0.1)
+    coalescer.add("created", "/temporary", now=0.0)
+    coalescer.add("modified", "/temporary", now=0.1)
+    coalescer.add("deleted", "/temporary", now=0.2)
+    coalescer.add("modified", "/deleted", now=0.0)
+    coalescer.add("deleted", "/deleted", now=0.1)
+    coalescer.add("deleted", "/replaced", now=0.0)
+    coalescer.add("created", "/replaced", now=0.1)
+
+    events = {event.path: event for event in coalescer.pop_ready(now=1.0)}
+    assert {path: event.event_type for path, event in events.items()} == {
+        "/created": "created",
+        "/deleted": "deleted",
+        "/replaced": "modified",
+    }
+    assert events["/created"].count == 2
+    assert coalescer.stats() == {
+        "pending": 0,
+        "received": 9,
+        "emitted": 3,
+        "cancelled": 3,
+    }
+
+
+def test_move():
+    coalescer = EventCoalescer(quiet_window=0.5)
+    coalescer.add("created", "/new", now=0.0)
+    coalescer.move("/new", "/renamed", now=0.1)
+    coalescer.add("modified", "/a", now=0.0)
+    coalescer.move("/a", "/b", now=0.1)
+    coalescer.move("/b", "/c", now=0.2)
+
+    events = {event.path: event for event in coalescer.pop_ready(now=1.0)}
+    assert events["/renamed"].event_type == "created"
+    assert events["/c"].event_type == "moved"
+    assert events["/c"].source == "/a"
+    assert events["/c"].modified
+    assert events["/c"].count == 3
+
+
+def test_move_over_moved_file():
+    coalescer = EventCoalescer(quiet_window=0.5)
+    coalescer.move("/a", "/b", now=0.0)
+    coalescer.move("/c", "/b", now=0.1)
+    coalescer.move("/x", "/y", now=0.0)
+    coalescer.add("created", "/x", now=0.1)
+    coalescer.move("/z", "/y", now=0.2)
+
+    events = {event.path: event for event in coalescer.pop_ready(now=1.0)}
+    assert sorted(events) == ["/a", "/b", "/x", "/y"]
+    # the file moved first is overwritten, its source stays deleted
+    assert events["/a"].event_type == "deleted"
+    assert events["/b"].event_type == "moved"
+    assert events["/b"].source == "/c"
+    # a new file took the place of the moved one
+    assert events["/x"].event_type == "modified"
+    assert events["/x"].count == 2
+    assert events["/y"].source == "/z"
+
+
+def test_moved_and_deleted():
+    coalescer = EventCoalescer(quiet_window=0.5)
+    coalescer.move("/a", "/b", now=0.0)
+    coalescer.add("deleted", "/b", now=0.1)
+
+    events = coalescer.pop_ready(now=1.0)
+    assert len(events) == 1
+    assert events[0].event_type == "deleted"
+    assert events[0].path == "/a"
+    assert events[0].count == 2
+
+
+def test_directory_move_and_delete():
+    coalescer = EventCoalescer(quiet_window=0.5)
+    coalescer.add("modified", "/a/x", now=0.0)
+    coalescer.add("modified", "/ab/y", now=0.0)
+    coalescer.move_tree("/a", "/b")
+    assert sorted(coalescer.pending) == ["/ab/y", "/b/x"]
+
+    coalescer.add("created", "/b/new", now=0.1)
+    coalescer.add("deleted", "/b/gone", now=0.1)
+    coalescer.move("/elsewhere", "/b/moved", now=0.1)
+    coalescer.remove_tree("/b", now=0.2)
+
+    events = {event.path: event for event in coalescer.pop_ready(now=1.0)}
+    assert sorted(events) == ["/ab/y", "/b/gone", "/elsewhere"]
+    assert events["/elsewhere"].event_type == "deleted"
+    assert coalescer.stats()["cancelled"] == 2
@@ -0,0 +1,91 @@
+import base64
+from datetime import datetime, timezone
+
+import pytest
+
+from models import (
+    CODECS,
+    FileObserverEvent,
+    decode_event,
+    read_header,
+)
+
+EVENTS = [
+    FileObserverEvent(event_type="created", file_path="/etc/app.conf"),
+    FileObserverEvent(
+        event_type="modified",
+        file_path="/etc/app.conf",
+        diff=["--- previous_version", "+++ current_version", "-a = 1", "+a = 2", ""],
+        merged_events=3,
+    ),
+    FileObserverEvent(
+        event_type="modified",
+        file_path="/data/blob.bin",
+        delta=[(0, 4096), base64.b64encode(b"\x00\xffchanged").decode("ascii")],
+        base_hash="a" * 64,
+        content_hash="b" * 64,
+    ),
+    FileObserverEvent(
+        event_type="created",
+        file_path="/data/large.bin",
+        delta=[base64.b64encode(b"first part").decode("ascii")],
+        content_hash="c" * 64,
+        partial=True,
+    ),
+    FileObserverEvent(
+        event_type="moved",
+        file_path="/srv/old",
+        destination_path="/srv/nöw",
+        is_directory=True,
+    ),
+]
+
+
+@pytest.mark.parametrize("name", ["json", "compact"])
+@pytest.mark.parametrize("event", EVENTS)
+def test_roundtrip(name, event):
+    data = CODECS[name].encode(event)
+    assert decode_event(data) == event
+    assert decode_event(data, validate=False) == event
+
+
+def test_compact_is_smaller():
+    for event in EVENTS:
+        compact = CODECS["compact"].encode(event)
+        assert len(compact) < len(CODECS["json"].encode(event))
+
+
+def test_header_without_body():
+    event = EVENTS[1]
+    data = CODECS["compact"].encode(event)
+    # the header is read without touching the body
+    header = read_header(data[: -len("".join(event.diff))])
+    assert header.event_type == "modified"
+    assert header.file_path == "/etc/app.conf"
+    assert header.timestamp == event.timestamp
+    assert header.merged_events == 3
+    with pytest.raises(ValueError):
+        decode_event(data[:-1])
+    assert read_header(CODECS["json"].encode(event)) == header
+
+
+def test_compact_timestamps_and_versions():
+    aware = datetime(2024, 11, 24, 9, 30, 30, 456000, tzinfo=timezone.utc)
+    event = FileObserverEvent(event_type="deleted", file_path="/a", timestamp=aware)
+    data = CODECS["compact"].encode(event)
+    assert decode_event(data).timestamp == aware.replace(tzinfo=None)
+
+    with pytest.raises(ValueError):
+        decode_event(data[:1] + b"\x02" + data[2:])
+
+
+def test_trusted_construction():
+    event = FileObserverEvent.trusted(
+        event_type="modified",
+        file_path="/etc/app.conf",
+        diff=["+a"],
+    )
+    # defaults are filled in like with validation
+    assert event.emitter
+    assert event.merged_events == 1
+    assert decode_event(CODECS["compact"].encode(event)) == event
@@ -0,0 +1,77 @@
+import base64
+
+import pytest
+
+from compression import (
+    BUILTIN_DICTIONARY,
+    DiffCompressor,
+    decompress,
+    dictionary_id,
+    load_dictionaries,
+    train,
+)
+from models import CODECS, FileObserverEvent, decode_event
+
+
+def config(i: int) -> str:
+    return "".join(f"option_{key} = {key * i}\n" for key in range(40))
+
+
+DIFF = ["--- previous_version", "+++ current_version", "@@ -1,40 +1,40 @@"] + [
+    f" option_{key} = {key}\n" for key in range(40)
+]
+
+
+def test_train_and_load(tmp_path):
+    dictionary = train([config(1), config(1), config(2)])
+    assert dictionary.startswith(BUILTIN_DICTIONARY)
+    # only lines seen more than once
+    assert b"option_3 = 3\\n" in dictionary
+    assert b"option_3 = 6\\n" not in dictionary
+
+    (tmp_path / "conf.dict").write_bytes(dictionary)
+    assert load_dictionaries(str(tmp_path)) == {".conf": dictionary}
+    assert load_dictionaries(str(tmp_path / "missing")) == {}
+
+
+def test_compress_with_dictionary():
+    dictionary = train([config(1), config(1)])
+    compressor = DiffCompressor({".conf": dictionary})
+    encoding, data = compressor.compress("/etc/app.conf", DIFF)
+    assert encoding == f"zlib:{dictionary_id(dictionary)}"
+    assert decompress(encoding, data, {dictionary_id(dictionary): dictionary}) == DIFF
+
+    # other files use the built-in dictionary
+    encoding, other = compressor.compress("/etc/app.ini", DIFF)
+    assert encoding == f"zlib:{dictionary_id(BUILTIN_DICTIONARY)}"
+    assert decompress(encoding, other, {}) == DIFF
+    assert len(data) < len(other)
+
+    with pytest.raises(ValueError):
+        decompress(f"zlib:{dictionary_id(dictionary)}", data, {})
+    assert compressor.stats()["compressed"] == 2
+
+
+def test_tiny_diffs_are_not_compressed():
+    compressor = DiffCompressor()
+    assert compressor.compress("/etc/app.conf", DIFF[:4]) is None
+    assert compressor.stats() == {
+        "diffs": 1,
+        "compressed": 0,
+        "bytes_in": 0,
+        "bytes_out": 0,
+    }
+
+
+def test_compressed_event_roundtrip():
+    encoding, data = DiffCompressor().compress("/etc/app.conf", DIFF)
+    event = FileObserverEvent(
+        event_type="modified",
+        file_path="/etc/app.conf",
+        diff_compression=encoding,
+        compressed_diff=base64.b64encode(data).decode("ascii"),
+    )
+    compact = CODECS["compact"].encode(event)
+    assert decode_event(compact) == event
+    # the compressed bytes are carried raw
+    assert len(compact) < len(CODECS["json"].encode(event)) - len(data) // 3
@@ -0,0 +1,26 @@
+import random
+
+import delta
+
+
+def test_delta_roundtrip():
+    generator = random.Random(1)
+    base = generator.randbytes(200_000) + bytes(50_000) + generator.randbytes(100_000)
+    data = base[:70_000] + b"inserted" + base[70_000:300_000] + base[300_100:]
+
+    instructions, signature = delta.encode(delta.signature(base), data)
+    assert delta.apply(base, instructions) == data
+    assert signature == delta.signature(data)
+    # only the chunks around the two changes are sent
+    assert delta.inserted_bytes(instructions) < 40_000
+
+
+def test_chunks_are_content_defined():
+    data = random.Random(2).randbytes(100_000)
+    boundaries = {end for _, end in delta.chunks(data)}
+    shifted = {end - 5 for _, end in delta.chunks(b"abcde" + data)}
+    # the boundaries are the same a few chunks behind the insertion
+    assert len(boundaries & shifted) >= len(boundaries) - 3
+    assert max(end - start for start, end in delta.chunks(data)) <= (
+        delta.MAX_CHUNK + 16
+    )
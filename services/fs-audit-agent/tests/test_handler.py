@@ -0,0 +1,294 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+
+import cache
+import delta
+from agent import STATS_TOPIC, FileHandler
+from coalescer import CoalescedEvent
+from metrics import Metrics
+from models import FileObserverRule
+from watchdog.events import (
+    DirMovedEvent,
+    FileCreatedEvent,
+    FileModifiedEvent,
+    FileMovedEvent,
+)
+
+
+class FakeClient:
+    binary = True
+
+    def __init__(self):
+        self.published = []
+
+    async def publish(self, topic, message):
+        self.published.append((topic, json.loads(message)))
+
+
+async def run_handler(tmp_path, events, expected, **options):
+    client = FakeClient()
+    rule = FileObserverRule(
+        exclude_patterns=[r"^.*/private/.*$"],
+        important_pattern=[r"^.*\.conf$"],
+    )
+    handler = FileHandler(client, rule, quiet_window=0.05, **options)
+    handler.initialize_cache(str(tmp_path))
+    task = asyncio.create_task(handler.run())
+
+    # watchdog calls the handler from its observer thread
+    thread = threading.Thread(target=events, args=(handler,))
+    thread.start()
+    while thread.is_alive() or len(client.published) < expected:
+        await asyncio.sleep(0.01)
+    task.cancel()
+    return client.published, handler.stats()
+
+
+def test_pipeline(tmp_path):
+    config = tmp_path / "app.conf"
+    config.write_text("a = 1\n")
+    os.mkdir(tmp_path / "private")
+
+    def events(handler):
+        handler.on_created(FileCreatedEvent(str(tmp_path / "private" / "key")))
+        for value in range(2, 5):
+            config.write_text(f"a = {value}\n")
+            handler.on_modified(FileModifiedEvent(str(config)))
+
+    published, stats = asyncio.run(
+        asyncio.wait_for(run_handler(tmp_path, events, 1), 5),
+    )
+    assert len(published) == 1
+    topic, msg = published[0]
+    assert topic == str(config)
+    assert msg["event_type"] == "modified"
+    assert msg["merged_events"] == 3
+    assert "-a = 1\n" in msg["diff"]
+    assert "+a = 4\n" in msg["diff"]
+    assert stats["raw"] == 0
+    assert stats["serialize"] == 0
+
+
+def test_directory_move_and_delete(tmp_path):
+    os.mkdir(tmp_path / "etc")
+    config = tmp_path / "etc" / "app.conf"
+    config.write_text("a = 1\n")
+    moved = tmp_path / "moved" / "app.conf"
+
+    def events(handler):
+        os.rename(tmp_path / "etc", tmp_path / "moved")
+        handler.on_moved(DirMovedEvent(str(tmp_path / "etc"), str(moved.parent)))
+        handler.on_moved(FileMovedEvent(str(config), str(moved), is_synthetic=True))
+        moved.write_text("a = 2\n")
+        handler.on_modified(FileModifiedEvent(str(moved)))
+
+    published, _ = asyncio.run(
+        asyncio.wait_for(run_handler(tmp_path, events, 2), 5),
+    )
+    topic, msg = published[0]
+    assert topic == str(tmp_path / "etc")
+    assert msg["event_type"] == "moved"
+    assert msg["is_directory"]
+    topic, msg = published[1]
+    assert topic == str(moved)
+    # the cache followed the directory, so the change has a diff
+    assert "+a = 2\n" in msg["diff"]
+    assert len(published) == 2
+
+
+async def _directory_barrier():
+    rule = FileObserverRule(exclude_patterns=[], important_pattern=[])
+    handler = FileHandler(FakeClient(), rule, diff_workers=4)
+    order = []
+
+    def process_event(event):
+        if event.event_type == "modified":
+            # a slow diff of a file below the directory
+            time.sleep(0.05)
+        order.append((event.event_type, event.path))
+        return []
+
+    handler.process_event = process_event
+    task = asyncio.create_task(handler.run())
+    await handler._diff[0].put(CoalescedEvent("modified", "/etc/a.conf", 0.0))
+    await handler._directory_event("moved_dir", "/etc", "/moved")
+    for i, queue in enumerate(handler._diff):
+        await queue.put(CoalescedEvent("created", f"/moved/{i}.conf", 0.0))
+    while len(order) < 6:
+        await asyncio.sleep(0.01)
+    task.cancel()
+    return order
+
+
+def test_directory_event_waits_for_all_workers():
+    order = asyncio.run(asyncio.wait_for(_directory_barrier(), 5))
+    assert order[:2] == [("modified", "/etc/a.conf"), ("moved_dir", "/moved")]
+    assert sorted(order[2:]) == [("created", f"/moved/{i}.conf") for i in range(4)]
+
+
+async def _file_move():
+    rule = FileObserverRule(exclude_patterns=[], important_pattern=[])
+    handler = FileHandler(FakeClient(), rule, quiet_window=0.01, diff_workers=4)
+    order = []
+
+    def process_event(event):
+        if event.event_type == "modified":
+            # a slow diff of the source before it is moved
+            time.sleep(0.05)
+        order.append((event.event_type, event.path))
+        return []
+
+    def worker(path):
+        return hash(path) % len(handler._diff)
+
+    # the source and the destination are handled by different workers
+    destination = next(
+        f"/etc/b{i}.conf"
+        for i in range(100)
+        if worker(f"/etc/b{i}.conf") != worker("/etc/a.conf")
+    )
+    handler.process_event = process_event
+    task = asyncio.create_task(handler.run())
+    await handler._diff[worker("/etc/a.conf")].put(
+        CoalescedEvent("modified", "/etc/a.conf", 0.0),
+    )
+    handler.coalescer.move("/etc/a.conf", destination)
+    while len(order) < 2:
+        await asyncio.sleep(0.01)
+    task.cancel()
+    return order, destination
+
+
+def test_file_move_waits_for_all_workers():
+    order, destination = asyncio.run(asyncio.wait_for(_file_move(), 5))
+    assert order == [("modified", "/etc/a.conf"), ("moved", destination)]
+
+
+async def _binary_versions(tmp_path):
+    existing = tmp_path / "existing.bin"
+    existing.write_bytes(b"\xff" + bytes(range(256)) * 40)
+    rule = FileObserverRule(exclude_patterns=[], important_pattern=[r"^.*\.bin$"])
+    handler = FileHandler(FakeClient(), rule)
+    handler.initialize_cache(str(tmp_path))
+
+    created = tmp_path / "created.bin"
+    created.write_bytes(b"\xff" + bytes(range(256)) * 20)
+    messages = handler.process_event(CoalescedEvent("created", str(created), 0.0))
+    created.write_bytes(b"\xff" + bytes(range(256)) * 21)
+    messages += handler.process_event(CoalescedEvent("modified", str(created), 0.0))
+    existing.write_bytes(b"\xfe" + bytes(range(256)) * 40)
+    messages += handler.process_event(CoalescedEvent("modified", str(existing), 0.0))
+    existing.write_bytes(b"\xfd" + bytes(range(256)) * 40)
+    messages += handler.process_event(CoalescedEvent("modified", str(existing), 0.0))
+    return messages
+
+
+def test_binary_versions_can_be_rebuilt(tmp_path):
+    """Test that the recorder gets the whole content before any delta."""
+    created, changed, first, second = asyncio.run(_binary_versions(tmp_path))
+    # the content of a new file
+    assert created.base_hash is None
+    assert delta.apply(b"", created.delta) == b"\xff" + bytes(range(256)) * 20
+    assert changed.base_hash == created.content_hash
+    # the first change of a file indexed at the start sends it whole
+    assert first.base_hash is None
+    assert delta.apply(b"", first.delta) == b"\xfe" + bytes(range(256)) * 40
+    assert second.base_hash == first.content_hash
+
+
+async def _large_binary(tmp_path):
+    rule = FileObserverRule(exclude_patterns=[], important_pattern=[r"^.*\.bin$"])
+    handler = FileHandler(FakeClient(), rule)
+    handler.cache.max_delta_bytes = 30_000
+    path = tmp_path / "firmware.bin"
+    data = random.Random(5).randbytes(100_000)
+    path.write_bytes(data)
+    parts = handler.process_event(CoalescedEvent("created", str(path), 0.0))
+    path.write_bytes(data[:50_000] + b"\xffpatch" + data[50_000:])
+    changed = handler.process_event(CoalescedEvent("modified", str(path), 0.0))
+    # the change is larger than a delta may be
+    path.write_bytes(random.Random(6).randbytes(70_000))
+    replaced = handler.process_event(CoalescedEvent("modified", str(path), 0.0))
+    return data, parts, changed, replaced
+
+
+def test_large_binary_files_are_sent_in_parts(tmp_path):
+    """Test that a version above max_delta_bytes is rebuilt from parts."""
+    data, parts, changed, replaced = asyncio.run(_large_binary(tmp_path))
+    assert [part.partial for part in parts] == [True, True, True, False]
+    versions = {None: b""}
+    for part in parts:
+        version = delta.apply(versions[part.base_hash], part.delta)
+        assert hashlib.sha256(version).hexdigest() == part.content_hash
+        versions[part.content_hash] = version
+    assert versions[parts[-1].content_hash] == data
+
+    # later changes are deltas against the uploaded version
+    (event,) = changed
+    assert event.base_hash == parts[-1].content_hash
+    assert delta.inserted_bytes(event.delta) < 30_000
+    assert len(replaced) == 3
+    assert replaced[0].base_hash is None
+
+
+def test_rescan(tmp_path, monkeypatch):
+    # the files of the test are all changed just now
+    monkeypatch.setattr(cache, "RACY_NS", 0)
+    config = tmp_path / "app.conf"
+    config.write_text("a = 1\n")
+    removed = tmp_path / "old.conf"
+    removed.write_text("old\n")
+    (tmp_path / "same.conf").write_text("same\n")
+
+    def events(handler):
+        # changes whose events were lost
+        config.write_text("a = 22\n")
+        removed.unlink()
+        (tmp_path / "new.conf").write_text("new\n")
+        assert handler.rescan(str(tmp_path)) == 3
+
+    published, _ = asyncio.run(
+        asyncio.wait_for(run_handler(tmp_path, events, 3), 5),
+    )
+    events = {topic: msg for topic, msg in published}
+    assert "+a = 22\n" in events[str(config)]["diff"]
+    assert events[str(removed)]["event_type"] == "deleted"
+    assert events[str(tmp_path / "new.conf")]["event_type"] == "created"
+    assert len(published) == 3
+
+
+def test_stats(tmp_path):
+    config = tmp_path / "app.conf"
+    config.write_text("a = 1\n")
+
+    def events(handler):
+        config.write_text("a = 2\n")
+        handler.on_modified(FileModifiedEvent(str(config)))
+
+    published, _ = asyncio.run(
+        asyncio.wait_for(
+            run_handler(
+                tmp_path,
+                events,
+                3,
+                metrics=Metrics(),
+                stats_interval=0.1,
+            ),
+            5,
+        ),
+    )
+    stats = [msg for topic, msg in published if topic == STATS_TOPIC]
+    # taken after the event was published
+    stats = stats[-1]
+    for stage in ["dispatch", "rules", "diff", "serialize", "publish"]:
+        assert stats["stages"][stage]["count"] >= 1
+    assert stats["counters"]["events"] == 1
+    assert stats["counters"]["messages"] >= 1
+    assert stats["counters"]["bytes_diffed"] == len("a = 2\n")
+    assert stats["queues"]["raw"] == 0
+    assert "hits" in stats["cache"]
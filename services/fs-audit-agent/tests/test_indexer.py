@@ -0,0 +1,53 @@
+from cache import FSOFileDiff
+from indexer import CacheIndexer
+from models import FileObserverRule
+from rules import CompiledRule
+
+
+def test_index_important_files(tmp_path):
+    for directory in ["etc", "etc/app", "home/joe", "src"]:
+        (tmp_path / directory).mkdir(parents=True)
+    for name in ["etc/a.conf", "etc/app/b.conf", "home/joe/c.conf", "src/main.py"]:
+        (tmp_path / name).write_text("content\n")
+
+    rule = FileObserverRule(
+        exclude_patterns=[r"^.*/joe/.*$"],
+        important_pattern=[r"^.*\.conf$"],
+    )
+    cache = FSOFileDiff()
+    indexer = CacheIndexer(CompiledRule(rule), cache, workers=2)
+    indexer.start(str(tmp_path))
+    assert indexer.wait(5)
+
+    assert sorted(cache.files) == [
+        str(tmp_path / "etc" / "a.conf"),
+        str(tmp_path / "etc" / "app" / "b.conf"),
+    ]
+    progress = indexer.progress()
+    assert progress["done"]
+    # the excluded home/joe directory is not entered
+    assert progress["directories"] == 5
+    assert progress["files"] == 3
+    assert progress["indexed"] == 2
+    assert progress["pending_directories"] == 0
+
+
+def test_unreadable_files_are_skipped(tmp_path, monkeypatch):
+    for name in ["a.conf", "b.conf", "c.conf"]:
+        (tmp_path / name).write_text("content\n")
+    rule = FileObserverRule(exclude_patterns=[], important_pattern=[r"^.*\.conf$"])
+    cache = FSOFileDiff()
+    add_file = cache.add_file
+
+    def unreadable(path, quiet=False):
+        if path.endswith("b.conf"):
+            raise PermissionError(13, "Permission denied", path)
+        add_file(path, quiet)
+
+    monkeypatch.setattr(cache, "add_file", unreadable)
+    indexer = CacheIndexer(CompiledRule(rule), cache, workers=2)
+    indexer.start(str(tmp_path))
+    assert indexer.wait(5)
+
+    assert sorted(cache.files) == [str(tmp_path / "a.conf"), str(tmp_path / "c.conf")]
+    assert indexer.progress()["errors"] == 1
@@ -0,0 +1,132 @@
+import os
+import sys
+import time
+
+import pytest
+from inotify import (
+    EVENT,
+    IN_ISDIR,
+    IN_MODIFY,
+    IN_MOVED_FROM,
+    IN_MOVED_TO,
+    InotifyObserver,
+)
+from models import FileObserverRule
+from rules import CompiledRule
+
+pytestmark = pytest.mark.skipif(
+    not sys.platform.startswith("linux"),
+    reason="inotify is Linux only",
+)
+
+
+class FakeHandler:
+    def __init__(self):
+        self.rules = CompiledRule(
+            FileObserverRule(
+                exclude_patterns=[r"^.*/private/.*$"],
+                important_pattern=[],
+            ),
+        )
+        self.events = []
+        self.rescans = 0
+
+    def submit_batch(self, events):
+        self.events.extend(events)
+
+    def rescan(self, root, on_directory=None):
+        self.rescans += 1
+
+
+def wait_for(handler, count):
+    deadline = time.monotonic() + 5
+    while len(handler.events) < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return handler.events
+
+
+def test_inotify_events(tmp_path):
+    os.mkdir(tmp_path / "etc")
+    os.mkdir(tmp_path / "private")
+    handler = FakeHandler()
+    observer = InotifyObserver(timeout=0.05)
+    observer.schedule(handler, str(tmp_path))
+    observer.start()
+    try:
+        (tmp_path / "private" / "key").write_text("secret\n")
+        (tmp_path / "etc" / "a.conf").write_text("a = 1\n")
+        os.rename(tmp_path / "etc" / "a.conf", tmp_path / "etc" / "b.conf")
+        os.rename(tmp_path / "etc", tmp_path / "moved")
+        (tmp_path / "moved" / "b.conf").write_text("a = 2\n")
+        os.mkdir(tmp_path / "new")
+        # the watch is added once the event for the directory was read
+        wait_for(handler, 5)
+        (tmp_path / "new" / "c.conf").write_text("c\n")
+        os.remove(tmp_path / "new" / "c.conf")
+        os.rmdir(tmp_path / "new")
+        events = wait_for(handler, 8)
+        time.sleep(0.1)
+    finally:
+        observer.stop()
+        observer.join()
+
+    a, b = str(tmp_path / "etc" / "a.conf"), str(tmp_path / "etc" / "b.conf")
+    assert events[0] == ("created", a, None)
+    assert ("modified", a, None) in events
+    assert ("moved", a, b) in events
+    assert ("moved_dir", str(tmp_path / "etc"), str(tmp_path / "moved")) in events
+    # the watch followed the moved directory
+    assert ("modified", str(tmp_path / "moved" / "b.conf"), None) in events
+    assert ("deleted", str(tmp_path / "new" / "c.conf"), None) in events
+    assert events[-1] == ("deleted_dir", str(tmp_path / "new"), None)
+    # excluded directories are not watched
+    assert not any("private" in event[1] for event in events)
+    assert observer.overflows == 0
+
+
+def read(observer, *events):
+    """Decode the raw inotify events as if they came with one read."""
+    data = b""
+    for wd, mask, cookie, name in events:
+        name = name.encode() + b"\0"
+        data += EVENT.pack(wd, mask, cookie, len(name)) + name
+    return observer._decode(memoryview(data), len(data))[0]
+
+
+def test_move_split_across_reads(tmp_path):
+    observer = InotifyObserver(move_window=0.2)
+    observer.schedule(FakeHandler(), str(tmp_path))
+    observer._paths[1] = str(tmp_path)
+    a, b, c = (str(tmp_path / name) for name in ["a", "b", "c"])
+
+    # the events behind the moved from event wait for its moved to event
+    assert read(observer, (1, IN_MOVED_FROM, 7, "a"), (1, IN_MODIFY, 0, "c")) == []
+    assert read(observer, (1, IN_MOVED_TO, 7, "b")) == [
+        ("moved", a, b),
+        ("modified", c, None),
+    ]
+
+    # moved out of the tree
+    observer.move_window = 0
+    assert read(observer, (1, IN_MOVED_FROM, 8, "b")) == []
+    assert read(observer, (1, IN_MODIFY, 0, "c")) == [
+        ("deleted", b, None),
+        ("modified", c, None),
+    ]
+
+
+def test_excluded_directory_moved_in(tmp_path):
+    os.makedirs(tmp_path / "outside" / "private" / "keys")
+    os.mkdir(tmp_path / "tree")
+    observer = InotifyObserver()
+    observer.schedule(FakeHandler(), str(tmp_path / "tree"))
+    observer._fd = observer._libc.inotify_init1(0)
+    observer._paths[1] = str(tmp_path / "tree")
+    try:
+        os.rename(tmp_path / "outside" / "private", tmp_path / "tree" / "private")
+        batch = read(observer, (1, IN_MOVED_TO | IN_ISDIR, 9, "private"))
+    finally:
+        os.close(observer._fd)
+
+    assert batch == []
+    assert observer._watches == {}
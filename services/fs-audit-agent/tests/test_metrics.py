@@ -0,0 +1,56 @@
+import threading
+import time
+
+from metrics import Histogram, Metrics, SamplingProfiler
+
+
+def test_histogram():
+    histogram = Histogram()
+    for us in [1, 2, 3, 4, 100]:
+        histogram.observe(us * 1000)
+    snapshot = histogram.snapshot()
+    assert snapshot["count"] == 5
+    assert snapshot["mean_us"] == 22
+    assert snapshot["max_us"] == 100
+    # upper bounds of the power of two buckets
+    assert 3 <= snapshot["p50_us"] <= 4.1
+    assert snapshot["p99_us"] == 100
+
+
+def test_metrics_toggle():
+    metrics = Metrics(enabled=False)
+    assert metrics.start() == 0
+    metrics.observe("diff", metrics.start())
+    metrics.add("events")
+    assert metrics.snapshot() == {"stages": {}, "counters": {}, "rates": {}}
+
+    metrics.enabled = True
+    metrics.observe("diff", metrics.start())
+    metrics.add("events", 10)
+    snapshot = metrics.snapshot()
+    assert snapshot["stages"]["diff"]["count"] == 1
+    assert snapshot["counters"] == {"events": 10}
+    assert snapshot["rates"]["events"] > 0
+    # rates are taken since the previous snapshot
+    assert metrics.snapshot()["rates"] == {"events": 0}
+
+
+def busy_loop(stopped):
+    while not stopped.is_set():
+        sum(range(1000))
+
+
+def test_profiler():
+    stopped = threading.Event()
+    thread = threading.Thread(target=busy_loop, args=(stopped,))
+    thread.start()
+    profiler = SamplingProfiler(interval=0.001)
+    profiler.start()
+    time.sleep(0.1)
+    profiler.stop()
+    stopped.set()
+    thread.join()
+
+    assert profiler.samples > 0
+    stacks = [" ".join(entry["stack"]) for entry in profiler.top()]
+    assert any("busy_loop" in stack for stack in stacks)
@@ -0,0 +1,132 @@
+import os
+
+import pytest
+import reconcile
+from cache import FSOFileDiff
+from models import FileObserverRule
+from reconcile import Reconciler, TreeManifest
+from rules import CompiledRule
+from store import CacheStore
+
+
+class FakeHandler:
+    def __init__(self, cache):
+        self.rules = CompiledRule(
+            FileObserverRule(
+                exclude_patterns=[r"^.*/private/.*$"],
+                important_pattern=[r"^.*\.conf$"],
+            ),
+        )
+        self.cache = cache
+        self.events = []
+
+    def submit_batch(self, events):
+        self.events.extend(events)
+
+
+@pytest.fixture(autouse=True)
+def no_racy_window(monkeypatch):
+    # the files of the tests are all changed just now
+    monkeypatch.setattr(reconcile, "RACY_NS", 0)
+
+
+def run(tmp_path, root):
+    cache = FSOFileDiff(store=CacheStore(str(tmp_path / "store")))
+    handler = FakeHandler(cache)
+    manifest = TreeManifest(str(tmp_path / "manifest.sqlite"))
+    reconciler = Reconciler(handler, manifest)
+    stats = reconciler.run(str(root))
+    return handler, manifest, stats
+
+
+def test_reconcile(tmp_path):
+    root = tmp_path / "tree"
+    for directory in ["etc", "etc/app", "private", "var/log"]:
+        (root / directory).mkdir(parents=True)
+    for name in ["etc/a.conf", "etc/app/b.conf", "private/key", "var/log/old"]:
+        (root / name).write_text("1\n")
+
+    # the first run only records the tree
+    handler, manifest, stats = run(tmp_path, root)
+    assert handler.events == []
+    assert stats["files"] == 3
+    for name in ["etc/a.conf", "etc/app/b.conf"]:
+        handler.cache.add_file(str(root / name))
+    handler.cache.close()
+    manifest.close()
+
+    # nothing changed: only the root is listed, its mtime was recorded
+    handler, manifest, stats = run(tmp_path, root)
+    assert handler.events == []
+    assert stats["listed"] == 0
+    manifest.close()
+
+    # changes while the agent was down
+    (root / "etc" / "a.conf").write_text("2\n")
+    (root / "etc" / "app" / "c.conf").write_text("new\n")
+    (root / "var" / "log" / "old").unlink()
+    os.rmdir(root / "var" / "log")
+    (root / "private" / "key").write_text("2\n")
+    handler, manifest, stats = run(tmp_path, root)
+    assert sorted(handler.events) == [
+        ("created", str(root / "etc" / "app" / "c.conf"), None),
+        ("deleted_dir", str(root / "var" / "log"), None),
+        ("modified", str(root / "etc" / "a.conf"), None),
+    ]
+    # the version from before the restart is back for the diff
+    diff = handler.cache.get_diff(str(root / "etc" / "a.conf"))
+    assert "-1\n" in diff and "+2\n" in diff
+    # directories with changes are listed until the handler recorded them
+    app = root / "etc" / "app"
+    assert manifest.get(str(app))[2] != os.stat(app).st_mtime_ns
+    manifest.close()
+
+
+def test_manifest_move_tree(tmp_path):
+    manifest = TreeManifest(str(tmp_path / "manifest.sqlite"))
+    for path in ["/w/a", "/w/a/b", "/w/a/b/c", "/w/ab"]:
+        manifest.put(path, os.stat(tmp_path), is_dir=True)
+    manifest.move_tree("/w/a", "/w/z")
+
+    assert manifest.get("/w/a") is None
+    assert manifest.get("/w/z")[2] is None
+    assert sorted(manifest.children("/w")) == ["/w/ab", "/w/z"]
+    assert list(manifest.children("/w/z/b")) == ["/w/z/b/c"]
+
+    manifest.remove_tree("/w/z")
+    assert list(manifest.children("/w")) == ["/w/ab"]
+    manifest.close()
+
+
+def test_racy_entries_compare_content(tmp_path, monkeypatch):
+    """Test that entries recorded within the racy window are hashed."""
+    monkeypatch.setattr(reconcile, "RACY_NS", 10**12)
+    root = tmp_path / "tree"
+    root.mkdir()
+    notes = root / "notes.txt"
+    same = root / "same.txt"
+    notes.write_text("abc\n")
+    same.write_text("abc\n")
+    handler, manifest, _ = run(tmp_path, root)
+    manifest.close()
+
+    # rewritten with the same size and mtime
+    stat = os.stat(notes)
+    notes.write_text("xyz\n")
+    os.utime(notes, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    handler, manifest, _ = run(tmp_path, root)
+    assert handler.events == [("modified", str(notes), None)]
+    manifest.close()
+
+
+def test_deleted_while_down_leaves_no_store_record(tmp_path):
+    path = tmp_path / "a.conf"
+    path.write_text("1\n")
+    cache = FSOFileDiff(store=CacheStore(str(tmp_path / "store")))
+    cache.add_file(str(path))
+    cache.close()
+
+    path.unlink()
+    store = CacheStore(str(tmp_path / "store"))
+    FSOFileDiff(store=store).remove(str(path))
+    assert str(path) not in store.manifest
@@ -0,0 +1,92 @@
+import asyncio
+import re
+
+import pytest
+from models import FileObserverRule
+from rules import CompiledRule, classify
+
+EXCLUDE = [
+    r"^.*/joe/.*$",
+    r"^.*\.tmp$",
+    r"^.*__pycache__$",
+    r"^/var/cache",
+    r"^/etc/shadow$",
+    r"secret",
+    r"^.*\.bak\d+$",
+    r"(?i)^.*\.KEY$",
+    r"^.*(a)\1$",
+]
+
+
+@pytest.mark.parametrize(
+    "pattern, expected",
+    [
+        (r"^.*\.conf$", ("suffix", ".conf")),
+        (r"^.*/joe/.*$", ("substring", "/joe/")),
+        (r"^/var/cache", ("prefix", "/var/cache")),
+        (r"^/etc/shadow$", ("exact", "/etc/shadow")),
+        (r"secret", ("substring", "secret")),
+        (r"^.*\.bak\d+$", ("regex", None)),
+        (r"^.*\\$", ("suffix", "\\")),
+        (r"^.*\$", ("substring", "$")),
+    ],
+)
+def test_classify(pattern, expected):
+    assert classify(re.compile(pattern)) == expected
+
+
+@pytest.mark.parametrize(
+    "path",
+    [
+        "/home/joe/notes.txt",
+        "/home/joey/notes.txt",
+        "/home/a/joe",
+        "/tmp/build.tmp",
+        "/src/__pycache__",
+        "/var/cache/apt/x",
+        "/var/cachet",
+        "/etc/shadow",
+        "/etc/shadow.bak",
+        "/etc/shadow.bak12",
+        "/srv/secrets/db",
+        "/srv/id.key",
+        "/srv/id.KEY",
+        "/srv/aa",
+        "/srv/joe/\n",
+        "relative/joe/file",
+        "file.tmp",
+    ],
+)
+def test_same_result_as_patterns(path):
+    rule = FileObserverRule(exclude_patterns=EXCLUDE, important_pattern=[])
+    compiled = CompiledRule(rule)
+    expected = any(pattern.search(path) for pattern in rule.exclude_patterns)
+    assert compiled.is_excluded(path) == expected
+
+
+def test_excludes_tree():
+    rule = FileObserverRule(exclude_patterns=EXCLUDE, important_pattern=[])
+    compiled = CompiledRule(rule)
+    assert compiled.excludes_tree("/home/joe")
+    assert compiled.excludes_tree("/var/cache")
+    assert compiled.excludes_tree("/srv/secrets")
+    assert not compiled.excludes_tree("/home/joey")
+    # the regex patterns can't exclude a whole directory
+    assert not compiled.excludes_tree("/srv/aa")
+
+
+def test_initialize_cache_skips_excluded_tree(tmp_path):
+    from agent import FileHandler
+
+    (tmp_path / "joe").mkdir()
+    (tmp_path / "joe" / "private.conf").write_text("secret\n")
+    (tmp_path / "app.conf").write_text("a = 1\n")
+    rule = FileObserverRule(exclude_patterns=[r"^.*/joe/.*$"], important_pattern=[])
+
+    async def initialize():
+        handler = FileHandler(client=None, rule=rule)
+        handler.initialize_cache(str(tmp_path))
+        return handler
+
+    handler = asyncio.run(initialize())
+    assert list(handler.cache.files) == [str(tmp_path / "app.conf")]
@@ -0,0 +1,184 @@
+import asyncio
+
+from agent import FSOMessageClient
+from spool import Spool
+
+
+def test_spool_order_and_restart(tmp_path):
+    spool = Spool(str(tmp_path), segment_bytes=64)
+    for i in range(10):
+        spool.append("events", f"message {i}")
+    spool.append("diffs", b"\x00binary")
+    assert spool.backlog()["messages"] == 11
+    assert spool.backlog()["segments"] > 1
+
+    messages, position = spool.read(max_bytes=100)
+    assert messages[0] == ("events", "message 0")
+    spool.consume(position, len(messages))
+    spool.close()
+
+    # the read position survives a restart
+    spool = Spool(str(tmp_path), segment_bytes=64)
+    rest = []
+    while spool.pending:
+        batch, position = spool.read()
+        rest.extend(batch)
+        spool.consume(position, len(batch))
+    assert messages + rest == [("events", f"message {i}") for i in range(10)] + [
+        ("diffs", b"\x00binary"),
+    ]
+    assert spool.backlog() == {"messages": 0, "bytes": 0, "segments": 0, "dropped": 0}
+
+
+def test_spool_drops_oldest_segment(tmp_path):
+    spool = Spool(str(tmp_path), segment_bytes=100, max_bytes=300)
+    for i in range(50):
+        spool.append("events", f"message {i:02d}")
+
+    backlog = spool.backlog()
+    assert backlog["bytes"] <= 300
+    assert backlog["dropped"] + backlog["messages"] == 50
+    messages = []
+    while spool.pending:
+        batch, position = spool.read()
+        messages.extend(batch)
+        spool.consume(position, len(batch))
+    # the newest messages are kept
+    assert messages == [
+        ("events", f"message {i:02d}") for i in range(backlog["dropped"], 50)
+    ]
+
+
+async def _reconnect(tmp_path):
+    received = []
+    connections = []
+
+    async def handle(reader, writer):
+        connections.append(writer)
+        while line := await reader.readline():
+            if line.startswith(b"PUBLISH "):
+                received.append(line.decode("utf-8").split()[-1])
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    client = FSOMessageClient(
+        port=port,
+        spool_dir=str(tmp_path / "spool"),
+        reconnect_delay=0.01,
+    )
+    await client.connect()
+    await client.publish("events", "a")
+    while not received:
+        await asyncio.sleep(0.01)
+
+    # the broker restarts
+    server.close()
+    for writer in connections:
+        writer.close()
+    await server.wait_closed()
+    while client.connected:
+        await asyncio.sleep(0.01)
+    for message in ["b", "c", "d"]:
+        await client.publish("events", message)
+    assert client.backlog()["spool"]["messages"] == 3
+
+    server = await asyncio.start_server(handle, "127.0.0.1", port)
+    while len(received) < 4:
+        await asyncio.sleep(0.01)
+    await client.publish("events", "e")
+    while len(received) < 5:
+        await asyncio.sleep(0.01)
+
+    backlog = client.backlog()
+    await client.disconnect()
+    server.close()
+    return received, backlog
+
+
+def test_client_spools_while_disconnected(tmp_path):
+    received, backlog = asyncio.run(_reconnect(tmp_path))
+    assert received == ["a", "b", "c", "d", "e"]
+    assert backlog["connected"]
+    assert backlog["reconnects"] == 1
+    assert backlog["published"] == 5
+    assert backlog["spool"]["messages"] == 0
+
+
+async def _start_without_broker(tmp_path):
+    received = []
+
+    async def handle(reader, writer):
+        while line := await reader.readline():
+            if line.startswith(b"PUBLISH "):
+                received.append(line.decode("utf-8").split()[-1])
+
+    # a free port nobody listens on yet
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    server.close()
+    await server.wait_closed()
+
+    client = FSOMessageClient(
+        port=port,
+        spool_dir=str(tmp_path / "spool"),
+        reconnect_delay=0.01,
+        max_reconnect_delay=0.05,
+    )
+    client.start()
+    await client.publish("events", "a")
+    await client.publish("events", "b")
+    spooled = client.backlog()["spool"]["messages"]
+
+    server = await asyncio.start_server(handle, "127.0.0.1", port)
+    while len(received) < 2:
+        await asyncio.sleep(0.01)
+    await client.disconnect()
+    server.close()
+    return received, spooled
+
+
+def test_client_starts_without_broker(tmp_path):
+    received, spooled = asyncio.run(_start_without_broker(tmp_path))
+    assert spooled == 2
+    assert received == ["a", "b"]
+
+
+async def _handshake_fails_once(tmp_path):
+    received = []
+
+    async def handle(reader, writer):
+        while line := await reader.readline():
+            if line.startswith(b"PUBLISH "):
+                received.append(line.decode("utf-8").split()[-1])
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    client = FSOMessageClient(
+        port=port,
+        binary=True,
+        spool_dir=str(tmp_path / "spool"),
+        reconnect_delay=0.01,
+    )
+    negotiated = []
+
+    async def negotiate():
+        negotiated.append(True)
+        if len(negotiated) == 1:
+            raise ConnectionResetError("Connection reset by peer")
+        client.binary = False
+
+    client._negotiate = negotiate
+    await client.publish("events", "a")
+    await client.connect()
+    await client.publish("events", "b")
+    while len(received) < 2:
+        await asyncio.sleep(0.01)
+    await client.disconnect()
+    server.close()
+    return received, len(negotiated)
+
+
+def test_client_retries_the_handshake(tmp_path):
+    received, attempts = asyncio.run(_handshake_fails_once(tmp_path))
+    assert attempts == 2
+    assert received == ["a", "b"]
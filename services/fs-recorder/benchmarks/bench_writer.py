@@ -0,0 +1,82 @@
+"""
+Benchmark of the log writer: lines per second and latency of writing
+events to the log, reopening the file for every line as before and with
+the group commit writer under each fsync policy, and with the log cut
+into segments of 1 MiB sealed in the background.
+
+Run from the recorder directory:
+
+    python benchmarks/bench_writer.py
+"""
+
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aiofiles  # noqa: E402
+
+from recorder import LogWriter, SegmentedLog, read_log  # noqa: E402
+
+LINES = 20000
+LINE = json.dumps({"topic": "/tmp/enlyze/app.conf", "payload": {"diff": ["x" * 200]}})
+
+
+async def reopen(path: str) -> float:
+    start = time.perf_counter()
+    for _ in range(LINES):
+        async with aiofiles.open(path, "a", encoding="utf-8") as f:
+            await f.write(LINE + "\n")
+    return time.perf_counter() - start
+
+
+async def group_commit(
+    path: str,
+    fsync: str,
+    segments: SegmentedLog | None = None,
+) -> tuple[float, dict]:
+    writer = LogWriter(path, fsync, segments=segments)
+    start = time.perf_counter()
+    for _ in range(LINES):
+        await writer.write(LINE + "\n")
+        # messages arrive from the broker connection
+        await asyncio.sleep(0)
+    await writer.close()
+    return time.perf_counter() - start, writer.stats()
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as directory:
+        elapsed = await reopen(os.path.join(directory, "reopen.jsonl"))
+        print(f"reopen per line   {LINES / elapsed:9.0f} lines/s")
+        for fsync in ["never", "batch", "100"]:
+            path = os.path.join(directory, f"{fsync}.jsonl")
+            elapsed, stats = await group_commit(path, fsync)
+            print(
+                f"fsync {fsync:11s} {LINES / elapsed:9.0f} lines/s  "
+                f"{stats['batches']:5d} batches  {stats['fsyncs']:5d} fsyncs  "
+                f"latency mean {stats['mean_latency_ms']:.1f} ms "
+                f"max {stats['max_latency_ms']:.1f} ms",
+            )
+
+        path = os.path.join(directory, "segmented", "audit.jsonl")
+        segments = SegmentedLog(path, max_bytes=1024 * 1024)
+        elapsed, stats = await group_commit(path, "batch", segments)
+        size = sum(os.path.getsize(segment) for segment in segments.segments())
+        print(
+            f"segmented batch   {LINES / elapsed:9.0f} lines/s  "
+            f"{stats['segments_sealed']:5d} segments  "
+            f"{stats['bytes'] / 1024:.0f} KiB logged, {size / 1024:.0f} KiB stored",
+        )
+        start = time.perf_counter()
+        lines = sum(1 for _ in read_log(path, verify=True))
+        elapsed = time.perf_counter() - start
+        print(f"read segments     {lines / elapsed:9.0f} lines/s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,17 +1,713 @@
 import asyncio
 import base64
+import gzip
+import hashlib
 import json
 import os
+import re
+import shutil
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
 
 import aiofiles
 
+# binary broker protocol: type, topic length, body length, topic, body
+PROTOCOL_BINARY = 2
+FRAME_HEADER = struct.Struct("!BHI")
+FRAME_SUBSCRIBE = 1
+FRAME_PUBLISH = 2
+FRAME_SUBSCRIBE_GROUP = 8
+# seconds to wait for the broker to answer the protocol negotiation
+HANDSHAKE_TIMEOUT = 2.0
+
+# compact event encoding of the agent, see CompactCodec in the agent's models
+COMPACT_HEADER = struct.Struct("!BBBBqI")
+COMPACT_MAGIC = 0xFE
+COMPACT_VERSION = 1
+EVENT_TYPES = ("created", "modified", "deleted", "moved")
+FLAG_DIRECTORY = 0x01
+FLAG_DESTINATION = 0x02
+FLAG_CONTENT_HASH = 0x04
+FLAG_BASE_HASH = 0x08
+FLAG_DIFF = 0x10
+FLAG_DELTA = 0x20
+FLAG_COMPRESSED_DIFF = 0x40
+FLAG_PARTIAL = 0x80
+EPOCH = datetime(1970, 1, 1)
+STRING = struct.Struct("!H")
+SIZE = struct.Struct("!I")
+COPY = struct.Struct("!BQQ")
+INSERT = struct.Struct("!BI")
+
+# preset dictionary of diffs without one of their own, see the agent's
+# compression module
+BUILTIN_DICTIONARY = b'["--- previous_version", "+++ current_version", "@@ -'
+
+# segmented log, see SegmentedLog
+SEGMENT_BYTES = 64 * 1024 * 1024
+SEGMENT_SECONDS = 24 * 3600
+# the timestamp of the event in a logged line, the first one is the
+# event's, quotes within strings are escaped
+TIMESTAMP = re.compile(rb'"timestamp": "([^"]+)"')
+
+
+def encode_frame(frame_type: int, topic: str = "", body: bytes = b"") -> bytes:
+    """Encode a frame of the binary broker protocol."""
+    topic = topic.encode("utf-8")
+    return FRAME_HEADER.pack(frame_type, len(topic), len(body)) + topic + body
+
+
+def apply_delta(base: bytes, delta: list) -> bytes:
+    """
+    Rebuild a binary file from its base version and the delta of an
+    event: [offset, length] copies from the base, strings are base64
+    encoded bytes to insert.
+    """
+    parts = []
+    for item in delta:
+        if isinstance(item, str):
+            parts.append(base64.b64decode(item))
+        else:
+            offset, length = item
+            parts.append(base[offset : offset + length])
+    return b"".join(parts)
+
+
+def rebuild_version(versions: str, payload: dict, drop_base: bool = False) -> bool:
+    """
+    Write the version of a binary file rebuilt from the delta of an
+    event to the versions directory. A delta without base_hash carries
+    the whole content. drop_base removes the base afterwards, a part of
+    a version sent in parts. Returns False if the delta was not applied.
+    """
+    base = b""
+    base_path = None
+    if payload.get("base_hash") is not None:
+        base_path = os.path.join(versions, payload["base_hash"])
+        if not os.path.exists(base_path):
+            print(f"Base version {payload['base_hash']} unknown, delta not applied.")
+            return False
+        with open(base_path, "rb") as f:
+            base = f.read()
+    data = apply_delta(base, payload["delta"])
+    if hashlib.sha256(data).hexdigest() != payload["content_hash"]:
+        print(f"Delta for {payload['file_path']} does not match its hash.")
+        return False
+    with open(os.path.join(versions, payload["content_hash"]), "wb") as f:
+        f.write(data)
+    if drop_base and base_path is not None:
+        os.remove(base_path)
+    return True
+
+
+def decode_compact(body: bytes) -> dict:
+    """
+    Decode a compact encoded event into the fields of its JSON encoding,
+    so both are logged the same way.
+    """
+    magic, version, event_type, flags, micros, merged = COMPACT_HEADER.unpack_from(
+        body,
+    )
+    if magic != COMPACT_MAGIC or version != COMPACT_VERSION:
+        raise ValueError(f"Unsupported event encoding {magic:#x} v{version}")
+    offset = COMPACT_HEADER.size
+
+    def string():
+        nonlocal offset
+        (size,) = STRING.unpack_from(body, offset)
+        offset += STRING.size + size
+        return body[offset - size : offset].decode("utf-8")
+
+    def size():
+        nonlocal offset
+        offset += SIZE.size
+        return SIZE.unpack_from(body, offset - SIZE.size)[0]
+
+    payload = {"emitter": string(), "event_type": EVENT_TYPES[event_type]}
+    payload["timestamp"] = (EPOCH + timedelta(microseconds=micros)).isoformat()
+    payload["file_path"] = string()
+    payload["destination_path"] = string() if flags & FLAG_DESTINATION else None
+    content_hash = string() if flags & FLAG_CONTENT_HASH else None
+    base_hash = string() if flags & FLAG_BASE_HASH else None
+    size()
+    diff = None
+    if flags & FLAG_DIFF:
+        diff = []
+        for _ in range(size()):
+            length = size()
+            diff.append(body[offset : offset + length].decode("utf-8"))
+            offset += length
+    delta = None
+    if flags & FLAG_DELTA:
+        delta = []
+        for _ in range(size()):
+            if body[offset]:
+                _, length = INSERT.unpack_from(body, offset)
+                offset += INSERT.size + length
+                inserted = body[offset - length : offset]
+                delta.append(base64.b64encode(inserted).decode("ascii"))
+            else:
+                _, base_offset, length = COPY.unpack_from(body, offset)
+                offset += COPY.size
+                delta.append([base_offset, length])
+    diff_compression = compressed_diff = None
+    if flags & FLAG_COMPRESSED_DIFF:
+        diff_compression = string()
+        length = size()
+        offset += length
+        compressed_diff = base64.b64encode(body[offset - length : offset]).decode()
+    payload.update(
+        diff=diff,
+        diff_compression=diff_compression,
+        compressed_diff=compressed_diff,
+        delta=delta,
+        base_hash=base_hash,
+        content_hash=content_hash,
+        merged_events=merged,
+        is_directory=bool(flags & FLAG_DIRECTORY),
+        partial=bool(flags & FLAG_PARTIAL),
+    )
+    return payload
+
+
+def dictionary_id(dictionary: bytes) -> str:
+    """Identify a dictionary by its content, like the agent does."""
+    return hashlib.sha256(dictionary).hexdigest()[:16]
+
+
+def load_dictionaries(directory: str) -> dict[str, bytes]:
+    """Load the diff dictionaries shared with the agents by their id."""
+    dictionaries = {dictionary_id(BUILTIN_DICTIONARY): BUILTIN_DICTIONARY}
+    for name in os.listdir(directory):
+        if name.endswith(".dict"):
+            with open(os.path.join(directory, name), "rb") as f:
+                dictionary = f.read()
+            dictionaries[dictionary_id(dictionary)] = dictionary
+    return dictionaries
+
+
+def expand_diff(payload: dict, dictionaries: dict[str, bytes]) -> None:
+    """Replace the compressed diff of an event by its diff lines."""
+    method, _, dictionary = payload["diff_compression"].partition(":")
+    if method != "zlib" or (dictionary and dictionary not in dictionaries):
+        raise ValueError(f"Unknown diff compression {payload['diff_compression']}")
+    if dictionary:
+        decompressor = zlib.decompressobj(zdict=dictionaries[dictionary])
+    else:
+        decompressor = zlib.decompressobj()
+    data = base64.b64decode(payload["compressed_diff"])
+    payload["diff"] = json.loads(decompressor.decompress(data) + decompressor.flush())
+    payload["diff_compression"] = payload["compressed_diff"] = None
+
+
+def parse_payload(body: bytes) -> dict:
+    """Decode an event body in any of the encodings of the agent."""
+    if body[:1] == bytes([COMPACT_MAGIC]):
+        return decode_compact(body)
+    return json.loads(body)
+
+
+class SegmentedLog:
+    """
+    The log as numbered segments next to its path, for audit.jsonl:
+
+    - audit.00000001.jsonl is written until it holds max_bytes or is
+      max_age seconds old, then the writer continues with the next one.
+    - A full segment is sealed in the background: compressed to
+      audit.00000001.jsonl.gz, a gzip file whose first member is a header
+      line with the time range and number of its events and the SHA-256
+      of its lines, so it can be looked at without decompressing it.
+    - After sealing, the oldest sealed segments beyond keep_bytes in
+      total or sealed more than keep_days ago are deleted, or moved to
+      the archive directory if there is one.
+
+    The segments are found by their names, seal() and retain() block and
+    run in an executor.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_bytes: int = SEGMENT_BYTES,
+        max_age: float = SEGMENT_SECONDS,
+        keep_bytes: int | None = None,
+        keep_days: float | None = None,
+        archive: str | None = None,
+        level: int = 6,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.keep_bytes = keep_bytes
+        self.keep_days = keep_days
+        self.archive = archive
+        self.level = level
+        self.directory = os.path.dirname(path)
+        stem = os.path.splitext(os.path.basename(path))[0]
+        self._stem = stem
+        self._pattern = re.compile(re.escape(stem) + r"\.(\d{8})\.jsonl(\.gz)?$")
+        self._sequence = None
+        # seals run concurrently in the executor, their retention must not
+        # remove the same segments twice
+        self._retain_lock = threading.Lock()
+
+    def segments(self) -> list[str]:
+        """Return the paths of the segments, oldest first."""
+        by_sequence = {}
+        if not os.path.isdir(self.directory):
+            return []
+        for name in os.listdir(self.directory):
+            match = self._pattern.match(name)
+            if match:
+                sequence = int(match.group(1))
+                # a segment that is being sealed is read from the sealed file
+                if match.group(2) or sequence not in by_sequence:
+                    by_sequence[sequence] = os.path.join(self.directory, name)
+        return [by_sequence[sequence] for sequence in sorted(by_sequence)]
+
+    def unsealed(self) -> list[str]:
+        return [path for path in self.segments() if not path.endswith(".gz")]
+
+    def next_path(self) -> str:
+        """Return the path of a new segment after all existing ones."""
+        if self._sequence is None:
+            self._sequence = 0
+            for path in self.segments():
+                match = self._pattern.match(os.path.basename(path))
+                self._sequence = max(self._sequence, int(match.group(1)))
+        self._sequence += 1
+        return os.path.join(self.directory, f"{self._stem}.{self._sequence:08d}.jsonl")
+
+    def seal(self, path: str) -> dict | None:
+        """
+        Compress a segment that is no longer written, return its header
+        or None if it was empty and removed.
+        """
+        if os.path.getsize(path) == 0:
+            os.remove(path)
+            return None
+        digest = hashlib.sha256()
+        header = {"first": None, "last": None, "events": 0, "bytes": 0}
+        with open(path, "rb") as f:
+            for line in f:
+                digest.update(line)
+                header["events"] += 1
+                header["bytes"] += len(line)
+                match = TIMESTAMP.search(line)
+                if match:
+                    timestamp = match.group(1).decode("utf-8")
+                    if header["first"] is None or timestamp < header["first"]:
+                        header["first"] = timestamp
+                    if header["last"] is None or timestamp > header["last"]:
+                        header["last"] = timestamp
+        header["sha256"] = digest.hexdigest()
+        header_line = json.dumps({"segment": header}) + "\n"
+
+        sealed = path + ".gz"
+        with open(sealed + ".tmp", "wb") as f:
+            f.write(gzip.compress(header_line.encode("utf-8"), self.level))
+            with open(path, "rb") as src, gzip.GzipFile(
+                fileobj=f,
+                mode="wb",
+                compresslevel=self.level,
+            ) as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(sealed + ".tmp", sealed)
+        os.remove(path)
+        self.retain()
+        return header
+
+    def retain(self) -> list[str]:
+        """Drop or archive old sealed segments, return their paths."""
+        with self._retain_lock:
+            return self._retain()
+
+    def _retain(self) -> list[str]:
+        sealed = [path for path in self.segments() if path.endswith(".gz")]
+        sizes = [os.path.getsize(path) for path in sealed]
+        total = sum(sizes)
+        now = time.time()
+        expired = []
+        # the latest sealed segment is always kept
+        for path, size in zip(sealed[:-1], sizes):
+            too_old = self.keep_days is not None and (
+                now - os.path.getmtime(path) > self.keep_days * 86400
+            )
+            too_large = self.keep_bytes is not None and total > self.keep_bytes
+            if not (too_old or too_large):
+                break
+            expired.append(path)
+            total -= size
+        for path in expired:
+            if self.archive:
+                os.makedirs(self.archive, exist_ok=True)
+                shutil.move(path, os.path.join(self.archive, os.path.basename(path)))
+            else:
+                os.remove(path)
+        if expired:
+            action = "Archived" if self.archive else "Dropped"
+            print(f"{action} {len(expired)} old log segment(s).")
+        return expired
+
+
+def read_segment_header(path: str) -> dict:
+    """Read the header of a sealed segment, only its first member is expanded."""
+    decompressor = zlib.decompressobj(wbits=31)
+    data = b""
+    with open(path, "rb") as f:
+        while not decompressor.eof:
+            chunk = f.read(4096)
+            if not chunk:
+                raise ValueError(f"Truncated segment header in {path}")
+            data += decompressor.decompress(chunk)
+    return json.loads(data)["segment"]
+
+
+def read_log(
+    path: str,
+    since: str | None = None,
+    until: str | None = None,
+    verify: bool = False,
+):
+    """
+    Yield the logged lines as dicts, oldest first, from a single log file
+    or all segments of a segmented one, one line in memory at a time.
+    since and until are ISO timestamps that limit the events, sealed
+    segments outside of them are skipped by their header. With verify,
+    the lines of sealed segments are checked against their SHA-256.
+    """
+    paths = SegmentedLog(path).segments()
+    if os.path.exists(path):
+        # logged before the log was segmented
+        paths.insert(0, path)
+    for segment in paths:
+        header = None
+        if segment.endswith(".gz"):
+            header = read_segment_header(segment)
+            if since and header["last"] and header["last"] < since:
+                continue
+            if until and header["first"] and header["first"] > until:
+                continue
+            f = gzip.open(segment, "rb")
+            # the header line
+            f.readline()
+        else:
+            f = open(segment, "rb")
+        digest = hashlib.sha256()
+        with f:
+            for line in f:
+                if verify:
+                    digest.update(line)
+                if since or until:
+                    match = TIMESTAMP.search(line)
+                    timestamp = match.group(1).decode("utf-8") if match else None
+                    if timestamp and since and timestamp < since:
+                        continue
+                    if timestamp and until and timestamp > until:
+                        continue
+                yield json.loads(line)
+        if verify and header and digest.hexdigest() != header["sha256"]:
+            raise ValueError(f"Segment {segment} does not match its checksum")
+
+
+class LogWriter:
+    """
+    Appends lines to the log file from a single task (group commit).
+
+    Lines are collected in a buffer and written with one write once it
+    holds max_bytes or max_delay seconds after its first line, the file
+    stays open. The fsync policy tells when written lines are durable:
+
+    - "never": lines are handed to the OS, they survive a crash of the
+      recorder but not of the host.
+    - "batch": every write is followed by an fsync, a line is durable
+      once its batch was written.
+    - a number of milliseconds: fsync at most that often, a crash of the
+      host loses up to that much of the latest lines.
+
+    write() only waits while more than max_pending bytes are not written.
+    Once writing failed, write() raises the error of the writer task.
+    With segments, the lines go to the current segment of a SegmentedLog
+    and full segments are sealed in an executor while writing goes on.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        fsync: str = "batch",
+        max_bytes: int = 1024 * 1024,
+        max_delay: float = 0.01,
+        max_pending: int = 16 * 1024 * 1024,
+        segments: SegmentedLog | None = None,
+    ):
+        if fsync not in ("never", "batch") and not fsync.isdigit():
+            raise ValueError(f"Invalid fsync policy {fsync}")
+        self.path = path
+        self.fsync = fsync
+        self.fsync_interval = int(fsync) / 1000 if fsync.isdigit() else None
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.segments = segments
+        self._lines = []
+        self._size = 0
+        # sum of the enqueue times of the buffered lines and the time of
+        # the first one, for their latency
+        self._enqueued = 0.0
+        self._first = 0.0
+        self._ready = asyncio.Event()
+        self._written = asyncio.Event()
+        self._task = None
+        self._closing = False
+        self._last_fsync = 0.0
+        # written lines wait for the next fsync of the interval
+        self._dirty = False
+        self._started = time.monotonic()
+        # the file written and its size and opening time, for rotation
+        self._path = path
+        self._file_size = 0
+        self._opened = 0.0
+        self._sealing = set()
+        # statistics
+        self.lines = 0
+        self.bytes = 0
+        self.batches = 0
+        self.fsyncs = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.sealed = 0
+
+    async def write(self, line: str) -> None:
+        """Queue a line for the log, it is written by the writer task."""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+            # wakes the lines waiting for room if the task fails
+            self._task.add_done_callback(lambda task: self._written.set())
+        self._check()
+        while self._size > self.max_pending:
+            self._written.clear()
+            await self._written.wait()
+            self._check()
+        now = time.monotonic()
+        if not self._lines:
+            self._first = now
+        self._lines.append(line)
+        self._size += len(line)
+        self._enqueued += now
+        if len(self._lines) == 1 or self._size >= self.max_bytes:
+            self._ready.set()
+
+    def _check(self) -> None:
+        """Raise the error that stopped the writer task."""
+        if not self._task.done() or self._task.cancelled():
+            return
+        if self._task.exception() is not None:
+            raise self._task.exception()
+
+    async def _run(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if self.segments:
+            # left over by a recorder that did not stop cleanly
+            for path in self.segments.unsealed():
+                self._seal(path)
+        f = await self._open()
+        try:
+            while not (self._closing and not self._lines):
+                try:
+                    await asyncio.wait_for(self._ready.wait(), self._timeout())
+                except asyncio.TimeoutError:
+                    pass
+                self._ready.clear()
+                if self._lines and self._size < self.max_bytes and not self._closing:
+                    # give more lines the chance to join the batch
+                    try:
+                        await asyncio.wait_for(self._full(), self.max_delay)
+                    except asyncio.TimeoutError:
+                        pass
+                if self._lines:
+                    await self._commit(f)
+                elif self._until_sync() == 0:
+                    # no lines came within the interval of the last batch
+                    await self._sync(f)
+                if self._until_rotation() == 0:
+                    f = await self._rotate(f)
+            if self.fsync_interval:
+                await self._sync(f, force=True)
+        finally:
+            await f.close()
+        if self.segments:
+            self._seal(self._path)
+            await asyncio.gather(*self._sealing, return_exceptions=True)
+
+    async def _open(self):
+        if self.segments:
+            self._path = self.segments.next_path()
+        self._file_size = 0
+        self._opened = time.monotonic()
+        return await aiofiles.open(self._path, "a", encoding="utf-8")
+
+    def _until_rotation(self) -> float | None:
+        """Seconds until the segment is rotated, None while not due."""
+        if not self.segments or not self._file_size:
+            return None
+        if self._file_size >= self.segments.max_bytes:
+            return 0
+        return max(0, self._opened + self.segments.max_age - time.monotonic())
+
+    def _until_sync(self) -> float | None:
+        """Seconds until the deferred fsync is due, None if there is none."""
+        if not self._dirty:
+            return None
+        return max(0, self._last_fsync + self.fsync_interval - time.monotonic())
+
+    def _timeout(self) -> float | None:
+        timeouts = [
+            timeout
+            for timeout in (self._until_rotation(), self._until_sync())
+            if timeout is not None
+        ]
+        return min(timeouts) if timeouts else None
+
+    async def _rotate(self, f):
+        if self.fsync_interval:
+            await self._sync(f, force=True)
+        await f.close()
+        self._seal(self._path)
+        return await self._open()
+
+    def _seal(self, path: str) -> None:
+        future = asyncio.get_running_loop().run_in_executor(
+            None,
+            self.segments.seal,
+            path,
+        )
+        self._sealing.add(future)
+        future.add_done_callback(self._sealed)
+
+    def _sealed(self, future) -> None:
+        self._sealing.discard(future)
+        if future.exception() is not None:
+            print(f"Failed to seal a log segment: {future.exception()}")
+        elif future.result() is not None:
+            self.sealed += 1
+
+    async def _full(self) -> None:
+        while self._size < self.max_bytes and not self._closing:
+            self._ready.clear()
+            await self._ready.wait()
+
+    async def _commit(self, f) -> None:
+        lines, self._lines = self._lines, []
+        enqueued, self._enqueued = self._enqueued, 0.0
+        first = self._first
+        self._size = 0
+        self._written.set()
+        data = "".join(lines)
+        await f.write(data)
+        await f.flush()
+        await self._sync(f)
+        now = time.monotonic()
+        self._file_size += len(data)
+        self.lines += len(lines)
+        self.bytes += len(data)
+        self.batches += 1
+        self.latency_total += len(lines) * now - enqueued
+        # the first line of the batch waited longest
+        self.latency_max = max(self.latency_max, now - first)
+
+    async def _sync(self, f, force: bool = False) -> None:
+        if self.fsync == "never" and not force:
+            return
+        now = time.monotonic()
+        if self.fsync_interval and not force:
+            if now - self._last_fsync < self.fsync_interval:
+                self._dirty = True
+                return
+        await asyncio.get_running_loop().run_in_executor(None, os.fsync, f.fileno())
+        self._last_fsync = now
+        self._dirty = False
+        self.fsyncs += 1
+
+    async def close(self) -> None:
+        """Write and sync the remaining lines and close the file."""
+        if self._task is None:
+            return
+        self._closing = True
+        self._ready.set()
+        try:
+            await self._task
+        finally:
+            self._task = None
+            self._closing = False
+
+    def stats(self) -> dict:
+        elapsed = time.monotonic() - self._started
+        return {
+            "lines": self.lines,
+            "bytes": self.bytes,
+            "batches": self.batches,
+            "fsyncs": self.fsyncs,
+            "lines_per_second": self.lines / elapsed if elapsed else 0.0,
+            "mean_latency_ms": (
+                self.latency_total / self.lines * 1000 if self.lines else 0.0
+            ),
+            "max_latency_ms": self.latency_max * 1000,
+            "segments_sealed": self.sealed,
+        }
+
 
 class FSORecorderClient:
-    def __init__(self, host: str, port: int, topic: str, logfile: str):
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        topic: str,
+        logfile: str,
+        binary: bool = False,
+        group: str | None = None,
+        versions: str | None = None,
+        dictionaries: str | None = None,
+        fsync: str = "batch",
+        segment_mb: int = 0,
+        keep_days: float | None = None,
+        archive: str | None = None,
+        keep_bytes: int | None = None,
+    ):
         self.host = host
         self.port = port
         self.topic = topic
         self.file_path = logfile
+        # request the binary protocol, only active if the broker accepts it
+        self.binary = binary
+        # share the subscription with other recorders of the same group
+        self.group = group
+        # directory of binary file versions named by their SHA-256,
+        # deltas are applied to the versions found there
+        self.versions = versions
+        # versions rebuilt from the parts of a larger one, removed once
+        # the next part was applied
+        self.partial_versions = set()
+        # compressed diffs are expanded with the dictionaries of this
+        # directory before they are logged, otherwise logged compressed
+        self.dictionaries = load_dictionaries(dictionaries) if dictionaries else None
+        # the log is cut into compressed segments of segment_mb MiB or a
+        # day, otherwise a single file
+        segments = None
+        if segment_mb:
+            segments = SegmentedLog(
+                logfile,
+                max_bytes=segment_mb * 1024 * 1024,
+                keep_bytes=keep_bytes,
+                keep_days=keep_days,
+                archive=archive,
+            )
+        # keeps the log open and writes many lines at once
+        self.log = LogWriter(logfile, fsync, segments=segments)
         self.reader = None
         self.writer = None
 
@@ -19,13 +715,37 @@ class FSORecorderClient:
         """Connects to the broker."""
         self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
         print(f"Connected to {self.host}:{self.port}")
+        if self.binary:
+            await self.negotiate()
         # Send the SUBSCRIBE command
         await self.subscribe()
 
+    async def negotiate(self):
+        """Asks the broker to switch to the binary protocol."""
+        self.writer.write(f"HELLO {PROTOCOL_BINARY}\n".encode("utf-8"))
+        await self.writer.drain()
+        try:
+            answer = await asyncio.wait_for(self.reader.readline(), HANDSHAKE_TIMEOUT)
+        except asyncio.TimeoutError:
+            # brokers without protocol negotiation ignore the HELLO
+            answer = b""
+        self.binary = answer.strip() == f"OK {PROTOCOL_BINARY}".encode("utf-8")
+        if not self.binary:
+            print("Broker does not support the binary protocol, using text.")
+
     async def subscribe(self):
         """Sends a subscription request to the broker."""
-        command = f"SUBSCRIBE {self.topic}\n"
-        self.writer.write(command.encode("utf-8"))
+        if self.binary and self.group:
+            group = self.group.encode("utf-8")
+            self.writer.write(encode_frame(FRAME_SUBSCRIBE_GROUP, self.topic, group))
+        elif self.binary:
+            self.writer.write(encode_frame(FRAME_SUBSCRIBE, self.topic))
+        elif self.group:
+            command = f"SUBSCRIBE_GROUP {self.group} {self.topic}\n"
+            self.writer.write(command.encode("utf-8"))
+        else:
+            command = f"SUBSCRIBE {self.topic}\n"
+            self.writer.write(command.encode("utf-8"))
         await self.writer.drain()
         print(f"Subscribed to topic: {self.topic}")
 
@@ -33,6 +753,12 @@ class FSORecorderClient:
         """Processes messages from the broker."""
         try:
             while True:
+                if self.binary:
+                    if not await self.process_frame():
+                        print("Connection closed by broker.")
+                        break
+                    continue
+
                 # Read a line from the broker
                 line = await self.reader.readline()
                 if not line:
@@ -46,23 +772,65 @@ class FSORecorderClient:
             print("Message processing task was cancelled.")
         finally:
             self.disconnect()
+            await self.log.close()
+            print(f"Log writer: {self.log.stats()}")
 
-    async def __log_line(self, topic: str, payload: dict):
+    async def process_frame(self) -> bool:
         """
-        Asynchronously writes a message with topic and payload
-        in JSON Line Protocol format to the specified file.
+        Reads and handles a single frame of the binary protocol.
+        Returns False if the broker closed the connection.
         """
-        # Ensure the directory for the file exists
-        os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+        try:
+            header = await self.reader.readexactly(FRAME_HEADER.size)
+            frame_type, topic_size, body_size = FRAME_HEADER.unpack(header)
+            data = await self.reader.readexactly(topic_size + body_size)
+        except asyncio.IncompleteReadError:
+            return False
+        if frame_type == FRAME_PUBLISH:
+            topic = data[:topic_size].decode("utf-8")
+            await self.handle_body(topic, data[topic_size:])
+        return True
 
+    async def __log_line(self, topic: str, payload: dict):
+        """
+        Queues a message with topic and payload in JSON Line Protocol
+        format for the log file, see LogWriter.
+        """
         json_line = {
             "topic": topic,
             "payload": payload,
         }
+        await self.log.write(json.dumps(json_line) + "\n")
+
+    def expand(self, payload: dict):
+        """Expand a compressed diff if the dictionaries are known."""
+        if self.dictionaries is None or payload.get("compressed_diff") is None:
+            return
+        try:
+            expand_diff(payload, self.dictionaries)
+        except (ValueError, zlib.error) as e:
+            print(f"Diff of {payload['file_path']} logged compressed: {e}")
 
-        # open file append mode...
-        async with aiofiles.open(self.file_path, "a", encoding="utf-8") as f:
-            await f.write(json.dumps(json_line) + "\n")
+    async def rebuild_version(self, payload: dict):
+        """
+        Rebuild the new version of a binary file from the delta of an
+        event if its base version is known. Reading, applying and writing
+        large files runs in an executor, not on the event loop.
+        """
+        if not self.versions or payload.get("delta") is None:
+            return
+        drop_base = payload.get("base_hash") in self.partial_versions
+        rebuilt = await asyncio.get_running_loop().run_in_executor(
+            None,
+            rebuild_version,
+            self.versions,
+            payload,
+            drop_base,
+        )
+        if rebuilt and drop_base:
+            self.partial_versions.discard(payload["base_hash"])
+        if rebuilt and payload.get("partial"):
+            self.partial_versions.add(payload["content_hash"])
 
     async def handle_message(self, message: str):
         """Handles an incoming message."""
@@ -72,17 +840,36 @@ class FSORecorderClient:
             print(f"Topic: {topic}")
 
             # Decode the payload from Base64
-            decoded_payload = base64.b64decode(payload).decode("utf-8")
-            # Parse JSON and pretty-print it
-            parsed_payload = json.loads(decoded_payload)
+            decoded_payload = base64.b64decode(payload)
+            # Parse JSON or the compact encoding and pretty-print it
+            parsed_payload = parse_payload(decoded_payload)
             print(json.dumps(parsed_payload, indent=4))
 
             # Log it to a file
+            self.expand(parsed_payload)
             await self.__log_line(topic, parsed_payload)
+            await self.rebuild_version(parsed_payload)
 
-        except (ValueError, json.JSONDecodeError) as e:
+        except (ValueError, IndexError, struct.error) as e:
             print(f"Failed to process message: {message}\nError: {e}")
 
+    async def handle_body(self, topic: str, body: bytes):
+        """Handles the body of a message received via the binary protocol."""
+        try:
+            print(f"Topic: {topic}")
+            if not body.startswith((b"{", bytes([COMPACT_MAGIC]))):
+                # published by a text client, the body is still base64
+                body = base64.b64decode(body)
+            parsed_payload = parse_payload(body)
+            print(json.dumps(parsed_payload, indent=4))
+
+            self.expand(parsed_payload)
+            await self.__log_line(topic, parsed_payload)
+            await self.rebuild_version(parsed_payload)
+
+        except (ValueError, IndexError, struct.error) as e:
+            print(f"Failed to process message on {topic}\nError: {e}")
+
     def disconnect(self):
         """Closes the connection to the broker."""
         if self.writer:
@@ -90,10 +877,38 @@ class FSORecorderClient:
             print("Disconnected from broker.")
 
 
-async def main(host, port, topic, logfile):
+async def main(
+    host,
+    port,
+    topic,
+    logfile,
+    binary,
+    group,
+    versions,
+    dictionaries,
+    fsync,
+    segment_mb,
+    keep_days,
+    archive,
+    keep_mb=None,
+):
     logfile = os.path.abspath(logfile)
 
-    client = FSORecorderClient(host, port, topic, logfile)
+    client = FSORecorderClient(
+        host,
+        port,
+        topic,
+        logfile,
+        binary,
+        group,
+        versions,
+        dictionaries,
+        fsync,
+        segment_mb,
+        keep_days,
+        archive,
+        keep_mb * 1024 * 1024 if keep_mb is not None else None,
+    )
     await client.connect()
 
     # Start processing messages
@@ -109,9 +924,70 @@ if __name__ == "__main__":
     parser.add_argument("-p", type=int, help="broker port", default=1883)
     parser.add_argument("-t", type=str, help="topic string", default="/tmp/enlyze~")
     parser.add_argument("-l", type=str, help="log file path", default="./audit.log")
+    parser.add_argument("-b", action="store_true", help="use the binary protocol")
+    parser.add_argument("-g", type=str, help="share events with group", default=None)
+    parser.add_argument(
+        "-v",
+        type=str,
+        help="directory of binary file versions to apply deltas to",
+        default=None,
+    )
+    parser.add_argument(
+        "-d",
+        type=str,
+        help="directory of diff dictionaries to expand compressed diffs with",
+        default=None,
+    )
+
+    parser.add_argument(
+        "-f",
+        type=str,
+        help="fsync the log: never, after every batch or every N milliseconds",
+        default="batch",
+    )
+    parser.add_argument(
+        "-r",
+        type=int,
+        help="rotate the log into compressed segments of N MiB or a day",
+        default=0,
+    )
+    parser.add_argument(
+        "-k",
+        type=float,
+        help="days to keep log segments, all if not given",
+        default=None,
+    )
+    parser.add_argument(
+        "-m",
+        type=int,
+        help="MiB of sealed log segments to keep, all if not given",
+        default=None,
+    )
+    parser.add_argument(
+        "-a",
+        type=str,
+        help="directory to archive old log segments to instead of dropping them",
+        default=None,
+    )
 
     args = parser.parse_args()
     try:
-        asyncio.run(main(args.c, args.p, args.t, args.l))
+        asyncio.run(
+            main(
+                args.c,
+                args.p,
+                args.t,
+                args.l,
+                args.b,
+                args.g,
+                args.v,
+                args.d,
+                args.f,
+                args.r,
+                args.k,
+                args.a,
+                args.m,
+            ),
+        )
     except KeyboardInterrupt:
         print("FSO Recorder stopped.")
@@ -1,8 +1,28 @@
+import asyncio
+import base64
+import errno
+import gzip
+import hashlib
+import json
+import os
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import AsyncMock, patch
 
 import pytest
 
-from recorder import FSORecorderClient
+from recorder import (
+    FRAME_PUBLISH,
+    FRAME_SUBSCRIBE,
+    FSORecorderClient,
+    LogWriter,
+    SegmentedLog,
+    encode_frame,
+    load_dictionaries,
+    read_log,
+    read_segment_header,
+)
 
 
 @pytest.fixture
@@ -79,3 +99,389 @@ async def test_disconnect(client):
     client.disconnect()
 
     mock_writer.close.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_connect_binary(client):
+    """Test that the client negotiates the binary protocol."""
+    client.binary = True
+    with patch("asyncio.open_connection", new_callable=AsyncMock) as mock_connection:
+        mock_reader = AsyncMock()
+        mock_reader.readline.return_value = b"OK 2\n"
+        mock_writer = AsyncMock()
+        mock_connection.return_value = (mock_reader, mock_writer)
+
+        await client.connect()
+
+        assert client.binary is True
+        mock_writer.write.assert_any_call(b"HELLO 2\n")
+        mock_writer.write.assert_any_call(encode_frame(FRAME_SUBSCRIBE, "/tmp/enlyze~"))
+
+
+@pytest.mark.asyncio
+async def test_connect_binary_unsupported(client):
+    """Test that the client falls back to text if the broker refuses."""
+    client.binary = True
+    with patch("asyncio.open_connection", new_callable=AsyncMock) as mock_connection:
+        mock_reader = AsyncMock()
+        mock_reader.readline.return_value = b"OK 1\n"
+        mock_writer = AsyncMock()
+        mock_connection.return_value = (mock_reader, mock_writer)
+
+        await client.connect()
+
+        assert client.binary is False
+        mock_writer.write.assert_any_call(b"SUBSCRIBE /tmp/enlyze~\n")
+
+
+@pytest.mark.asyncio
+async def test_process_messages_binary(client):
+    """Test that binary frames with JSON and base64 bodies are logged."""
+    client.binary = True
+    client.writer = AsyncMock()
+    client.reader = asyncio.StreamReader()
+    client.reader.feed_data(
+        encode_frame(FRAME_PUBLISH, "/tmp/enlyze/a", b'{"key": "Value"}')
+        + encode_frame(FRAME_PUBLISH, "/tmp/enlyze/b", b"eyJrZXkiOiAiVmFsdWUifQ=="),
+    )
+    client.reader.feed_eof()
+
+    with patch.object(
+        client,
+        "_FSORecorderClient__log_line",
+        new_callable=AsyncMock,
+    ) as mock_log_line:
+        await client.process_messages()
+
+    mock_log_line.assert_any_await("/tmp/enlyze/a", {"key": "Value"})
+    mock_log_line.assert_any_await("/tmp/enlyze/b", {"key": "Value"})
+    assert client.writer.close.called
+
+
+@pytest.mark.asyncio
+async def test_subscribe_group(client):
+    """Test that recorders of a group share the subscription."""
+    client.group = "recorders"
+    client.writer = AsyncMock()
+
+    await client.subscribe()
+
+    client.writer.write.assert_called_once_with(
+        b"SUBSCRIBE_GROUP recorders /tmp/enlyze~\n",
+    )
+
+
+@pytest.mark.asyncio
+async def test_rebuild_version(client, tmp_path):
+    """Test that deltas of binary files are applied to known versions."""
+    base = b"\x00\x01" * 100
+    data = base[:50] + b"new" + base[100:]
+    (tmp_path / hashlib.sha256(base).hexdigest()).write_bytes(base)
+    client.versions = str(tmp_path)
+
+    await client.rebuild_version(
+        {
+            "file_path": "/tmp/enlyze/firmware.bin",
+            "delta": [[0, 50], base64.b64encode(b"new").decode(), [100, 100]],
+            "base_hash": hashlib.sha256(base).hexdigest(),
+            "content_hash": hashlib.sha256(data).hexdigest(),
+        },
+    )
+
+    assert (tmp_path / hashlib.sha256(data).hexdigest()).read_bytes() == data
+
+
+@pytest.mark.asyncio
+async def test_rebuild_first_version(client, tmp_path):
+    """Test that a delta without a base carries the whole version."""
+    data = b"\x00\x01" * 100
+    client.versions = str(tmp_path)
+
+    await client.rebuild_version(
+        {
+            "file_path": "/tmp/enlyze/firmware.bin",
+            "delta": [base64.b64encode(data).decode()],
+            "base_hash": None,
+            "content_hash": hashlib.sha256(data).hexdigest(),
+        },
+    )
+
+    assert (tmp_path / hashlib.sha256(data).hexdigest()).read_bytes() == data
+
+
+@pytest.mark.asyncio
+async def test_rebuild_version_in_parts(client, tmp_path):
+    """Test that a version sent in parts is rebuilt without the parts."""
+    data = bytes(range(256)) * 4
+    first = hashlib.sha256(data[:512]).hexdigest()
+    client.versions = str(tmp_path)
+
+    for payload in [
+        {
+            "delta": [base64.b64encode(data[:512]).decode()],
+            "base_hash": None,
+            "content_hash": first,
+            "partial": True,
+        },
+        {
+            "delta": [[0, 512], base64.b64encode(data[512:]).decode()],
+            "base_hash": first,
+            "content_hash": hashlib.sha256(data).hexdigest(),
+            "partial": False,
+        },
+    ]:
+        await client.rebuild_version(dict(payload, file_path="/tmp/enlyze/a.bin"))
+
+    assert os.listdir(tmp_path) == [hashlib.sha256(data).hexdigest()]
+    assert client.partial_versions == set()
+
+
+@pytest.mark.asyncio
+async def test_handle_compact_body(client):
+    """Test that compact encoded events are logged like their JSON encoding."""
+    body = (
+        b"\xfe\x01\x01,\x00\x06'\xa5DXy\x80\x00\x00\x00\x01\x00\x04host"
+        b"\x00\x0e/data/blob.bin\x00\x02cd\x00\x02ab\x00\x00\x00\x1f\x00\x00\x00\x02"
+        + bytes(15)
+        + b"\x10\x00\x01\x00\x00\x00\x05hello"
+    )
+    with patch.object(
+        client,
+        "_FSORecorderClient__log_line",
+        new_callable=AsyncMock,
+    ) as mock_log_line:
+        await client.handle_body("/tmp/enlyze/a", body)
+        await client.handle_message(
+            "/tmp/enlyze/a " + base64.b64encode(body).decode("ascii"),
+        )
+
+    payload = {
+        "emitter": "host",
+        "event_type": "modified",
+        "timestamp": "2024-11-24T09:30:30",
+        "file_path": "/data/blob.bin",
+        "destination_path": None,
+        "diff": None,
+        "diff_compression": None,
+        "compressed_diff": None,
+        "delta": [[0, 4096], "aGVsbG8="],
+        "base_hash": "ab",
+        "content_hash": "cd",
+        "merged_events": 1,
+        "is_directory": False,
+        "partial": False,
+    }
+    assert mock_log_line.await_args_list[0].args == ("/tmp/enlyze/a", payload)
+    assert mock_log_line.await_args_list[1].args == ("/tmp/enlyze/a", payload)
+
+
+@pytest.mark.asyncio
+async def test_expand_compressed_diff(client, tmp_path):
+    """Test that compressed diffs are expanded with the shared dictionary."""
+    dictionary = b'["--- previous_version", "+++ current_version", "@@ -1 +1 @@", '
+    (tmp_path / "conf.dict").write_bytes(dictionary)
+    diff = ["--- previous_version", "+++ current_version", "-a = 1\n", "+a = 2\n"]
+    compressor = zlib.compressobj(zdict=dictionary)
+    data = compressor.compress(json.dumps(diff).encode()) + compressor.flush()
+    payload = {
+        "file_path": "/etc/app.conf",
+        "diff": None,
+        "diff_compression": "zlib:" + hashlib.sha256(dictionary).hexdigest()[:16],
+        "compressed_diff": base64.b64encode(data).decode(),
+    }
+
+    # without the dictionaries the diff is logged compressed
+    client.expand(payload)
+    assert payload["diff"] is None
+
+    client.dictionaries = load_dictionaries(str(tmp_path))
+    client.expand(payload)
+    assert payload["diff"] == diff
+    assert payload["compressed_diff"] is None
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("fsync", ["never", "batch", "50"])
+async def test_log_writer(tmp_path, fsync):
+    """Test that lines are written in order with few writes and fsyncs."""
+    path = tmp_path / "logs" / "audit.jsonl"
+    writer = LogWriter(str(path), fsync, max_bytes=4096)
+    for i in range(2000):
+        await writer.write(f"line {i}\n")
+        if i % 500 == 0:
+            # let the writer commit while lines keep coming
+            await asyncio.sleep(0)
+    await writer.close()
+
+    assert path.read_text().splitlines() == [f"line {i}" for i in range(2000)]
+    stats = writer.stats()
+    assert stats["lines"] == 2000
+    assert stats["batches"] < 100
+    if fsync == "never":
+        assert stats["fsyncs"] == 0
+    elif fsync == "batch":
+        assert stats["fsyncs"] == stats["batches"]
+    else:
+        # at most every 50 ms and once more on close
+        assert 1 <= stats["fsyncs"] <= stats["batches"] + 1
+    assert stats["max_latency_ms"] >= stats["mean_latency_ms"]
+
+
+@pytest.mark.asyncio
+async def test_log_writer_deferred_fsync(tmp_path):
+    """Test that a batch within the fsync interval is synced while idle."""
+    writer = LogWriter(str(tmp_path / "audit.jsonl"), "100", max_delay=0)
+    await writer.write("first\n")
+    await asyncio.sleep(0.05)
+    await writer.write("second\n")
+    await asyncio.sleep(0.3)
+    assert writer.stats()["batches"] == 2
+    assert writer.stats()["fsyncs"] == 2
+    await writer.close()
+
+
+@pytest.mark.asyncio
+async def test_log_writer_failure(tmp_path, monkeypatch):
+    """Test that writes fail instead of waiting once writing failed."""
+
+    def fsync(fd):
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    monkeypatch.setattr(os, "fsync", fsync)
+    writer = LogWriter(str(tmp_path / "audit.jsonl"), "batch", max_pending=100)
+
+    async def write_all():
+        for i in range(1000):
+            await writer.write(f"line {i}\n")
+
+    with pytest.raises(OSError) as error:
+        await asyncio.wait_for(write_all(), 5)
+    assert error.value.errno == errno.ENOSPC
+    with pytest.raises(OSError):
+        await writer.close()
+
+
+def test_log_writer_policy(tmp_path):
+    with pytest.raises(ValueError):
+        LogWriter(str(tmp_path / "audit.jsonl"), "sometimes")
+
+
+def log_line(i: int) -> str:
+    payload = {"timestamp": f"2024-10-20T12:{i // 60:02d}:{i % 60:02d}", "n": i}
+    return json.dumps({"topic": "/tmp/enlyze~", "payload": payload}) + "\n"
+
+
+@pytest.mark.asyncio
+async def test_segmented_log(tmp_path):
+    """Test that the log is rotated, sealed and read back across segments."""
+    path = str(tmp_path / "audit.jsonl")
+    segments = SegmentedLog(path, max_bytes=4096)
+    writer = LogWriter(path, "never", max_bytes=1024, segments=segments)
+    for i in range(600):
+        await writer.write(log_line(i))
+        if i % 50 == 0:
+            await asyncio.sleep(0.02)
+    await writer.close()
+
+    paths = segments.segments()
+    assert len(paths) > 3
+    assert all(path.endswith(".jsonl.gz") for path in paths)
+    assert writer.stats()["segments_sealed"] == len(paths)
+    header = read_segment_header(paths[0])
+    assert header["first"] == "2024-10-20T12:00:00"
+    assert header["events"] > 0
+    assert sum(read_segment_header(path)["events"] for path in paths) == 600
+
+    assert [line["payload"]["n"] for line in read_log(path, verify=True)] == list(
+        range(600)
+    )
+    assert [
+        line["payload"]["n"]
+        for line in read_log(
+            path,
+            since="2024-10-20T12:05:00",
+            until="2024-10-20T12:05:59",
+        )
+    ] == list(range(300, 360))
+
+    # a new writer continues after the existing segments and seals the
+    # segment a crashed one left behind
+    crashed = segments.next_path()
+    with open(crashed, "w") as f:
+        f.write(log_line(600))
+    writer = LogWriter(path, "never", segments=SegmentedLog(path, max_age=0.05))
+    await writer.write(log_line(601))
+    await asyncio.sleep(0.2)
+    await writer.write(log_line(602))
+    await writer.close()
+    assert len(segments.segments()) == len(paths) + 3
+    assert [line["payload"]["n"] for line in read_log(path)][-3:] == [600, 601, 602]
+
+
+def test_segment_checksum_and_retention(tmp_path):
+    path = str(tmp_path / "audit.jsonl")
+    archive = tmp_path / "archive"
+    segments = SegmentedLog(path, keep_bytes=1, archive=str(archive))
+    for i in range(3):
+        with open(segments.next_path(), "w") as f:
+            f.write(log_line(i))
+    first, second, third = segments.segments()
+    segments.keep_bytes = None
+    segments.seal(first)
+    segments.seal(second)
+
+    # only the last sealed segment stays within one byte
+    segments.keep_bytes = 1
+    segments.seal(third)
+    assert segments.segments() == [third + ".gz"]
+    assert sorted(p.name for p in archive.iterdir()) == [
+        "audit.00000001.jsonl.gz",
+        "audit.00000002.jsonl.gz",
+    ]
+
+    # a tampered segment is noticed
+    with open(third + ".gz", "ab") as f:
+        f.write(gzip.compress(log_line(3).encode()))
+    assert len(list(read_log(path))) == 2
+    with pytest.raises(ValueError):
+        list(read_log(path, verify=True))
+
+
+def test_concurrent_retention(tmp_path, monkeypatch):
+    """Test that seals running at once do not remove a segment twice."""
+    path = str(tmp_path / "audit.jsonl")
+    segments = SegmentedLog(path)
+    for i in range(8):
+        with open(segments.next_path(), "w") as f:
+            f.write(log_line(i))
+    for segment in segments.segments():
+        segments.seal(segment)
+
+    remove = os.remove
+
+    def slow_remove(path):
+        # let the other threads list the segments meanwhile
+        time.sleep(0.01)
+        remove(path)
+
+    monkeypatch.setattr(os, "remove", slow_remove)
+    segments.keep_bytes = 1
+    with ThreadPoolExecutor(4) as pool:
+        dropped = list(pool.map(lambda _: segments.retain(), range(4)))
+
+    assert sorted(len(paths) for paths in dropped) == [0, 0, 0, 7]
+    assert len(segments.segments()) == 1
+
+
+def test_client_segment_retention(tmp_path):
+    client = FSORecorderClient(
+        host="127.0.0.1",
+        port=1883,
+        topic="/tmp/enlyze~",
+        logfile=str(tmp_path / "audit.jsonl"),
+        segment_mb=1,
+        keep_days=7,
+        keep_bytes=64 * 1024 * 1024,
+    )
+    assert client.log.segments.keep_bytes == 64 * 1024 * 1024
+    assert client.log.segments.keep_days == 7